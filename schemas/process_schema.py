@@ -6,4 +6,5 @@ class ProcessResponse(BaseModel):
     status: bool = Field(..., description="Process status, True for success, False for failure")
     message: str = Field(..., description="Process message") 
     data: Optional[List[Dict[str, Any]]] = Field(None, description="List of process result data")
+    admission: Optional[Dict[str, float]] = Field(None, description="Expected queue seconds and seconds to completion when the call was admitted")
 
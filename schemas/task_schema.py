@@ -0,0 +1,56 @@
+from pydantic import BaseModel, Field, model_validator
+import re
+from typing import Any, Optional, Dict, List, Literal
+
+
+# Parameters every poster workflow receives, each one is bound to one or more workflow inputs
+REQUIRED_BINDINGS = ("input_image", "flux_prompt", "seed", "x_percent", "y_percent", "scale", "width", "height")
+
+VARIANT_ID_PATTERN = re.compile(r"[A-Za-z0-9_.-]{1,64}")
+
+
+class InputBinding(BaseModel):
+    """One workflow input a task parameter is written to"""
+    node: str = Field(..., description="Node ID in the API-format workflow")
+    input: str = Field(..., description="Input name of the node")
+
+
+class WorkflowVariant(BaseModel):
+    """One version of the workflow of a task type, rendered for a share of its requests"""
+    weight: float = Field(0, ge=0, description="Share of the requests relative to the other variants, 0 only when requested by name")
+    overrides: Dict[str, Dict[str, Any]] = Field(default_factory=dict, description="Node ID -> input -> value, a [node ID, output] value rewires the input")
+
+
+class TaskSpec(BaseModel):
+    """One task type of templates/task_registry.yml"""
+    task_type: str = Field(..., description="Task type, the registry key")
+    workflow: str = Field(..., description="API-format ComfyUI workflow file")
+    prompt_templates: str = Field("templates/prompt_templates.yml", description="YAML file with the prompt templates")
+    prompt_key: str = Field(..., description="Template key of the system prompt used to write the image prompt")
+    placement_key: str = Field(..., description="Template key of the product placement prompts")
+    bindings: Dict[str, List[InputBinding]] = Field(..., description="Task parameter -> workflow inputs it is written to")
+    outputs: Dict[str, str] = Field(..., description="Output node ID -> result name")
+    middle_outputs: Dict[str, str] = Field(default_factory=dict, description="Output node ID -> result name, with show_middle_result")
+    width: Optional[int] = Field(None, description="Default output width, IMAGE2POSTER_OUTPUT_SIZE_WIDTH when not set")
+    height: Optional[int] = Field(None, description="Default output height, IMAGE2POSTER_OUTPUT_SIZE_HEIGHT when not set")
+    scale_min: Optional[float] = Field(None, description="Smallest product scale, IMAGE2POSTER_SCALE_MIN when not set")
+    scale_max: Optional[float] = Field(None, description="Largest product scale, IMAGE2POSTER_SCALE_MAX when not set")
+    batchsize_use_one_prompt: Optional[int] = Field(None, description="Images sharing one prompt, IMAGE2POSTER_BATCHSIZE_USE_ONE_PROMPT when not set")
+    preprocess_node: Optional[str] = Field(None, description="Node whose output only depends on the input image, rendered once per image and reused")
+    draft_steps: List[InputBinding] = Field(default_factory=list, description="Sampler step inputs reduced for draft images")
+    placement_mode: Optional[Literal["llm", "local", "llm_with_fallback"]] = Field(None, description="How the product is placed, IMAGE2POSTER_PLACEMENT_MODE when not set")
+    variants: Dict[str, WorkflowVariant] = Field(default_factory=dict, description="Variant ID -> workflow version, requests are split by weight")
+
+    @model_validator(mode="after")
+    def check_bindings(self) -> "TaskSpec":
+        missing = [name for name in REQUIRED_BINDINGS if not self.bindings.get(name)]
+        if missing:
+            raise ValueError(f"task {self.task_type} has no binding for {missing}")
+        if not self.outputs:
+            raise ValueError(f"task {self.task_type} has no output node")
+        invalid = [variant_id for variant_id in self.variants if not VARIANT_ID_PATTERN.fullmatch(variant_id)]
+        if invalid:
+            raise ValueError(f"task {self.task_type} has invalid variant IDs {invalid}, letters, digits, '_', '.' and '-' only")
+        if self.variants and not any(variant.weight > 0 for variant in self.variants.values()):
+            raise ValueError(f"task {self.task_type} has no variant with a weight above 0")
+        return self
@@ -1,7 +1,9 @@
 import yaml
 import json
 import os
+import asyncio
 import httpx
+import uuid
 from typing import Dict, Any
 from abc import ABC, abstractmethod
 from datetime import datetime
@@ -12,26 +14,36 @@ from schemas.process_schema import ProcessResponse
 from utils.logger import logger
 from utils.setting import settings
 from utils.prompt_engineer import GeneratePrompt
-from utils.websocket_api import WebsocketAPI
+from utils.websocket_api import WebsocketAPI, DISK_OUTPUT_SUFFIX
+from utils.workflow_validator import WorkflowValidator
+from utils.cost_model import cost_model
+from utils.variant_stats import variant_stats
+from utils.singleflight import get_singleflight, make_key
+from utils.image_source import ImageSource, multipart_stream
 
 class BaseTaskProcessor(ABC):
     """ Task processor that supports asynchronous task execution """
-    def __init__(self, task_type, model_client, model_name):
+    def __init__(self, task_type, model_client, model_name, engine=None):
         """
         Initialize task processor
         Args:
             task_type: Type of task
             model_client: Model client
             model_name: Model name
+            engine: Optional TaskEngine whose connections and clients are shared with the other task types
         """
         # Store ongoing tasks
         self.task_type = task_type
 
         self.model_client = model_client
         self.model_name = model_name
+        self.engine = engine
 
         # Generate prompt
-        self.prompt_generator = GeneratePrompt(self.model_client, self.model_name)
+        if engine is not None:
+            self.prompt_generator = engine.prompt_generator
+        else:
+            self.prompt_generator = GeneratePrompt(self.model_client, self.model_name, candidates=settings.PROMPT_CANDIDATES)
 
     @staticmethod
     def group_task(batchsize, group_size=5):
@@ -45,14 +57,56 @@ class BaseTaskProcessor(ABC):
 
 
 class ComfyuiTaskProcessor(BaseTaskProcessor):
-    def __init__(self, task_type, model_client, model_name):
-        super().__init__(task_type, model_client, model_name)
+    def __init__(self, task_type, model_client, model_name, job_store=None, engine=None):
+        super().__init__(task_type, model_client, model_name, engine=engine)
+
+        # Optional durable job store, records the ComfyUI prompt_id and outputs of every batch item
+        self.job_store = job_store
 
         comfyui_base_api_url = settings.COMFYUI_BASE_API_URL        # ComfyUI address
         self.comfyui_upload_image_url = comfyui_base_api_url + "/api/upload/image"
 
+        if engine is not None:
+            # One websocket connection and schema cache for every task type of the engine
+            self.websocket_api = engine.websocket_api
+            self.workflow_validator = engine.workflow_validator
+        else:
+            self.websocket_api, self.workflow_validator = self.create_comfyui_clients(comfyui_base_api_url)
+
+        # Identical uploads in flight share one request
+        self.upload_flight = get_singleflight("upload", enabled=settings.SINGLEFLIGHT_ENABLED)
+
+    @staticmethod
+    def create_comfyui_clients(comfyui_base_api_url: str) -> tuple:
+        """
+        Returns:
+            tuple: (WebsocketAPI, WorkflowValidator or None when validation is disabled)
+        """
         # Configure websocket service
-        self.websocket_api = WebsocketAPI(comfyui_base_url=comfyui_base_api_url)
+        websocket_api = WebsocketAPI(comfyui_base_url=comfyui_base_api_url)
+
+        # Workflows are checked against cached node schemas, so bad parameters fail before they are queued
+        workflow_validator = None
+        if settings.COMFYUI_VALIDATE_WORKFLOW:
+            workflow_validator = WorkflowValidator(websocket_api.get_object_info, ttl=settings.COMFYUI_OBJECT_INFO_TTL,
+                                                   recheck_seconds=settings.COMFYUI_OBJECT_INFO_RECHECK_SECONDS)
+            websocket_api.on_node_errors = workflow_validator.invalidate_node_errors
+        # Node times of finished prompts train the cost model used for admission control and count for their workflow variant
+        websocket_api.on_prompt_timings = ComfyuiTaskProcessor.observe_prompt_timings
+        return websocket_api, workflow_validator
+
+    @staticmethod
+    def observe_prompt_timings(prompt_id: str, node_times: Dict[str, float]) -> None:
+        cost_model.observe_prompt(prompt_id, node_times)
+        variant_stats.observe_prompt(prompt_id, node_times)
+
+    async def validate_workflow(self, workflow_data: dict) -> None:
+        """
+        Raises:
+            WorkflowValidationError: When ComfyUI would reject the workflow
+        """
+        if self.workflow_validator is not None:
+            await asyncio.to_thread(self.workflow_validator.validate, workflow_data)
 
     @staticmethod 
     def load_template_prompt(prompt_template_path, template_key):
@@ -75,15 +129,25 @@ class ComfyuiTaskProcessor(BaseTaskProcessor):
             raise ValueError(f"Failed to load template: {str(e)}")
         
     @staticmethod
-    def change_workflow_output_to_websocket(workflow_data: dict) -> dict:
+    def change_workflow_output_to_websocket(workflow_data: dict, persist_outputs: bool = settings.COMFYUI_PERSIST_OUTPUTS) -> dict:
         """Change SaveImage and PreviewImage nodes to SaveImageWebsocket in workflow
+        With persist_outputs every changed node {id} gets a SaveImage twin {id}_disk on the same images, whose
+        files are listed in /history, so images sent while the websocket was down can still be downloaded.
         Args:
             workflow_data: Workflow data dictionary
+            persist_outputs: Keep the images on the ComfyUI disk as well
         Returns:
             dict: Modified workflow data
         """
-        for node in workflow_data.values():
+        for node_id, node in list(workflow_data.items()):
             if node.get('class_type') in ['SaveImage', 'PreviewImage']:
+                if persist_outputs:
+                    workflow_data[node_id + DISK_OUTPUT_SUFFIX] = {
+                        'class_type': 'SaveImage',
+                        'inputs': {'images': node['inputs']['images'],
+                                   'filename_prefix': node['inputs'].get('filename_prefix', f"poster/{node_id}")},
+                        '_meta': {'title': f"Disk copy of {node_id}"},
+                    }
                 node['class_type'] = 'SaveImageWebsocket'
         return workflow_data
 
@@ -95,6 +159,14 @@ class ComfyuiTaskProcessor(BaseTaskProcessor):
         return content_type
 
     async def upload_local_image_to_comfyui(self, image_path: str) -> str:
+        """
+        Upload local image to ComfyUI server, concurrent uploads of the same unchanged file share one request
+        """
+        stat = os.stat(image_path)
+        key = make_key(self.comfyui_upload_image_url, self.task_type, os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+        return await self.upload_flight.do(key, lambda: self._upload_local_image_to_comfyui(image_path))
+
+    async def _upload_local_image_to_comfyui(self, image_path: str) -> str:
         """
         Upload local image to ComfyUI server
         
@@ -151,6 +223,78 @@ class ComfyuiTaskProcessor(BaseTaskProcessor):
             for _, file_tuple in upload_data['files']:
                 file_tuple[1].close()
 
+    async def upload_image_source_to_comfyui(self, source: ImageSource) -> str:
+        """
+        Upload the input image of a call, a file, bytes, a file object or a URL, without a temporary file.
+        Its size and sniffed type are checked first; concurrent uploads of the same file or URL share one request
+        Raises:
+            ImageInputError: When the image is too large, not an image or cannot be downloaded
+        """
+        if source.url is not None:
+            key = make_key(self.comfyui_upload_image_url, self.task_type, source.url)
+            image_name, digest, product_profile = await self.upload_flight.do(key, lambda: self._upload_image_url(source))
+            source.digest = source.digest or digest
+            source.product_profile = source.product_profile or product_profile
+            return image_name
+        content_type, extension = await asyncio.to_thread(source.inspect)
+        if source.path is not None:
+            return await self.upload_local_image_to_comfyui(source.path)
+        return await self._upload_image_content(source, content_type, extension)
+
+    def _uploaded_image_name(self, response: httpx.Response, subfolder: str) -> str:
+        if response.status_code != 200:
+            raise Exception(f'Image upload failed: {response.text}')
+        return os.path.join(subfolder, response.json().get('name'))
+
+    async def _upload_image_content(self, source: ImageSource, content_type: str, extension: str) -> str:
+        """Upload bytes or a file object, httpx sends bytes as they are and reads a file object in chunks"""
+        subfolder = self.task_type
+        image_name = f"{datetime.now():%Y%m%d%H%M%S}-{source.stem}{extension}"
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                url=self.comfyui_upload_image_url,
+                headers={'Accept': 'image/png,image/jpeg,image/jpg'},
+                files=[('image', (image_name, source.upload_content(), content_type))],
+                data={'subfolder': subfolder}
+            )
+        return self._uploaded_image_name(response, subfolder)
+
+    async def _upload_image_url(self, source: ImageSource) -> tuple:
+        """
+        Stream a URL download into the upload request, chunk by chunk: the image is never held in memory
+        or written to disk as a whole
+        Returns:
+            tuple: (image name after successful upload, sha256 of the image, product profile when the source has an analyzer)
+        """
+        subfolder = self.task_type
+        boundary = uuid.uuid4().hex
+        async with source.download() as (content_type, extension, chunks), httpx.AsyncClient(timeout=settings.IMAGE_INPUT_TIMEOUT) as client:
+            image_name = f"{datetime.now():%Y%m%d%H%M%S}-{source.stem}{extension}"
+            response = await client.post(
+                url=self.comfyui_upload_image_url,
+                headers={'Accept': 'image/png,image/jpeg,image/jpg',
+                         'Content-Type': f'multipart/form-data; boundary={boundary}'},
+                content=multipart_stream(boundary, {'subfolder': subfolder}, 'image', image_name, content_type, chunks),
+            )
+        logger.info(f"tasktype-{self.task_type} streamed {source.label} into the upload of {image_name}")
+        return self._uploaded_image_name(response, subfolder), source.digest, source.product_profile
+
+    async def upload_image_bytes_to_comfyui(self, image: bytes, image_name: str, subfolder: str) -> str:
+        """
+        Upload image bytes under a fixed name, an existing file of that name is replaced
+        Returns:
+            str: Image name after successful upload
+        """
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                url=self.comfyui_upload_image_url,
+                files=[('image', (image_name, image, 'image/png'))],
+                data={'subfolder': subfolder, 'overwrite': 'true'}
+            )
+        if response.status_code != 200:
+            raise Exception(f'Image upload failed: {response.text}')
+        return os.path.join(subfolder, response.json().get('name'))
+
     @abstractmethod
     async def process(self, data: Dict[str, Any]) -> ProcessResponse:
         pass
\ No newline at end of file
@@ -0,0 +1,75 @@
+import json
+from typing import Dict, Any
+
+from schemas.process_schema import ProcessResponse
+from utils.logger import logger
+from utils.setting import settings
+from utils.output_store import OutputStore
+from utils.cost_model import cost_model
+from utils.variant_stats import variant_stats
+from utils.draft_store import DraftStore
+from utils.position_generator import PositionGenerator
+from utils.prompt_engineer import GeneratePrompt
+from utils.task_registry import load_task_registry
+from services.base_service import ComfyuiTaskProcessor
+from services.workflow_processor import WorkflowTaskProcessor
+
+
+class TaskEngine:
+    """
+    Serves every task type of the task registry with one set of connections and pools: one ComfyUI
+    websocket (one client_id), one workflow schema cache, one LLM client with its prompt and position
+    generators, one output store and one draft store. The scheduler and the singleflight groups are process-wide already.
+    """
+    def __init__(self, model_client, model_name, job_store=None, registry_path: str = settings.TASK_REGISTRY_PATH):
+        self.model_client = model_client
+        self.model_name = model_name
+        self.job_store = job_store
+        self.registry = load_task_registry(registry_path)
+
+        self.websocket_api, self.workflow_validator = ComfyuiTaskProcessor.create_comfyui_clients(settings.COMFYUI_BASE_API_URL)
+        self.prompt_generator = GeneratePrompt(model_client, model_name, candidates=settings.PROMPT_CANDIDATES)
+        self.position_generator = PositionGenerator(model_client=model_client, model_name=model_name)
+        self.output_store = OutputStore() if settings.OUTPUT_STORE_ENABLED else None
+        self.draft_store = DraftStore()
+
+        self._workflows: Dict[str, dict] = {}      # workflow file -> workflow with websocket outputs
+        self._processors: Dict[str, WorkflowTaskProcessor] = {}
+
+    @property
+    def task_types(self) -> list:
+        return list(self.registry)
+
+    def load_workflow(self, workflow_path: str) -> dict:
+        """Workflow of a file with its outputs changed to SaveImageWebsocket, loaded once per file"""
+        workflow_data = self._workflows.get(workflow_path)
+        if workflow_data is None:
+            with open(workflow_path, 'r', encoding='utf-8') as file:
+                workflow_data = json.load(file)
+            ComfyuiTaskProcessor.change_workflow_output_to_websocket(workflow_data)
+            self._workflows[workflow_path] = workflow_data
+        return workflow_data
+
+    def processor(self, task_type: str) -> WorkflowTaskProcessor:
+        """
+        Raises:
+            KeyError: When the registry has no such task type
+        """
+        processor = self._processors.get(task_type)
+        if processor is None:
+            processor = WorkflowTaskProcessor(self.registry[task_type], self)
+            self._processors[task_type] = processor
+        return processor
+
+    async def process(self, task_type: str, task_id: str, data: Dict[str, Any]) -> ProcessResponse:
+        if task_type not in self.registry:
+            logger.error(f"tasktype-{task_type} ERROR INFO: unknown task type, registered: {self.task_types}")
+            return {"status": False, "message": f"Unknown task type: {task_type}", "data": None}
+        return await self.processor(task_type).process(task_id=task_id, data=data)
+
+    def close(self) -> None:
+        self.websocket_api.close()
+        cost_model.save()
+        variant_stats.save()
+        if self.output_store is not None:
+            self.output_store.shutdown()
@@ -0,0 +1,913 @@
+import copy
+import random
+import io
+import os
+import json
+import math
+import hashlib
+import asyncio
+import time
+from PIL import Image
+from typing import Dict, Any, Optional
+import sys
+from pathlib import Path
+
+# Add project root directory to path if running this file directly
+if __name__ == "__main__" or not __package__:
+    current_file = Path(__file__).resolve()
+    project_root = current_file.parents[1]  # Go up one level to project root directory
+    sys.path.insert(0, str(project_root))  # Use insert(0,...) to ensure project path has highest priority
+
+try:
+    from utils.pipeline import Pipeline, PipelineStage, StageError
+    from utils.metrics import LatencyHistogram
+    from utils.prompt_engineer import GeneratePrompt
+    from utils.job_store import ITEM_DONE, ITEM_SUBMITTED
+    from utils.workflow_validator import WorkflowValidationError
+    from utils.singleflight import get_singleflight, make_key, singleflight_stats
+    from utils.profiling import ensure_loop_lag_monitor, maybe_profile_call
+    from utils.placement import LocalPlacementEstimator, PLACEMENT_MODES, profile_product
+    from utils.image_source import ImageSource, ImageInputError
+    from utils.semantic_cache import SemanticCache
+    from utils.workflow_split import split_workflow, preprocess_output_id, bindings_in, apply_overrides
+    from utils.variant_stats import variant_stats
+    from utils.cost_model import cost_model, admission
+    from utils.scheduler import scheduler, RESOURCE_GPU, RESOURCE_LLM, PRIORITIES, PRIORITY_INTERACTIVE, PRIORITY_BULK
+    from schemas.process_schema import ProcessResponse
+    from schemas.task_schema import TaskSpec, InputBinding, WorkflowVariant
+    from utils.logger import logger
+    from utils.setting import settings
+    from services.base_service import ComfyuiTaskProcessor
+except ModuleNotFoundError as e:
+    print(f"Import error: {e}")
+    print("Please ensure this file is run from the project root directory")
+    sys.exit(1)
+
+
+# Process modes: full quality, drafts at a reduced size and steps, full renders of chosen draft images
+MODE_FULL = "full"
+MODE_DRAFT = "draft"
+MODE_FINALIZE = "finalize"
+MODES = (MODE_FULL, MODE_DRAFT, MODE_FINALIZE)
+
+# Flux prompts kept per semantic cache entry, later requests close to it reuse them before new ones are generated
+CACHED_PROMPTS_PER_ENTRY = 32
+
+# ComfyUI input subfolder of the preprocessed input images, named by content hash
+PREPROCESS_SUBFOLDER = "preprocessed"
+
+# Variant of a task type without variants in the registry: the workflow as it is
+VARIANT_DEFAULT = "default"
+
+
+def _preprocess_digest(content_digest: str, signature: str) -> str:
+    """Hash of an input image (its sha256) and the preprocess workflow it goes through"""
+    return hashlib.sha256(f"{signature}\n{content_digest}".encode()).hexdigest()[:40]
+
+
+class WorkflowTaskProcessor(ComfyuiTaskProcessor):
+    """
+    Runs one task type of the registry: prompt -> placement -> render -> save.
+    The workflow, its parameter bindings and output nodes come from the TaskSpec, the ComfyUI connection,
+    LLM clients and output store come from the TaskEngine and are shared by every task type.
+    """
+    def __init__(self, spec: TaskSpec, engine):
+        super().__init__(spec.task_type, engine.model_client, engine.model_name, job_store=engine.job_store, engine=engine)
+        self.spec = spec
+        self.output_size_width = spec.width or settings.IMAGE2POSTER_OUTPUT_SIZE_WIDTH
+        self.output_size_height = spec.height or settings.IMAGE2POSTER_OUTPUT_SIZE_HEIGHT
+        self.scale_min = spec.scale_min if spec.scale_min is not None else settings.IMAGE2POSTER_SCALE_MIN
+        self.scale_max = spec.scale_max if spec.scale_max is not None else settings.IMAGE2POSTER_SCALE_MAX
+        self.batchsize_use_one_prompt = spec.batchsize_use_one_prompt or settings.IMAGE2POSTER_BATCHSIZE_USE_ONE_PROMPT
+        self.pipeline_queue_size = settings.IMAGE2POSTER_PIPELINE_QUEUE_SIZE
+        self.prompt_batch_groups = settings.IMAGE2POSTER_PROMPT_BATCH_GROUPS
+        self.recovery_poll_seconds = settings.JOB_RECOVERY_POLL_SECONDS
+        # Content-addressed output store, derivatives are built while the next images render
+        self.output_store = engine.output_store
+        self.derive_workers = settings.OUTPUT_STORE_WORKERS
+
+
+        # Identical process calls and placement requests in flight are coalesced
+        self.process_flight = get_singleflight("process", enabled=settings.SINGLEFLIGHT_ENABLED)
+        self.llm_flight = get_singleflight("llm", enabled=settings.SINGLEFLIGHT_ENABLED)
+        self.last_pipeline_stats = None     # Stage occupancy of the last finished process call
+        self.stage_latency = {}             # Stage name -> LatencyHistogram of every process call, e.g. for tools/loadgen.py
+
+        # Flux prompts and placements of earlier requests, reused by input prompts close in meaning
+        self.prompt_cache = SemanticCache(self.task_type) if settings.SEMANTIC_CACHE_ENABLED else None
+
+        # Prompt engineering
+        self.system_prompt = self.load_system_prompt(spec.prompt_templates, spec.prompt_key)
+        # Image generation coordinates 
+        image2position_prompt = self.load_template_prompt(spec.prompt_templates, spec.placement_key)
+        self.image2position_system_prompt = image2position_prompt['system_prompt']  # System prompt
+        self.image2position_user_template_prompt = image2position_prompt['user_prompt_template']    # User case
+
+        # Position generator, the LLM one and the local one computing the placement from the product image
+        self.position_generator = engine.position_generator
+        self.local_placement = LocalPlacementEstimator(scale_min=self.scale_min, scale_max=self.scale_max)
+        self.placement_mode = spec.placement_mode or settings.IMAGE2POSTER_PLACEMENT_MODE
+        if self.placement_mode not in PLACEMENT_MODES:
+            raise ValueError(f"placement mode must be one of {PLACEMENT_MODES}, got {self.placement_mode}")
+        self.placement_timeout = settings.IMAGE2POSTER_PLACEMENT_TIMEOUT
+
+        # Draft mode renders at a share of the size and steps, finalize calls render chosen drafts at full quality
+        self.draft_store = engine.draft_store
+        self.draft_scale = settings.IMAGE2POSTER_DRAFT_SCALE
+        self.draft_steps_ratio = settings.IMAGE2POSTER_DRAFT_STEPS_RATIO
+        self.draft_min_steps = settings.IMAGE2POSTER_DRAFT_MIN_STEPS
+        self.draft_steps = spec.draft_steps
+
+        # Workflow with its outputs changed to 'SaveImageWebsocket', shared by the task types using the same file. Never modified, every image gets a copy
+        self.workflow_data = engine.load_workflow(spec.workflow)
+
+        # Task parameter -> workflow inputs it is written to
+        self.input_bindings = spec.bindings
+        # Nodes only depending on the input image (the product cutout) run once per image in their own workflow, their
+        # output is uploaded under its content hash and every variant loads it instead of running them again
+        self.preprocess_workflow = None
+        if spec.preprocess_node and settings.IMAGE2POSTER_PREPROCESS_CACHE:
+            self.preprocess_workflow, self.workflow_data, cached_input = split_workflow(self.workflow_data, spec.preprocess_node)
+            ComfyuiTaskProcessor.change_workflow_output_to_websocket(self.preprocess_workflow)
+            self.preprocess_output = preprocess_output_id(spec.preprocess_node)
+            self.preprocess_bindings = bindings_in(spec.bindings, self.preprocess_workflow)
+            self.preprocess_signature = json.dumps(self.preprocess_workflow, sort_keys=True)
+            self.input_bindings = dict(bindings_in(spec.bindings, self.workflow_data), input_image=[InputBinding(node=cached_input, input='image')])
+            self.preprocess_input = cached_input
+            self.preprocess_flight = get_singleflight("preprocess", enabled=settings.SINGLEFLIGHT_ENABLED)
+            self._preprocessed = {}     # Preprocessed image -> time it was last known to be on ComfyUI
+        # Workflow versions tried on live traffic, a request is assigned one by a stable hash (see _assign_variant).
+        # Variants with overrides have their own cost key, so the cost model and admission learn their node times apart
+        weights = settings.VARIANT_WEIGHTS.get(self.task_type, {})
+        unknown = sorted(set(weights) - set(spec.variants))
+        if unknown:
+            logger.warning(f"tasktype-{self.task_type} VARIANT_WEIGHTS names unknown variants {unknown}")
+        self.record_variant = bool(spec.variants)      # Results name their variant when the task type has variants
+        self.variants = {}
+        for variant_id, variant in (spec.variants or {VARIANT_DEFAULT: WorkflowVariant(weight=1)}).items():
+            workflow_data = apply_overrides(self.workflow_data, variant.overrides) if variant.overrides else self.workflow_data
+            self.variants[variant_id] = {
+                'weight': float(weights.get(variant_id, variant.weight)),
+                'workflow': workflow_data,
+                'input_bindings': bindings_in(self.input_bindings, workflow_data),
+                'draft_steps': [binding for binding in self.draft_steps if binding.node in workflow_data],
+                'cost_key': f"{self.task_type}@{variant_id}" if variant.overrides else self.task_type,
+            }
+        if not any(variant['weight'] > 0 for variant in self.variants.values()):
+            raise ValueError(f"task {self.task_type} has no variant with a weight above 0")
+        # Drafts written before a task type had variants were rendered by the workflow as it is
+        self.default_variant = next((variant_id for variant_id, variant in spec.variants.items() if not variant.overrides), next(iter(self.variants)))
+        # Output intermediate results
+        self.output_node_ids_show_middle_result = spec.middle_outputs or spec.outputs
+        # Output final result
+        self.output_node_ids = spec.outputs
+
+    def _set_workflow_params(self, workflow_data: dict, params: dict, input_bindings: Optional[dict] = None) -> None:
+        """
+        setting workflow parameters
+
+        Args:
+            workflow_data: Workflow data
+            params: Dictionary containing the parameters to be set, parameters without a value are left as they are
+            input_bindings: Bindings of the workflow variant, the bindings of the task type by default
+        """
+        for name, bindings in (input_bindings or self.input_bindings).items():
+            if name not in params:
+                continue
+            for binding in bindings:
+                workflow_data[binding.node]['inputs'][binding.input] = params[name]
+
+    def _render_size(self, variant: str, draft: bool, width: int, height: int) -> dict:
+        """Size the images of a call are rendered at, drafts are scaled down to a multiple of 16 pixels"""
+        cost_key = self.variants[variant]['cost_key']
+        if not draft:
+            return {'variant': variant, 'draft': False, 'render_width': width, 'render_height': height, 'cost_key': cost_key}
+        return {'variant': variant, 'draft': True,
+                'render_width': max(256, int(width * self.draft_scale) // 16 * 16),
+                'render_height': max(256, int(height * self.draft_scale) // 16 * 16),
+                'cost_key': f"{cost_key}:draft"}     # Fewer steps, the cost model keeps draft node times apart
+
+    def _assign_variant(self, task_id: str, data: Dict[str, Any]) -> str:
+        """
+        Workflow variant of a call: data['variant'] when given, otherwise picked by weight with a hash of
+        data['variant_key'] (the task_id by default), so a job retried by another worker keeps its variant
+        and callers passing e.g. a user ID as variant_key keep one variant per user
+        """
+        if "variant" in data:
+            variant = str(data["variant"])
+            if variant not in self.variants:
+                raise ValueError(f"variant must be one of {list(self.variants)}")
+            return variant
+        key = str(data.get("variant_key", task_id))
+        weighted = [(variant_id, variant['weight']) for variant_id, variant in self.variants.items() if variant['weight'] > 0]
+        point = int.from_bytes(hashlib.sha256(f"{self.task_type}:{key}".encode()).digest()[:8], 'big') / 2 ** 64 * sum(weight for _, weight in weighted)
+        for variant_id, weight in weighted:
+            point -= weight
+            if point < 0:
+                return variant_id
+        return weighted[-1][0]
+
+    @staticmethod
+    def _stats_variant(job: dict) -> str:
+        """Name the statistics of a call are counted under, drafts apart from full renders"""
+        return f"{job['variant']}:draft" if job['draft'] else job['variant']
+
+    def _compile_workflow(self, job: dict, params: dict) -> dict:
+        """
+        Workflow of one image. Drafts keep the prompt, seed and placement of the full render, only the canvas,
+        the product scale (relative to the product image pixels) and the sampler steps are reduced.
+        """
+        variant = self.variants[job['variant']]
+        workflow_data = copy.deepcopy(variant['workflow'])
+        if job['draft']:
+            render = self._render_size(job['variant'], True, params['width'], params['height'])
+            factor = render['render_width'] / params['width']
+            # The placement was clamped to the scale range at full size, the draft scale follows the smaller canvas on purpose
+            params = dict(params, width=render['render_width'], height=render['render_height'], scale=round(params['scale'] * factor, 3))
+            for binding in variant['draft_steps']:
+                inputs = workflow_data[binding.node]['inputs']
+                inputs[binding.input] = min(inputs[binding.input], max(self.draft_min_steps, round(inputs[binding.input] * self.draft_steps_ratio)))
+        self._set_workflow_params(workflow_data, params, variant['input_bindings'])
+        return workflow_data
+
+    @staticmethod
+    def _mean_render(renders: list) -> dict:
+        """One render size pricing several formats together: node times are linear in the pixel count, so the square of the mean pixel count"""
+        side = int(math.sqrt(sum(render['render_width'] * render['render_height'] for render in renders) / len(renders)))
+        return dict(renders[0], render_width=side, render_height=side)
+
+    async def _prompt_cache_entry(self, task_id: str, input_prompt: str) -> Optional[dict]:
+        """Cached flux prompts and placements of an input prompt close to this one, a new empty entry when there is none"""
+        if self.prompt_cache is None:
+            return None
+        match = await asyncio.to_thread(self.prompt_cache.get, input_prompt)
+        if match is None:
+            return await asyncio.to_thread(self.prompt_cache.put, input_prompt, {'flux_prompts': [], 'placements': {}})
+        logger.info(f"tasktype-{self.task_type} task_id:{task_id} prompt cache hit, similarity {match[1]:.3f}")
+        return match[0]
+
+    @staticmethod
+    def _take_cached_prompts(job: dict, count: int) -> list:
+        """Up to count cached flux prompts this call did not use yet"""
+        entry = job['prompt_cache']
+        if entry is None:
+            return []
+        prompts = [prompt for prompt in entry['flux_prompts'] if prompt not in job['used_prompts']][:count]
+        job['used_prompts'].update(prompts)
+        return prompts
+
+    @staticmethod
+    def _cache_prompts(job: dict, prompts: list) -> None:
+        entry = job['prompt_cache']
+        if entry is None:
+            return
+        for prompt in prompts:
+            if prompt and prompt != GeneratePrompt.CONTENT_REVIEW_MESSAGE and prompt not in entry['flux_prompts'] \
+                    and len(entry['flux_prompts']) < CACHED_PROMPTS_PER_ENTRY:
+                entry['flux_prompts'].append(prompt)
+                job['used_prompts'].add(prompt)
+
+    async def _stage_prompt(self, groups: list) -> list:
+        """Pipeline stage: generate the prompts of a chunk of groups with one batched LLM request, cached prompts are used first"""
+        job = groups[0]['job']
+        input_prompt = job['input_prompt']
+        if job['prompt_optimizer']:
+            flux_prompts = self._take_cached_prompts(job, len(groups))
+            if len(flux_prompts) < len(groups):
+                async with scheduler.slot(RESOURCE_LLM, job['tenant'], job['priority']):
+                    generated = await self.prompt_generator.generate_prompts(self.system_prompt, input_prompt, count=len(groups) - len(flux_prompts))
+                self._cache_prompts(job, generated)
+                flux_prompts += generated
+        else:
+            flux_prompts = [input_prompt] * len(groups)
+        for group, flux_prompt in zip(groups, flux_prompts):
+            if flux_prompt and ("内容不符合内容审查的规范" in flux_prompt or flux_prompt == GeneratePrompt.CONTENT_REVIEW_MESSAGE):
+                raise StageError(flux_prompt, f"The content does not conform to the content review standard, input_prompt: {input_prompt}")
+            if not flux_prompt:
+                raise StageError("flux_prompt is None")
+            logger.info(f"tasktype-{self.task_type} flux_prompt: {flux_prompt}")
+            group['flux_prompt'] = flux_prompt
+        return groups
+
+    async def _place_locally(self, job: dict, flux_prompt: str) -> dict:
+        return await asyncio.to_thread(self.local_placement.estimate, job['image'], flux_prompt, job['width'], job['height'])
+
+    async def _generate_position(self, group: dict) -> dict:
+        """Product position and scale of one group, from the LLM, the local estimator or the LLM with a local fallback"""
+        job = group['job']
+        if self.placement_mode == 'local':
+            return await self._place_locally(job, group['flux_prompt'])
+        # LLM placements of cached flux prompts are cached with them
+        placements = job['prompt_cache']['placements'] if job.get('prompt_cache') is not None else {}
+        if group['flux_prompt'] in placements:
+            return dict(placements[group['flux_prompt']])
+
+        async def generate_position():
+            async with scheduler.slot(RESOURCE_LLM, job['tenant'], job['priority']):
+                return await asyncio.to_thread(
+                    self.position_generator.generator_position,
+                    image_url=None, system_prompt=self.image2position_system_prompt,
+                    user_prompt=group['flux_prompt'], user_template_prompt=self.image2position_user_template_prompt,
+                    scale_min=self.scale_min, scale_max=self.scale_max)
+        key = make_key("generator_position", self.model_name, group['flux_prompt'], self.scale_min, self.scale_max)
+        if self.placement_mode == 'llm':
+            position_dict = await self.llm_flight.do(key, generate_position)
+            placements[group['flux_prompt']] = {name: position_dict[name] for name in ('x_percent', 'y_percent', 'scale')}
+            return position_dict
+
+        try:
+            # The shared LLM call keeps running after a timeout, other groups with the same prompt still get it
+            position_dict = await asyncio.wait_for(self.llm_flight.do(key, generate_position), timeout=self.placement_timeout)
+            placements[group['flux_prompt']] = {name: position_dict[name] for name in ('x_percent', 'y_percent', 'scale')}
+            return dict(placements[group['flux_prompt']])
+        except Exception as e:
+            reason = f"took longer than {self.placement_timeout}s" if isinstance(e, asyncio.TimeoutError) else f"failed: {e!r}"
+            logger.warning(f"tasktype-{self.task_type} task_id:{job['task_id']} LLM placement {reason}, placed locally")
+            return await self._place_locally(job, group['flux_prompt'])
+
+    async def _stage_placement(self, group: dict) -> list:
+        """
+        Pipeline stage: get the product position of one group and fan out to one item per image and format.
+        The position is generated for the first format and moved to the others, so every format costs no extra LLM call.
+        """
+        job = group['job']
+        try:
+            position_dict = await self._generate_position(group)
+            positions = [{name: position_dict[name] for name in ('x_percent', 'y_percent', 'scale')}]
+            for width, height in job['sizes'][1:]:
+                positions.append(await asyncio.to_thread(self.local_placement.adapt, positions[0], job['image'],
+                                                         job['width'], job['height'], width, height))
+        except Exception as e:
+            raise StageError("process run failed. ", f"error when get position info. ERROR INFO:{e}")
+
+        items = []
+        for size_index, ((width, height), position) in enumerate(zip(job['sizes'], positions)):
+            for one_task_index in group['indices']:
+                index = size_index * job['batchsize'] + one_task_index     # Images of one format have consecutive indices
+                if index in job['recorded']:
+                    continue
+                params = {
+                    'input_image': job['input_image'],
+                    'flux_prompt': group['flux_prompt'],
+                    'seed': job['seed'],
+                    'x_percent': position['x_percent'],
+                    'y_percent': position['y_percent'],
+                    'scale': position['scale'],
+                    'width': width,
+                    'height': height
+                }
+                items.append({'job': job, 'index': index, 'params': params})
+                job['params'][index] = params
+        return items
+
+    async def _stage_submit(self, item: dict) -> list:
+        """Pipeline stage: compile the workflow of one image and queue it on ComfyUI once the scheduler grants a GPU slot"""
+        job = item['job']
+        workflow_data = self._compile_workflow(job, item['params'])
+        await self._check_workflow(workflow_data, job['task_id'])
+        # The slot is held until the images are collected, so it bounds the prompts this tenant has on ComfyUI
+        ticket = await scheduler.acquire(RESOURCE_GPU, job['tenant'], job['priority'], expected_seconds=job['expected_seconds'])
+        job['tickets'].append(ticket)
+        item['gpu_ticket'] = ticket
+        status, message, prompt_id = await asyncio.to_thread(self.websocket_api.submit_task_to_comfyui, workflow_data)
+        if not status:
+            scheduler.release(ticket)
+            self._check_preprocessed(job, message)
+            raise StageError("process run failed. ", f"cannot get result from websocket_api, ERROR INFO:{message}")
+        logger.info(f"tasktype-{self.task_type} task_id:{job['task_id']} get prompt_id: {prompt_id}")
+        item['prompt_id'] = prompt_id
+        render = self._render_size(job['variant'], job['draft'], item['params']['width'], item['params']['height'])
+        cost_model.expect(prompt_id, job['cost_key'], render['render_width'] * render['render_height'] / 1e6)
+        variant_stats.expect(prompt_id, self.task_type, self._stats_variant(job))
+        if self.job_store is not None:
+            await asyncio.to_thread(self.job_store.record_item_submitted, job['task_id'], item['index'], prompt_id, item['params'])
+        return [item]
+
+    async def _check_workflow(self, workflow_data: dict, task_id: str) -> None:
+        """Reject a workflow ComfyUI would not accept, without queueing it"""
+        try:
+            await self.validate_workflow(workflow_data)
+        except WorkflowValidationError as e:
+            raise StageError(f"Invalid input parameters, error_info: {e}", f"workflow validation failed, ERROR INFO:{e}")
+        except Exception as e:
+            # Node schemas are not available, ComfyUI validates the prompt itself
+            logger.warning(f"tasktype-{self.task_type} task_id:{task_id} workflow not validated locally: {e}")
+
+    async def _stage_collect(self, item: dict) -> list:
+        """Pipeline stage: wait for the rendered images of one prompt"""
+        try:
+            item['image_data'] = await asyncio.to_thread(
+                self.websocket_api.wait_for_images, item['prompt_id'], item['job']['output_node_ids'].keys())
+        except Exception as e:
+            cost_model.forget(item['prompt_id'])
+            variant_stats.forget(item['prompt_id'])
+            self._check_preprocessed(item['job'], e)
+            raise StageError("process run failed. ", f"cannot get result from websocket_api, ERROR INFO:{e}")
+        finally:
+            scheduler.release(item.pop('gpu_ticket'))
+            job = item['job']
+            job['expected_seconds'] = max(job['expected_seconds'] - job['image_seconds'], 0.0)
+            admission.progress(job['task_id'])
+        return [item]
+
+    @staticmethod
+    def _image_label(job: dict, index: int) -> str:
+        """Image number in the file names, with the format ({width}x{height}_{n}) when the call renders several"""
+        sizes = job.get('sizes', ())
+        if len(sizes) <= 1:
+            return str(index + 1)
+        width, height = sizes[index // job['batchsize']]
+        return f"{width}x{height}_{index % job['batchsize'] + 1}"
+
+    def _save_images(self, image_data: dict, output_node_ids: dict, task_id: str, image_label: str, output_path: str) -> tuple:
+        """
+        Write the images of one prompt to {output_path}/{task_id}-{result_name}_{image_label}.png
+        Returns:
+            tuple: result dict (result name -> path) and the stored objects that get derivatives (result name -> (digest, path))
+        """
+        one_result_dict = {}
+        stored_objects = {}
+        for key in image_data:
+            result_name = output_node_ids[key]
+            image = image_data[key][0]  # Image data
+            image_name = f"{task_id}-{result_name}_{image_label}.png"
+            save_path = f'{output_path}/{image_name}'
+            if self.output_store is not None:
+                # The websocket delivers PNG bytes, store them once by content hash and link the task path to it
+                digest, object_path = self.output_store.put(image)
+                self.output_store.link(object_path, save_path)
+                one_result_dict.setdefault('renditions', {})[result_name] = {'original': object_path}
+                if self.output_store.wants_derivatives(result_name):
+                    stored_objects[result_name] = (digest, object_path)
+            else:
+                image = Image.open(io.BytesIO(image))
+                image.save(f"{save_path}")
+            one_result_dict[result_name] = save_path
+        return one_result_dict, stored_objects
+
+    async def _stage_save(self, item: dict) -> list:
+        """Pipeline stage: write the images of one prompt to disk and queue their derivatives"""
+        job = item['job']
+        item['result'], stored_objects = await asyncio.to_thread(
+            self._save_images, item.pop('image_data'), job['output_node_ids'],
+            job['task_id'], self._image_label(job, item['index']), job['output_path'])
+        item['derivatives'] = {result_name: self.output_store.submit_derivatives(digest, object_path)
+                               for result_name, (digest, object_path) in stored_objects.items()}
+        return [item]
+
+    async def _stage_derive(self, item: dict) -> list:
+        """Pipeline stage: wait for the derivatives built by the output store process pool"""
+        job = item['job']
+        one_result_dict = item['result']
+        for result_name, futures in item.pop('derivatives').items():
+            for name, future in futures.items():
+                try:
+                    one_result_dict['renditions'][result_name][name] = await asyncio.wrap_future(future)
+                except Exception as e:
+                    logger.error(f"tasktype-{self.task_type} task_id:{job['task_id']} cannot build rendition {name} of {result_name}, ERROR INFO:{e}")
+        if job['draft']:
+            one_result_dict['draft_id'] = job['task_id']
+        if self.record_variant:
+            one_result_dict['variant'] = job['variant']
+        if self.job_store is not None:
+            await asyncio.to_thread(self.job_store.record_item_done, job['task_id'], item['index'], one_result_dict)
+        return [(item['index'], one_result_dict)]
+
+    async def _finish_item(self, item: dict) -> tuple:
+        """Run the save and derive stages for one item outside the pipeline"""
+        item = (await self._stage_save(item))[0]
+        return (await self._stage_derive(item))[0]
+
+    async def _resume_item(self, job: dict, index: int, record: dict) -> tuple:
+        """
+        Finish an item a previous worker already queued on ComfyUI.
+        Finished prompts are re-attached through /history, prompts that did not start yet are moved to this
+        client_id, only prompts whose images are lost are rendered again.
+        """
+        prompt_id = record['prompt_id']
+        output_node_ids = job['output_node_ids']
+        item = {'job': job, 'index': index, 'params': record['params']}
+        while True:
+            image_data = await asyncio.to_thread(self.websocket_api.get_history_outputs, prompt_id, output_node_ids.keys())
+            if image_data is not None:
+                break
+            state = await asyncio.to_thread(self.websocket_api.get_prompt_queue_state, prompt_id)
+            if state == 'pending':
+                # Not started yet, its websocket messages would go to the dead client_id
+                await asyncio.to_thread(self.websocket_api.delete_queued_prompt, prompt_id)
+                break
+            if state is None:
+                # Neither queued nor in the history (ComfyUI restarted), check the history once more for a race
+                image_data = await asyncio.to_thread(self.websocket_api.get_history_outputs, prompt_id, output_node_ids.keys())
+                break
+            await asyncio.sleep(self.recovery_poll_seconds)
+
+        if image_data and set(image_data) >= set(output_node_ids):
+            logger.info(f"tasktype-{self.task_type} task_id:{job['task_id']} re-attached prompt_id: {prompt_id}")
+            item['image_data'] = image_data
+            return await self._finish_item(item)
+
+        logger.info(f"tasktype-{self.task_type} task_id:{job['task_id']} images of prompt_id {prompt_id} are lost, render again")
+        item = (await self._stage_submit(item))[0]
+        item = (await self._stage_collect(item))[0]
+        return await self._finish_item(item)
+
+    def _build_pipeline(self, task_id: str, render_only: bool = False) -> Pipeline:
+        """All stages, or from submit on for items whose prompt and placement are known (finalize calls)"""
+        stages = [
+            PipelineStage("prompt", self._stage_prompt),
+            PipelineStage("placement", self._stage_placement),
+            PipelineStage("submit", self._stage_submit),
+            PipelineStage("collect", self._stage_collect),
+            PipelineStage("save", self._stage_save, workers=2),
+            PipelineStage("derive", self._stage_derive, workers=self.derive_workers),
+        ]
+        return Pipeline(name=f"{self.task_type}-{task_id}", queue_size=self.pipeline_queue_size, stages=stages[2:] if render_only else stages)
+
+    async def process(self, task_id: str, data: Dict[str, Any]) -> ProcessResponse:
+        """
+        Run one request. Identical requests in flight (same task type and data) share one run,
+        every caller gets its own copy of the result. Items in a job store and drafts are recorded under
+        the task_id of the run, so those calls are only shared with calls of the same task_id.
+        """
+        ensure_loop_lag_monitor()
+        profiler = maybe_profile_call()
+        try:
+            job_id = task_id if self.job_store is not None or data.get("mode") == MODE_DRAFT else None
+            key = make_key(self.task_type, job_id, ImageSource.request_key_data(data))
+            result = await self.process_flight.do(key, lambda: self._process(task_id, data))
+        finally:
+            if profiler is not None:
+                await asyncio.to_thread(profiler.stop, f"{self.task_type}-{task_id}")
+        logger.debug(f"tasktype-{self.task_type} singleflight stats: {singleflight_stats()}")
+        return result
+
+    async def _admit(self, task_id: str, priority: str, cost_key: str, width: int, height: int, images: int) -> dict:
+        """Admission decision of a call, counting the prompts other clients have on ComfyUI when an SLO is set"""
+        external_seconds = 0.0
+        if admission.enabled:
+            try:
+                queue = await asyncio.to_thread(self.websocket_api.get_queue_status)
+                ours = self.websocket_api.open_prompts
+                foreign = [entry for entry in queue.get('queue_running', []) + queue.get('queue_pending', []) if entry[1] not in ours]
+                external_seconds = len(foreign) * cost_model.predict_image(self.task_type, self.output_size_width, self.output_size_height)
+            except Exception as e:
+                logger.warning(f"tasktype-{self.task_type} task_id:{task_id} cannot read the ComfyUI queue: {e}")
+        return await admission.admit(task_id, priority, cost_key, width, height, images, external_seconds)
+
+    async def _admit_call(self, task_id: str, priority: str, render: dict, images: int) -> tuple:
+        """
+        Expected GPU time from the measured node times
+        Returns:
+            tuple: (expected queue_seconds and eta_seconds of the call for its response, rejection response or None)
+        """
+        decision = await self._admit(task_id, priority, render['cost_key'], render['render_width'], render['render_height'], images)
+        estimate = {'queue_seconds': round(decision['queue_seconds'], 1), 'eta_seconds': round(decision['eta_seconds'], 1)}
+        if not decision['admitted']:
+            logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: rejected, expected queue time "
+                         f"{decision['queue_seconds']:.1f}s exceeds the {priority} SLO")
+            return estimate, {"status": False, "message": f"Server busy, expected queue time {decision['queue_seconds']:.0f}s, try again later",
+                              "data": None, "admission": estimate}
+        logger.info(f"tasktype-{self.task_type} task_id:{task_id} admitted, expected queue {decision['queue_seconds']:.1f}s, "
+                    f"GPU {decision['cost_seconds']:.1f}s, completion in {decision['eta_seconds']:.1f}s")
+        return estimate, None
+
+    async def _prepare_input_image(self, task_id: str, image: ImageSource, tenant: str, priority: str) -> str:
+        """Image the generation workflow loads: the uploaded input image, or its preprocessed version"""
+        if self.preprocess_workflow is None:
+            return await self.upload_image_source_to_comfyui(image)
+        input_image = None
+        if image.url is not None:
+            # A download is hashed while it streams into the upload, the preprocessed image is looked up after it
+            input_image = await self.upload_image_source_to_comfyui(image)
+        content_digest = await asyncio.to_thread(image.compute_digest)
+        digest = _preprocess_digest(content_digest, self.preprocess_signature)
+        image_name = os.path.join(PREPROCESS_SUBFOLDER, f"{digest}.png")
+        # ComfyUI may have lost the file since (input folder cleaned, another server), it is checked again after the TTL
+        checked_at = self._preprocessed.get(image_name)
+        if checked_at is None or time.monotonic() - checked_at > settings.IMAGE2POSTER_PREPROCESS_TTL:
+            key = make_key(self.comfyui_upload_image_url, digest)
+            await self.preprocess_flight.do(key, lambda: self._preprocess(task_id, image, input_image, digest, tenant, priority))
+            now = time.monotonic()
+            if checked_at is None:
+                self._preprocessed = {name: known_at for name, known_at in self._preprocessed.items()
+                                      if now - known_at <= settings.IMAGE2POSTER_PREPROCESS_TTL}
+            self._preprocessed[image_name] = now
+        return image_name
+
+    def _check_preprocessed(self, job: dict, error: Any) -> None:
+        """A generation prompt failed on the LoadImage of the preprocessed image: it is checked and rendered again by the next call"""
+        if self.preprocess_workflow is not None and f"Node {self.preprocess_input} " in str(error):
+            if self._preprocessed.pop(job['input_image'], None) is not None:
+                logger.warning(f"tasktype-{self.task_type} task_id:{job['task_id']} preprocessed {job['input_image']} failed to load, "
+                               f"it is preprocessed again")
+
+    async def _preprocess(self, task_id: str, image: ImageSource, input_image: Optional[str], digest: str, tenant: str, priority: str) -> None:
+        """Run the preprocess workflow on an input image and upload its output, unless another worker already did"""
+        image_name = f"{digest}.png"
+        if await asyncio.to_thread(self.websocket_api.input_exists, image_name, PREPROCESS_SUBFOLDER):
+            logger.info(f"tasktype-{self.task_type} task_id:{task_id} reuse preprocessed {image_name}")
+            return
+        if input_image is None:
+            input_image = await self.upload_image_source_to_comfyui(image)
+        workflow_data = copy.deepcopy(self.preprocess_workflow)
+        for binding in self.preprocess_bindings['input_image']:
+            workflow_data[binding.node]['inputs'][binding.input] = input_image
+        async with scheduler.slot(RESOURCE_GPU, tenant, priority):
+            status, message, prompt_id = await asyncio.to_thread(self.websocket_api.submit_task_to_comfyui, workflow_data)
+            if not status:
+                raise Exception(f"cannot queue the preprocess workflow, ERROR INFO:{message}")
+            image_data = await asyncio.to_thread(self.websocket_api.wait_for_images, prompt_id, [self.preprocess_output])
+        await self.upload_image_bytes_to_comfyui(image_data[self.preprocess_output][0], image_name, PREPROCESS_SUBFOLDER)
+        logger.info(f"tasktype-{self.task_type} task_id:{task_id} preprocessed {image.label} as {image_name}, prompt_id: {prompt_id}")
+
+    def _parse_sizes(self, data: Dict[str, Any]) -> list:
+        """Output sizes of a call: data['sizes'] as [{'width': w, 'height': h}, ...] or [[w, h], ...], otherwise width and height"""
+        if "sizes" not in data:
+            return [(int(data.get("width", self.output_size_width)), int(data.get("height", self.output_size_height)))]
+        sizes = []
+        for size in data["sizes"]:
+            width, height = (size["width"], size["height"]) if isinstance(size, dict) else size
+            sizes.append((int(width), int(height)))
+        if not sizes:
+            raise ValueError("sizes is empty")
+        if len(set(sizes)) != len(sizes):
+            raise ValueError(f"sizes has duplicates: {sizes}")
+        return sizes
+
+    async def _process(self, task_id: str, data: Dict[str, Any]) -> ProcessResponse:
+        started_at = time.monotonic()
+        mode = data.get("mode", MODE_FULL)     # full, draft (reduced size and steps) or finalize (full renders of chosen draft images)
+        if mode == MODE_FINALIZE:
+            return await self._finalize(task_id, data)
+        try:
+            if mode not in MODES:
+                raise ValueError(f"mode must be one of {MODES}")
+            # Parameter parsing
+            image = ImageSource.from_request(data)     # data['image'] (bytes, file object, URL or path), data['image_url'] or data['image_path']
+            input_prompt = data["input_prompt"]
+            batchsize = int(data.get("batchsize", 1))   # Determine if it is a batch task by checking if there is a batchsize
+            show_middle_result = bool(data.get("show_middle_result", False))    # Whether to display intermediate results, default is not displayed
+            prompt_optimizer = bool(data.get("prompt_optimizer", True))    # Whether to use prompt optimizer
+            seed = int(data.get("seed", random.randint(1, 886185987922208)))
+            sizes = self._parse_sizes(data)     # Every format shares the upload, the prompts and the placements
+            width, height = sizes[0]
+            images = batchsize * len(sizes)
+            output_path = data.get("output_path", "output")
+            tenant = str(data.get("tenant_id", "default"))     # Scheduler tenant, requests of one tenant share its quota
+            priority = data.get("priority", PRIORITY_INTERACTIVE if images == 1 else PRIORITY_BULK)
+            if priority not in PRIORITIES:
+                raise ValueError(f"priority must be one of {PRIORITIES}")
+            variant = self._assign_variant(task_id, data)
+            if self.placement_mode != 'llm' or len(sizes) > 1:
+                # The local placement and the other formats need the product profile, a URL is analyzed while it is uploaded
+                image.analyzer = profile_product
+
+        except Exception as e:
+            logger.error(f"tasktype-{self.task_type} ERROR INFO: Missing required input parameters, ERROR INFO:{e}")
+            return {"status": False, "message": f"Missing required input parameters, error_info: {e}", "data": None}
+
+        if show_middle_result:  # Specify the node for output results, two modes: one shows intermediate results, one doesn't show intermediate results
+            output_node_ids = self.output_node_ids_show_middle_result
+        else:
+            output_node_ids = self.output_node_ids
+
+        # Reject bad parameters before the upload and the LLM calls, the placement is checked again for every image
+        renders = [self._render_size(variant, mode == MODE_DRAFT, size_width, size_height) for size_width, size_height in sizes]
+        try:
+            for size_width, size_height in sizes:
+                workflow_data = self._compile_workflow({'variant': variant, 'draft': mode == MODE_DRAFT}, {
+                    'flux_prompt': input_prompt,
+                    'seed': seed,
+                    'x_percent': 50,
+                    'y_percent': 50,
+                    'scale': self.scale_min,
+                    'width': size_width,
+                    'height': size_height
+                })
+                await self._check_workflow(workflow_data, task_id)
+        except StageError as e:
+            logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: {e.detail}")
+            return {"status": False, "message": e.message, "data": None}
+
+        # Rejected before any work when the queue is too long
+        render = self._mean_render(renders)
+        estimate, rejection = await self._admit_call(task_id, priority, render, images)
+        if rejection is not None:
+            return rejection
+
+        # Download the image to comfyui, preprocessed once per image when the task type has a preprocess node
+        # Everything up to _run_job, which finishes the admission itself, has to finish it when it fails
+        try:
+            input_image = await self._prepare_input_image(task_id, image, tenant, priority)
+            logger.info(f'input_image: {input_image}')
+        except ImageInputError as e:
+            admission.finish(task_id)
+            logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: bad input image {image.label}, ERROR INFO:{e}")
+            return {"status": False, "message": f"Invalid input image: {e}", "data": None}
+        except Exception as e: 
+            admission.finish(task_id)
+            logger.error(f"tasktype-{self.task_type} ERROR INFO: cannot upload image to comfyui, ERROR INFO:{e}")
+            return {"status": False, "message": "process run failed. ", "data": None}
+        try:
+            prompt_cache = await self._prompt_cache_entry(task_id, input_prompt) if prompt_optimizer else None
+            # Items recorded by an earlier attempt of this job are re-attached or taken as they are
+            records = {}
+            if self.job_store is not None:
+                records = await asyncio.to_thread(self.job_store.get_items, task_id)
+        except Exception as e:
+            admission.finish(task_id)
+            logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: cannot read the prompt cache or the job store, ERROR INFO:{e}")
+            return {"status": False, "message": "process run failed. ", "data": None}
+
+        # Parameters shared by every stage of this call
+        image_seconds = cost_model.predict_image(render['cost_key'], render['render_width'], render['render_height'])
+        job = {
+            'task_id': task_id,
+            'image': image,
+            'input_prompt': input_prompt,
+            'prompt_optimizer': prompt_optimizer,
+            'input_image': input_image,
+            'seed': seed,
+            'width': width,     # First format, the placement is generated for it
+            'height': height,
+            'sizes': sizes,
+            'batchsize': batchsize,
+            'output_node_ids': output_node_ids,
+            'output_path': output_path,
+            'tenant': tenant,
+            'priority': priority,
+            'image_seconds': image_seconds,      # Expected GPU seconds of one image
+            'expected_seconds': image_seconds * images,   # Expected GPU seconds left, orders GPU slots with the sjf policy
+            'params': {},       # Item index -> workflow parameters at full size, kept for finalize calls of drafts
+            'prompt_cache': prompt_cache,
+            'used_prompts': set(),      # Flux prompts of this call, a cached prompt is used once per call
+            'tickets': [],      # GPU slots granted to this call, released on failure
+            'variant': variant,
+            'draft': render['draft'],
+            'cost_key': render['cost_key'],
+            'started_at': started_at,
+            'admission': estimate,      # Queue time and completion estimate at admission, returned with the result
+        }
+        logger.info(f"tasktype-{self.task_type} task_id:{task_id} variant {variant}")
+        job['recorded'] = set(records)
+
+        grouptasks_list = self.group_task(batchsize=batchsize, group_size=self.batchsize_use_one_prompt)
+        # Share the same prompt within the same group, in every format
+        groups = []
+        for group_task in grouptasks_list:
+            group_task = [index for index in group_task
+                          if any(size_index * batchsize + index not in records for size_index in range(len(sizes)))]
+            if group_task:
+                groups.append({'job': job, 'indices': group_task})
+
+        # The prompts of up to prompt_batch_groups groups are generated by one LLM request
+        chunks = [groups[i:i + self.prompt_batch_groups] for i in range(0, len(groups), self.prompt_batch_groups)]
+
+        # prompt -> placement -> submit -> collect -> save -> derive, every stage works on a different group at the same time
+        return await self._run_job(job, self._build_pipeline(task_id), chunks, records)
+
+    async def _finalize(self, task_id: str, data: Dict[str, Any]) -> ProcessResponse:
+        """
+        Render chosen images of a draft at full size and steps. The uploaded image, prompts, seed and placements
+        of the draft are reused, so only the submit -> collect -> save -> derive stages run.
+        """
+        started_at = time.monotonic()
+        try:
+            draft_id = str(data["draft_id"])
+            indices = sorted({int(index) for index in data["indices"]})
+            if not indices:
+                raise ValueError("indices is empty")
+            show_middle_result = bool(data.get("show_middle_result", False))
+            output_path = data.get("output_path", "output")
+            tenant = str(data.get("tenant_id", "default"))
+            priority = data.get("priority", PRIORITY_INTERACTIVE if len(indices) == 1 else PRIORITY_BULK)
+            if priority not in PRIORITIES:
+                raise ValueError(f"priority must be one of {PRIORITIES}")
+            draft = await asyncio.to_thread(self.draft_store.get, draft_id)
+        except Exception as e:
+            logger.error(f"tasktype-{self.task_type} ERROR INFO: Missing required input parameters, ERROR INFO:{e}")
+            return {"status": False, "message": f"Missing required input parameters, error_info: {e}", "data": None}
+
+        if draft is None or draft['task_type'] != self.task_type:
+            logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: draft {draft_id} not found or expired")
+            return {"status": False, "message": f"Draft {draft_id} not found or expired", "data": None}
+        missing = [index for index in indices if str(index) not in draft['items']]
+        if missing:
+            logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: draft {draft_id} has no images {missing}")
+            return {"status": False, "message": f"Draft {draft_id} has no images {missing}", "data": None}
+
+        variant = draft.get('variant', self.default_variant)
+        if variant not in self.variants:
+            logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: variant {variant} of draft {draft_id} is not configured any more")
+            return {"status": False, "message": f"Variant {variant} of draft {draft_id} is not configured any more", "data": None}
+        # Every chosen image is priced at its own format
+        renders = [self._render_size(variant, False, draft['items'][str(index)]['width'], draft['items'][str(index)]['height']) for index in indices]
+        render = self._mean_render(renders)
+        estimate, rejection = await self._admit_call(task_id, priority, render, len(indices))
+        if rejection is not None:
+            return rejection
+
+        image_seconds = cost_model.predict_image(render['cost_key'], render['render_width'], render['render_height'])
+        job = {
+            'task_id': task_id,
+            'draft_id': draft_id,
+            'input_image': draft['input_image'],
+            'width': draft['width'],
+            'height': draft['height'],
+            # Formats of the draft call, the images are labeled and grouped like its images. Drafts stored before
+            # the formats were have one format
+            'sizes': [tuple(size) for size in draft.get('sizes', [(draft['width'], draft['height'])])],
+            'batchsize': draft.get('batchsize', len(draft['items'])),
+            'output_node_ids': self.output_node_ids_show_middle_result if show_middle_result else self.output_node_ids,
+            'output_path': output_path,
+            'tenant': tenant,
+            'priority': priority,
+            'image_seconds': image_seconds,
+            'expected_seconds': image_seconds * len(indices),
+            'params': {},
+            'tickets': [],
+            'variant': variant,
+            'draft': render['draft'],
+            'cost_key': render['cost_key'],
+            'started_at': started_at,
+            'admission': estimate,      # Queue time and completion estimate at admission, returned with the result
+        }
+        records = {}
+        if self.job_store is not None:
+            try:
+                records = await asyncio.to_thread(self.job_store.get_items, task_id)
+            except Exception as e:
+                admission.finish(task_id)
+                logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: cannot read the job store, ERROR INFO:{e}")
+                return {"status": False, "message": "process run failed. ", "data": None}
+        items = [{'job': job, 'index': index, 'params': draft['items'][str(index)]} for index in indices if index not in records]
+        logger.info(f"tasktype-{self.task_type} task_id:{task_id} finalize images {indices} of draft {draft_id}")
+
+        # submit -> collect -> save -> derive
+        return await self._run_job(job, self._build_pipeline(task_id, render_only=True), items, records)
+
+    async def _run_job(self, job: dict, pipeline: Pipeline, inputs: list, records: dict) -> ProcessResponse:
+        """Run the pipeline over its inputs and finish the items an earlier attempt recorded, results ordered by index"""
+        task_id = job['task_id']
+        done_results = [(index, record['outputs']) for index, record in records.items() if record['status'] == ITEM_DONE]
+        resume_items = [(index, record) for index, record in records.items() if record['status'] == ITEM_SUBMITTED]
+        job['params'].update((index, record['params']) for index, record in records.items() if record['params'])
+
+        succeeded = False
+        tasks = [asyncio.ensure_future(pipeline.run(inputs))]
+        tasks.extend(asyncio.ensure_future(self._resume_item(job, index, record)) for index, record in resume_items)
+        try:
+            pipeline_results, *resumed_results = await asyncio.gather(*tasks)
+            results = done_results + pipeline_results + resumed_results
+            if job['draft']:
+                # The full-size parameters of every image, a finalize call renders the chosen ones from them
+                await asyncio.to_thread(self.draft_store.put, task_id, {
+                    'task_type': self.task_type,
+                    'image': job['image'].label,
+                    'variant': job['variant'],
+                    'input_image': job['input_image'],
+                    'width': job['width'],
+                    'height': job['height'],
+                    'sizes': job['sizes'],
+                    'batchsize': job['batchsize'],
+                    'items': {str(index): params for index, params in job['params'].items()},
+                })
+            succeeded = True
+        except StageError as e:
+            logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: {e.detail}")
+            return {# Return error message when program fails
+                    "status": False,
+                    "message": e.message,
+                    "data": None}
+        except Exception as e:
+            logger.error(f"tasktype-{self.task_type} task_id:{task_id} ERROR INFO: {e}")
+            return {"status": False, "message": "process run failed. ", "data": None}
+        finally:
+            for task in tasks:
+                task.cancel()
+            for ticket in job['tickets']:
+                scheduler.release(ticket)
+            admission.finish(task_id)
+            variant_stats.record_call(self.task_type, self._stats_variant(job), time.monotonic() - job['started_at'],
+                                      succeeded, len(results) if succeeded else 0)
+            self.last_pipeline_stats = pipeline.stats()
+            for name, stage_stats in pipeline.stage_stats.items():
+                self.stage_latency.setdefault(name, LatencyHistogram()).merge(stage_stats.latency)
+            logger.info(f"tasktype-{self.task_type} task_id:{task_id} pipeline stats: {self.last_pipeline_stats}")
+
+        results = sorted(results, key=lambda result: result[0])
+        result_list = [one_result_dict for _, one_result_dict in results]
+        sizes = job.get('sizes', ())
+        if len(sizes) > 1:
+            # Results grouped by format, in the order of data['sizes']. A finalize call has the formats of its chosen images
+            formats = [{'width': width, 'height': height, 'results': []} for width, height in sizes]
+            for index, one_result_dict in results:
+                formats[index // job['batchsize']]['results'].append(one_result_dict)
+            result_list = [one_format for one_format in formats if one_format['results']]
+        logger.info(f"tasktype-{self.task_type} task_id:{task_id} task done.")
+        return {    # Return normal when program runs successfully
+                "status": True,
+                "message": "success",
+                "data": result_list,
+                "admission": job['admission']}
@@ -0,0 +1,12 @@
+import os
+import sys
+from pathlib import Path
+
+from dotenv import dotenv_values
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Settings are read when utils.setting is first imported, the example configuration fills what the environment does not set
+for key, value in dotenv_values(ROOT / ".env.example").items():
+    os.environ.setdefault(key, value or "")
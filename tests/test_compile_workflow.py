@@ -0,0 +1,108 @@
+import copy
+from pathlib import Path
+
+import pytest
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="module")
+def processor():
+    from services.task_engine import TaskEngine
+    engine = TaskEngine(model_client=None, model_name="test", registry_path=str(ROOT / "templates" / "task_registry.yml"))
+    yield engine.processor("image2poster")
+    engine.websocket_api.close()
+
+
+@pytest.fixture
+def draft_settings(processor, monkeypatch):
+    monkeypatch.setattr(processor, "draft_scale", 0.5)
+    monkeypatch.setattr(processor, "draft_steps_ratio", 0.4)
+    monkeypatch.setattr(processor, "draft_min_steps", 4)
+    return processor
+
+
+PARAMS = {'flux_prompt': "a perfume bottle on a marble table", 'seed': 7, 'x_percent': 50, 'y_percent': 60,
+          'scale': 0.6, 'width': 1080, 'height': 1920}
+
+
+def _value(workflow: dict, binding) -> object:
+    return workflow[binding.node]['inputs'][binding.input]
+
+
+def _steps(processor, variant: str) -> dict:
+    workflow = processor.variants[variant]['workflow']
+    return {binding.node: _value(workflow, binding) for binding in processor.variants[variant]['draft_steps']}
+
+
+def test_full_render_writes_every_binding(processor):
+    variant = processor.variants["baseline"]
+    template = copy.deepcopy(variant['workflow'])
+    workflow = processor._compile_workflow({'variant': "baseline", 'draft': False}, PARAMS)
+    for name, bindings in variant['input_bindings'].items():
+        for binding in bindings:
+            expected = PARAMS.get(name, _value(variant['workflow'], binding))
+            assert _value(workflow, binding) == expected
+    assert {binding.node: _value(workflow, binding) for binding in variant['draft_steps']} == _steps(processor, "baseline")
+    # The variant workflow is a template, compiling leaves it as it is
+    assert variant['workflow'] == template
+
+
+def test_draft_reduces_canvas_scale_and_steps(draft_settings):
+    processor = draft_settings
+    variant = processor.variants["baseline"]
+    workflow = processor._compile_workflow({'variant': "baseline", 'draft': True}, PARAMS)
+    bindings = variant['input_bindings']
+    # 1080 x 1920 at half size, down to a multiple of 16
+    assert _value(workflow, bindings['width'][0]) == 528
+    assert _value(workflow, bindings['height'][0]) == 960
+    # The product keeps its share of the canvas
+    assert _value(workflow, bindings['scale'][0]) == round(0.6 * 528 / 1080, 3)
+    # Prompt, seed and placement are those of the full render
+    assert _value(workflow, bindings['seed'][0]) == 7
+    assert _value(workflow, bindings['flux_prompt'][0]) == PARAMS['flux_prompt']
+    assert _value(workflow, bindings['x_percent'][0]) == 50
+    full_steps = _steps(processor, "baseline")
+    for binding in variant['draft_steps']:
+        assert _value(workflow, binding) == max(4, round(full_steps[binding.node] * 0.4))
+    assert _steps(processor, "baseline") == full_steps
+
+
+def test_draft_canvas_and_steps_have_a_floor(draft_settings, monkeypatch):
+    processor = draft_settings
+    monkeypatch.setattr(processor, "draft_steps_ratio", 0.01)
+    variant = processor.variants["baseline"]
+    workflow = processor._compile_workflow({'variant': "baseline", 'draft': True}, dict(PARAMS, width=400, height=300, scale=0.5))
+    bindings = variant['input_bindings']
+    assert (_value(workflow, bindings['width'][0]), _value(workflow, bindings['height'][0])) == (256, 256)
+    assert _value(workflow, bindings['scale'][0]) == round(0.5 * 256 / 400, 3)
+    for binding in variant['draft_steps']:
+        assert _value(workflow, binding) == 4
+
+
+def test_draft_never_raises_the_steps(draft_settings, monkeypatch):
+    processor = draft_settings
+    monkeypatch.setattr(processor, "draft_min_steps", 1000)
+    workflow = processor._compile_workflow({'variant': "baseline", 'draft': True}, PARAMS)
+    for binding in processor.variants["baseline"]['draft_steps']:
+        assert _value(workflow, binding) == _steps(processor, "baseline")[binding.node]
+
+
+def test_variants_compile_their_own_workflow(processor):
+    fast = processor._compile_workflow({'variant': "fast_steps", 'draft': False}, PARAMS)
+    assert {binding.node: _value(fast, binding) for binding in processor.variants["fast_steps"]['draft_steps']} == {"478": 12, "139": 24}
+    no_relight = processor._compile_workflow({'variant': "no_relight", 'draft': False}, PARAMS)
+    assert len(no_relight) < len(processor.variants["baseline"]['workflow'])
+    assert no_relight["336"]['inputs']['image1'] == no_relight["336"]['inputs']['image2']
+    # Parameters bound only to dropped nodes are not written
+    for name, bindings in processor.variants["no_relight"]['input_bindings'].items():
+        assert all(binding.node in no_relight for binding in bindings)
+
+
+def test_draft_of_a_variant_skips_the_steps_of_dropped_nodes(draft_settings):
+    processor = draft_settings
+    assert "139" not in processor.variants["no_relight"]['workflow']
+    workflow = processor._compile_workflow({'variant': "no_relight", 'draft': True}, PARAMS)
+    assert [binding.node for binding in processor.variants["no_relight"]['draft_steps']] == ["478"]
+    assert workflow["478"]['inputs']['steps'] == max(4, round(processor.variants["no_relight"]['workflow']["478"]['inputs']['steps'] * 0.4))
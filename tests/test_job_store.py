@@ -0,0 +1,126 @@
+import types
+
+import pytest
+
+from utils import job_store
+from utils.job_store import JobStore, ITEM_DONE, ITEM_SUBMITTED, JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(job_store, "time", types.SimpleNamespace(time=clock.time))
+    return clock
+
+
+@pytest.fixture
+def store(tmp_path, clock):
+    return JobStore(str(tmp_path / "jobs" / "jobs.db"), lease_seconds=30, max_attempts=2)
+
+
+def test_claim_order_follows_priority_then_age(store, clock):
+    bulk = store.enqueue("image2poster", {"n": 1}, priority=1)
+    clock.now += 1
+    first = store.enqueue("image2poster", {"n": 2}, priority=0)
+    clock.now += 1
+    second = store.enqueue("image2poster", {"n": 3}, priority=0)
+    claimed = [store.claim("worker")["job_id"] for _ in range(3)]
+    assert claimed == [first, second, bulk]
+    assert store.claim("worker") is None
+
+
+def test_claim_returns_payload_and_attempts(store):
+    job_id = store.enqueue("image2poster", {"prompt": "a bottle"}, job_id="job-1")
+    assert job_id == "job-1"
+    job = store.claim("worker")
+    assert job == {"job_id": "job-1", "task_type": "image2poster", "data": {"prompt": "a bottle"}, "attempts": 1}
+    assert store.get_job(job_id)["status"] == JOB_RUNNING
+    assert store.get_job(job_id)["lease_owner"] == "worker"
+
+
+def test_expired_lease_is_claimed_again(store, clock):
+    job_id = store.enqueue("image2poster", {})
+    store.claim("dead")
+    clock.now += 10
+    assert store.heartbeat(job_id, "dead")     # Extends the lease to now + 30
+    clock.now += 20
+    assert store.claim("other") is None
+    clock.now += 11
+    job = store.claim("other")
+    assert job["job_id"] == job_id
+    assert job["attempts"] == 2
+    # The old worker lost the lease, it can neither extend nor finish the job
+    assert not store.heartbeat(job_id, "dead")
+    store.complete(job_id, "dead", {"images": []})
+    assert store.get_job(job_id)["status"] == JOB_RUNNING
+
+
+def test_lease_expiring_too_often_fails_the_job(store, clock):
+    job_id = store.enqueue("image2poster", {})
+    for _ in range(2):
+        assert store.claim("worker")["job_id"] == job_id
+        clock.now += 31
+    assert store.claim("worker") is None
+    job = store.get_job(job_id)
+    assert job["status"] == JOB_FAILED
+    assert job["error"] == "lease expired too many times"
+
+
+def test_complete_stores_the_result(store):
+    job_id = store.enqueue("image2poster", {})
+    store.claim("worker")
+    store.complete(job_id, "worker", {"images": ["a.png"]})
+    job = store.get_job(job_id)
+    assert job["status"] == JOB_DONE
+    assert job["result"] == {"images": ["a.png"]}
+    assert job["lease_owner"] is None
+
+
+def test_fail_with_retry_requeues_until_attempts_run_out(store):
+    job_id = store.enqueue("image2poster", {})
+    store.claim("worker")
+    store.fail(job_id, "worker", "ComfyUI unreachable", retry=True)
+    assert store.get_job(job_id)["status"] == JOB_QUEUED
+    assert store.claim("worker")["attempts"] == 2
+    store.fail(job_id, "worker", "ComfyUI unreachable", retry=True)
+    job = store.get_job(job_id)
+    assert job["status"] == JOB_FAILED
+    assert job["error"] == "ComfyUI unreachable"
+
+
+def test_items_round_trip(store):
+    job_id = store.enqueue("image2poster", {})
+    store.record_item_submitted(job_id, 0, "prompt-a", {"seed": 1})
+    store.record_item_submitted(job_id, 1, "prompt-b", {"seed": 2})
+    store.record_item_done(job_id, 0, {"images": ["a.png"]})
+    items = store.get_items(job_id)
+    assert items[0] == {"status": ITEM_DONE, "prompt_id": "prompt-a", "params": {"seed": 1}, "outputs": {"images": ["a.png"]}}
+    assert items[1] == {"status": ITEM_SUBMITTED, "prompt_id": "prompt-b", "params": {"seed": 2}, "outputs": None}
+    # A resubmitted item replaces the record of the lost prompt
+    store.record_item_submitted(job_id, 1, "prompt-c", {"seed": 2})
+    assert store.get_items(job_id)[1]["prompt_id"] == "prompt-c"
+    assert store.get_items("other") == {}
+
+
+def test_jobs_ahead_and_counts(store, clock):
+    running = store.enqueue("image2poster", {"n": 0})
+    store.claim("worker")
+    clock.now += 1
+    earlier = store.enqueue("image2poster", {"n": 1})
+    clock.now += 1
+    job_id = store.enqueue("image2poster", {"n": 2})
+    clock.now += 1
+    store.enqueue("image2poster", {"n": 3})
+    store.enqueue("image2poster", {"n": 4}, priority=1)
+    ahead = {job["job_id"] for job in store.jobs_ahead(job_id)}
+    assert ahead == {running, earlier}
+    assert store.jobs_ahead("missing") == []
+    assert store.counts() == {JOB_RUNNING: 1, JOB_QUEUED: 4}
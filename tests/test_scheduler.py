@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+
+from utils.scheduler import (FairShareScheduler, ResourcePool, POLICY_SJF, PRIORITY_BULK, PRIORITY_INTERACTIVE,
+                             RESOURCE_GPU)
+
+
+async def _settle() -> None:
+    """Let the tasks created so far run up to their first wait"""
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+async def _grant_order(pool: ResourcePool, requests: list) -> list:
+    """
+    Queue (tenant, priority, expected_seconds) requests behind a blocker holding the only slot, then release
+    them one by one, returns the tenants in the order they were granted
+    """
+    blocker = await pool.acquire("blocker", PRIORITY_INTERACTIVE)
+    tasks = {}
+    for tenant, priority, expected_seconds in requests:
+        tasks[asyncio.ensure_future(pool.acquire(tenant, priority, expected_seconds=expected_seconds))] = tenant
+        await _settle()
+    pool.release(blocker)
+    order = []
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        assert len(done) == 1, "one slot grants one ticket at a time"
+        task = done.pop()
+        order.append(tasks[task])
+        pool.release(task.result())
+    return order
+
+
+def test_capacity_is_never_exceeded():
+    async def run():
+        pool = ResourcePool("gpu", capacity=2, tenant_limit=10, tenant_weights={})
+        peak = running = 0
+
+        async def job():
+            nonlocal peak, running
+            ticket = await pool.acquire("a", PRIORITY_BULK)
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.001)
+            running -= 1
+            pool.release(ticket)
+
+        await asyncio.gather(*[job() for _ in range(10)])
+        return peak, pool.running
+    peak, running = asyncio.run(run())
+    assert peak == 2
+    assert running == 0
+
+
+def test_one_tenant_is_served_in_arrival_order():
+    async def run():
+        pool = ResourcePool("gpu", capacity=1, tenant_limit=1, tenant_weights={})
+        return await _grant_order(pool, [("a", PRIORITY_BULK, 0.0)] * 3 + [("b", PRIORITY_BULK, 0.0)])
+    assert asyncio.run(run()) == ["a", "b", "a", "a"]
+
+
+def test_tenants_share_slots_by_weight():
+    async def run():
+        pool = ResourcePool("gpu", capacity=1, tenant_limit=1, tenant_weights={"heavy": 2.0})
+        requests = [(tenant, PRIORITY_BULK, 0.0) for _ in range(6) for tenant in ("heavy", "light")]
+        return await _grant_order(pool, requests)
+    order = asyncio.run(run())
+    # Stride scheduling: the heavy tenant's pass grows half as fast, it gets two of every three slots while both wait
+    assert order[:6].count("heavy") == 4
+    assert order[:6].count("light") == 2
+
+
+def test_interactive_before_bulk_and_reserved_slots():
+    async def run():
+        pool = ResourcePool("gpu", capacity=2, tenant_limit=10, tenant_weights={}, interactive_reserved=1)
+        first = await pool.acquire("a", PRIORITY_BULK)
+        # The last slot is kept for interactive requests
+        bulk = asyncio.ensure_future(pool.acquire("a", PRIORITY_BULK))
+        await _settle()
+        assert not bulk.done()
+        interactive = await asyncio.wait_for(pool.acquire("b", PRIORITY_INTERACTIVE), 1)
+        pool.release(first)
+        pool.release(interactive)
+        ticket = await asyncio.wait_for(bulk, 1)
+        pool.release(ticket)
+        return pool.running
+    assert asyncio.run(run()) == 0
+
+
+def test_tenant_limit():
+    async def run():
+        pool = ResourcePool("gpu", capacity=4, tenant_limit=1, tenant_weights={})
+        first = await pool.acquire("a", PRIORITY_BULK)
+        second = asyncio.ensure_future(pool.acquire("a", PRIORITY_BULK))
+        other = await asyncio.wait_for(pool.acquire("b", PRIORITY_BULK), 1)
+        await _settle()
+        waited = not second.done()
+        pool.release(first)
+        pool.release(await asyncio.wait_for(second, 1))
+        pool.release(other)
+        return waited
+    assert asyncio.run(run())
+
+
+def test_sjf_serves_the_shortest_expected_job_first():
+    async def run():
+        pool = ResourcePool("gpu", capacity=1, tenant_limit=10, tenant_weights={}, policy=POLICY_SJF, sjf_aging=0.0)
+        return await _grant_order(pool, [("long", PRIORITY_BULK, 100.0), ("short", PRIORITY_BULK, 1.0), ("medium", PRIORITY_BULK, 10.0)])
+    assert asyncio.run(run()) == ["short", "medium", "long"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        pool = ResourcePool("gpu", capacity=1, tenant_limit=10, tenant_weights={})
+        holder = await pool.acquire("a", PRIORITY_BULK)
+        waiter = asyncio.ensure_future(pool.acquire("b", PRIORITY_BULK))
+        await _settle()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        queued = pool.tenants["b"].queued()
+        pool.release(holder)
+        pool.release(holder)    # Twice is harmless
+        return queued, pool.running
+    assert asyncio.run(run()) == (0, 0)
+
+
+def test_unknown_priority_and_policy_are_rejected():
+    with pytest.raises(ValueError):
+        ResourcePool("gpu", capacity=1, tenant_limit=1, tenant_weights={}, policy="lottery")
+
+    async def run():
+        scheduler = FairShareScheduler(gpu_capacity=1, llm_capacity=1, tenant_gpu_limit=1, tenant_llm_limit=1)
+        await scheduler.acquire(RESOURCE_GPU, "a", "urgent")
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+
+
+def test_slot_releases_on_error():
+    async def run():
+        scheduler = FairShareScheduler(gpu_capacity=1, llm_capacity=1, tenant_gpu_limit=1, tenant_llm_limit=1, gpu_interactive_reserved=0)
+        with pytest.raises(RuntimeError):
+            async with scheduler.slot(RESOURCE_GPU, "a", PRIORITY_BULK):
+                raise RuntimeError("render failed")
+        return scheduler.pools[RESOURCE_GPU].running
+    assert asyncio.run(run()) == 0
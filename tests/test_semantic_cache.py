@@ -0,0 +1,78 @@
+import types
+
+import numpy as np
+
+from utils import semantic_cache
+from utils.semantic_cache import HashedNgramVectorizer, SemanticCache
+
+
+def _cache(monkeypatch, now: list, **kwargs) -> SemanticCache:
+    monkeypatch.setattr(semantic_cache, "time", types.SimpleNamespace(time=lambda: now[0]))
+    kwargs.setdefault("threshold", 0.75)
+    kwargs.setdefault("capacity", 4)
+    kwargs.setdefault("ttl", 0)
+    return SemanticCache("test", **kwargs)
+
+
+def test_vectors_have_unit_length_and_rank_by_meaning():
+    vectorizer = HashedNgramVectorizer()
+    brief = vectorizer.embed("A perfume bottle on a marble table")
+    close = vectorizer.embed("perfume bottles on the marble table")
+    other = vectorizer.embed("running shoes on a city street")
+    assert np.isclose(np.linalg.norm(brief), 1.0)
+    # Stopwords and case do not count
+    assert np.isclose(float(brief @ vectorizer.embed("perfume bottle marble table")), 1.0)
+    assert float(brief @ close) > 0.75
+    assert float(brief @ close) > float(brief @ other)
+    assert not vectorizer.embed("").any()
+    assert np.isclose(np.linalg.norm(vectorizer.embed("香水瓶")), 1.0)
+
+
+def test_close_text_hits_and_distant_text_misses(monkeypatch):
+    cache = _cache(monkeypatch, [1000.0])
+    assert cache.get("a perfume bottle on a marble table") is None
+    cache.put("a perfume bottle on a marble table", {"prompt": "p1"})
+    value, similarity = cache.get("perfume bottles on the marble table")
+    assert value == {"prompt": "p1"}
+    assert similarity >= 0.75
+    assert cache.get("running shoes on a city street") is None
+    stats = cache.stats()
+    assert (stats["entries"], stats["lookups"], stats["hits"], stats["hit_rate"]) == (1, 3, 1, 0.3333)
+
+
+def test_same_text_replaces_its_entry(monkeypatch):
+    cache = _cache(monkeypatch, [1000.0])
+    cache.put("a perfume bottle", "old")
+    cache.put("a perfume bottle", "new")
+    assert cache.get("a perfume bottle")[0] == "new"
+    assert cache.stats()["entries"] == 1
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    now = [1000.0]
+    cache = _cache(monkeypatch, now, capacity=2)
+    cache.put("a perfume bottle on marble", "perfume")
+    now[0] += 1
+    cache.put("running shoes on a street", "shoes")
+    now[0] += 1
+    assert cache.get("a perfume bottle on marble")[0] == "perfume"     # Now the most recently used
+    now[0] += 1
+    cache.put("a coffee mug on a desk", "mug")
+    assert cache.get("running shoes on a street") is None
+    assert cache.get("a perfume bottle on marble")[0] == "perfume"
+    assert cache.get("a coffee mug on a desk")[0] == "mug"
+    assert cache.stats()["entries"] == 2
+
+
+def test_expired_entries_are_not_returned_and_reused_first(monkeypatch):
+    now = [1000.0]
+    cache = _cache(monkeypatch, now, capacity=2, ttl=60)
+    cache.put("a perfume bottle on marble", "perfume")
+    now[0] += 30
+    cache.put("running shoes on a street", "shoes")
+    now[0] += 31
+    assert cache.get("a perfume bottle on marble") is None
+    # The expired row is taken before the live one, although the live one was used less recently since
+    cache.put("a coffee mug on a desk", "mug")
+    assert cache.get("running shoes on a street")[0] == "shoes"
+    assert cache.get("a coffee mug on a desk")[0] == "mug"
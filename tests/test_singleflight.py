@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from utils.singleflight import SingleFlight, make_key
+
+
+def test_make_key_ignores_dict_order():
+    assert make_key("image2poster", {"a": 1, "b": [1, 2]}) == make_key("image2poster", {"b": [1, 2], "a": 1})
+    assert make_key("image2poster", None, {"a": 1}) != make_key("image2poster", "task-1", {"a": 1})
+
+
+def test_identical_calls_run_once_and_get_their_own_copy():
+    async def run():
+        group = SingleFlight("test")
+        started = 0
+
+        async def work():
+            nonlocal started
+            started += 1
+            await asyncio.sleep(0.01)
+            return {"images": ["a.png"]}
+
+        results = await asyncio.gather(*[group.do("key", work) for _ in range(5)])
+        return group, started, results
+    group, started, results = asyncio.run(run())
+    assert started == 1
+    assert all(result == {"images": ["a.png"]} for result in results)
+    results[0]["images"].append("b.png")
+    assert results[1] == {"images": ["a.png"]}
+    assert (group.calls, group.executions, group.coalesced) == (5, 1, 4)
+    assert group.stats()["in_flight"] == 0
+
+
+def test_different_keys_and_later_calls_run_again():
+    async def run():
+        group = SingleFlight("test")
+        started = []
+
+        async def work(value):
+            started.append(value)
+            await asyncio.sleep(0)
+            return value
+
+        first = await asyncio.gather(group.do("a", lambda: work("a")), group.do("b", lambda: work("b")))
+        again = await group.do("a", lambda: work("a"))
+        return first, again, started
+    first, again, started = asyncio.run(run())
+    assert first == ["a", "b"]
+    assert again == "a"
+    assert started == ["a", "b", "a"]
+
+
+def test_exception_reaches_every_caller():
+    async def run():
+        group = SingleFlight("test")
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("ComfyUI unreachable")
+
+        return await asyncio.gather(*[group.do("key", work) for _ in range(3)], return_exceptions=True), group
+    results, group = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert group.executions == 1
+
+
+def test_disabled_group_runs_every_call():
+    async def run():
+        group = SingleFlight("test", enabled=False)
+        started = 0
+
+        async def work():
+            nonlocal started
+            started += 1
+            await asyncio.sleep(0)
+            return started
+
+        await asyncio.gather(*[group.do("key", work) for _ in range(3)])
+        return started
+    assert asyncio.run(run()) == 3
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_call():
+    async def run():
+        group = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "done"
+
+        first = asyncio.ensure_future(group.do("key", work))
+        second = asyncio.ensure_future(group.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        release.set()
+        return await asyncio.wait_for(second, 1)
+    assert asyncio.run(run()) == "done"
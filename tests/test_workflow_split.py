@@ -0,0 +1,99 @@
+import pytest
+
+from schemas.task_schema import InputBinding
+from utils.workflow_split import ancestors, apply_overrides, bindings_in, preprocess_output_id, split_workflow
+
+
+def _node(class_type: str, **inputs) -> dict:
+    return {'class_type': class_type, 'inputs': inputs, '_meta': {'title': class_type}}
+
+
+def _workflow() -> dict:
+    """Product image -> background removal -> blend onto a generated background -> save"""
+    return {
+        "1": _node("LoadImage", image="product.png", upload="image"),
+        "2": _node("RMBG", image=["1", 0], model="RMBG-2.0"),
+        "3": _node("CheckpointLoaderSimple", ckpt_name="flux.safetensors"),
+        "4": _node("KSampler", model=["3", 0], seed=1, steps=20),
+        "5": _node("VAEDecode", samples=["4", 0], vae=["3", 2]),
+        "6": _node("ImageBlend", image1=["5", 0], image2=["2", 0], mask=["2", 1]),
+        "7": _node("SaveImage", images=["6", 0], filename_prefix="poster"),
+        "8": _node("PreviewImage", images=["1", 0]),
+    }
+
+
+def test_ancestors():
+    workflow = _workflow()
+    assert ancestors(workflow, "2") == {"1", "2"}
+    assert ancestors(workflow, "6") == {"1", "2", "3", "4", "5", "6"}
+    assert ancestors(workflow, "3") == {"3"}
+
+
+def test_preprocess_workflow_is_the_node_its_inputs_and_a_save():
+    workflow = _workflow()
+    preprocess, _, _ = split_workflow(workflow, "2")
+    output_id = preprocess_output_id("2")
+    assert set(preprocess) == {"1", "2", output_id}
+    assert preprocess[output_id]['class_type'] == "SaveImage"
+    assert preprocess[output_id]['inputs']['images'] == ["2", 0]
+    assert preprocess["2"] == workflow["2"]
+    assert preprocess["2"] is not workflow["2"]
+
+
+def test_generation_workflow_loads_the_cached_image():
+    workflow = _workflow()
+    _, generation, load_id = split_workflow(workflow, "2")
+    assert load_id == "2_cached"
+    assert generation[load_id]['class_type'] == "LoadImage"
+    # The node keeps its ID, so the links of its consumers still hold
+    assert generation["2"]['class_type'] == "JoinImageWithAlpha"
+    assert generation["2"]['inputs'] == {'image': [load_id, 0], 'alpha': [load_id, 1]}
+    assert generation["6"] == workflow["6"]
+    # The product LoadImage still feeds an output node, so it stays
+    assert "1" in generation
+    assert workflow["2"]['class_type'] == "RMBG"
+
+
+def test_generation_workflow_drops_inputs_only_the_preprocessing_needed():
+    workflow = _workflow()
+    del workflow["8"]
+    _, generation, load_id = split_workflow(workflow, "2")
+    assert set(generation) == {"2", "3", "4", "5", "6", "7", load_id}
+
+
+def test_overrides_change_inputs_of_a_copy():
+    workflow = _workflow()
+    changed = apply_overrides(workflow, {"4": {"steps": 12}})
+    assert changed["4"]['inputs']['steps'] == 12
+    assert workflow["4"]['inputs']['steps'] == 20
+    assert set(changed) == set(workflow)
+
+
+def test_rewired_overrides_drop_the_bypassed_nodes():
+    workflow = _workflow()
+    # Save the decoded background as it is: the blend and the background removal are not needed any more
+    changed = apply_overrides(workflow, {7: {"images": [5, 0]}})
+    assert changed["7"]['inputs']['images'] == ["5", 0]
+    assert set(changed) == {"1", "3", "4", "5", "7", "8"}
+    del workflow["8"]
+    assert set(apply_overrides(workflow, {"7": {"images": ["5", 0]}})) == {"3", "4", "5", "7"}
+
+
+def test_overrides_naming_unknown_nodes_are_rejected():
+    with pytest.raises(ValueError, match="99"):
+        apply_overrides(_workflow(), {"99": {"steps": 12}})
+    with pytest.raises(ValueError, match="98"):
+        apply_overrides(_workflow(), {"7": {"images": ["98", 0]}})
+
+
+def test_bindings_in_keeps_bindings_of_remaining_nodes():
+    bindings = {
+        'seed': [InputBinding(node="4", input="seed")],
+        'input_image': [InputBinding(node="1", input="image"), InputBinding(node="2", input="image")],
+        'mask': [InputBinding(node="2", input="mask")],
+    }
+    workflow = apply_overrides(_workflow(), {"6": {"image2": ["1", 0], "mask": ["1", 1]}})
+    assert "2" not in workflow
+    kept = bindings_in(bindings, workflow)
+    assert set(kept) == {'seed', 'input_image'}
+    assert [binding.node for binding in kept['input_image']] == ["1"]
@@ -0,0 +1,269 @@
+"""
+Open-loop load generator: replays process payloads from a JSONL file at a fixed or ramping arrival rate
+and reports throughput, error rate and p50/p95/p99 latency, end to end and per pipeline stage.
+
+    python tools/loadgen.py --requests tools/sample_requests.jsonl --qps 0.5 --duration 120
+    python tools/loadgen.py --requests tools/sample_requests.jsonl --ramp 0.2:2 --duration 300 --stub --stub-gpus 2
+
+Open loop: request i is sent at its scheduled time whether or not the earlier ones have finished, so an
+overloaded system shows up as growing latency and errors instead of a lower send rate.
+
+Each line of the requests file is either a process payload ({"image_path" or "image_url": ..., "input_prompt": ...}) or
+{"task_type": ..., "data": {...}}. Lines that are neither are skipped. The requests run in this process
+through the task engine, against the ComfyUI and Azure OpenAI endpoints of the settings, or against
+tools/stub_servers.py started on free ports with --stub.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+project_root = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(project_root))   # Project modules are imported after the stub endpoints are set
+
+from utils.metrics import LatencyHistogram
+
+
+PERCENTILES = (50, 95, 99)
+
+
+def load_payloads(path, default_task_type):
+    payloads = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if isinstance(entry.get("data"), dict):
+                payloads.append((entry.get("task_type", default_task_type), entry["data"]))
+            elif "image_path" in entry or "image_url" in entry:
+                payloads.append((default_task_type, entry))
+            else:
+                print(f"line {number} is not a process payload, skipped", file=sys.stderr)
+    if not payloads:
+        raise SystemExit(f"no process payloads in {path}")
+    return payloads
+
+
+def arrival_offsets(duration, start_qps, end_qps, poisson):
+    """Send times in seconds from the start, the rate goes linearly from start_qps to end_qps"""
+    offset = 0.0
+    while offset < duration:
+        yield offset
+        rate = start_qps + (end_qps - start_qps) * offset / duration
+        offset += random.expovariate(rate) if poisson else 1.0 / rate
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub(args):
+    """Start tools/stub_servers.py on free ports and point the settings at it, before they are imported"""
+    comfyui_port, llm_port = free_port(), free_port()
+    command = [sys.executable, str(project_root / "tools" / "stub_servers.py"),
+               "--comfyui-port", str(comfyui_port), "--llm-port", str(llm_port),
+               "--node-seconds", str(args.stub_node_seconds), "--llm-latency", str(args.stub_llm_latency),
+               "--gpus", str(args.stub_gpus), "--fail-rate", str(args.stub_fail_rate),
+               "--drop-seconds", str(args.stub_drop_seconds)]
+    process = subprocess.Popen(command, cwd=project_root)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", llm_port), timeout=0.2).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise SystemExit("stub servers did not start")
+            time.sleep(0.1)
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    os.environ.update({
+        "COMFYUI_BASE_API_URL": f"http://127.0.0.1:{comfyui_port}",
+        "COMFYUI_WEBSOCKET_API_URL": f"ws://127.0.0.1:{comfyui_port}/ws",
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{llm_port}",
+    })
+    for key, value in {"AZURE_OPENAI_MODEL": "stub", "AZURE_OPENAI_API_KEY": "stub", "AZURE_OPENAI_API_VERSION": "2024-02-01",
+                       "LOG_LEVEL": "WARNING", "DEFAULT_BATCHSIZE_USE_ONE_PROMPT": "1", "IMAGE2POSTER_BATCHSIZE_USE_ONE_PROMPT": "1",
+                       "IMAGE2POSTER_OUTPUT_SIZE_WIDTH": "1024", "IMAGE2POSTER_OUTPUT_SIZE_HEIGHT": "1024",
+                       "IMAGE2POSTER_SCALE_MIN": "0.3", "IMAGE2POSTER_SCALE_MAX": "0.7",
+                       "IMAGE_INPUT_ALLOW_PRIVATE_URLS": "true"}.items():     # Test images are served locally
+        os.environ.setdefault(key, value)
+    return process
+
+
+def histogram_line(name, histogram):
+    snapshot = histogram.snapshot(percentiles=PERCENTILES)
+    if not snapshot["count"]:
+        return f"{name:<14} no samples"
+    values = "  ".join(f"p{percent} {snapshot[f'p{percent}']:8.3f}s" for percent in PERCENTILES)
+    return f"{name:<14} n={snapshot['count']:<6} {values}  max {snapshot['max']:8.3f}s"
+
+
+async def run(args):
+    from models.azure_openai import azure_openai, azure_model
+    from services.task_engine import TaskEngine
+
+    payloads = load_payloads(args.requests, args.task_type)
+    engine = TaskEngine(model_client=azure_openai, model_name=azure_model)
+    for task_type in {task_type for task_type, _ in payloads}:
+        engine.processor(task_type).stage_latency.clear()
+
+    if args.ramp:
+        start_qps, end_qps = (float(value) for value in args.ramp.split(":"))
+    else:
+        start_qps = end_qps = args.qps
+
+    end_to_end = LatencyHistogram()
+    window = LatencyHistogram()
+    dispatch_lag = LatencyHistogram()
+    errors = collections.Counter()
+    counts = collections.Counter()
+    in_flight = set()
+
+    async def one_request(task_type, data):
+        data = dict(data)
+        if args.vary_seed and "seed" not in data:
+            data["seed"] = random.randint(1, 886185987922208)   # Identical payloads would be coalesced into one run
+        if args.output_path:
+            data["output_path"] = args.output_path
+        started = time.perf_counter()
+        try:
+            result = await engine.process(task_type, str(uuid.uuid4()), data)
+            ok, message = result["status"], result["message"]
+        except Exception as e:
+            ok, message = False, f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - started
+        if ok:
+            counts["completed"] += 1
+            end_to_end.record(elapsed)
+            window.record(elapsed)
+        else:
+            counts["errors"] += 1
+            errors[message.strip()[:120]] += 1
+
+    async def report_windows():
+        previous = collections.Counter()
+        while True:
+            await asyncio.sleep(args.report_interval)
+            snapshot = window.snapshot(percentiles=(50, 99))
+            window.reset()
+            sent = counts["sent"] - previous["sent"]
+            print(f"[{time.perf_counter() - run_started:7.1f}s] offered {sent / args.report_interval:6.2f} qps  "
+                  f"completed {counts['completed'] - previous['completed']:4d}  errors {counts['errors'] - previous['errors']:3d}  "
+                  f"in flight {len(in_flight):4d}  p50 {snapshot['p50'] or 0:7.3f}s  p99 {snapshot['p99'] or 0:7.3f}s", flush=True)
+            previous = collections.Counter(counts)
+
+    run_started = time.perf_counter()
+    reporter = asyncio.ensure_future(report_windows())
+    for number, offset in enumerate(arrival_offsets(args.duration, start_qps, end_qps, args.poisson)):
+        if args.max_requests and number >= args.max_requests:
+            break
+        delay = run_started + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        dispatch_lag.record(max(0.0, time.perf_counter() - run_started - offset))
+        task_type, data = payloads[number % len(payloads)]
+        task = asyncio.ensure_future(one_request(task_type, data))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        counts["sent"] += 1
+    send_seconds = time.perf_counter() - run_started
+
+    if in_flight:
+        done, pending = await asyncio.wait(set(in_flight), timeout=args.drain_timeout)
+        for task in pending:
+            task.cancel()
+        counts["unfinished"] = len(pending)
+    reporter.cancel()
+    elapsed = time.perf_counter() - run_started
+
+    stage_latency = {}
+    for task_type in {task_type for task_type, _ in payloads}:
+        for name, histogram in engine.processor(task_type).stage_latency.items():
+            stage_latency.setdefault(name, LatencyHistogram()).merge(histogram)
+    finished = counts["completed"] + counts["errors"]
+    report = {
+        "requests_file": args.requests,
+        "arrival_qps": [start_qps, end_qps],
+        "sent": counts["sent"],
+        "completed": counts["completed"],
+        "errors": counts["errors"],
+        "unfinished": counts["unfinished"],
+        "error_rate": round(counts["errors"] / finished, 4) if finished else 0.0,
+        "elapsed_seconds": round(elapsed, 3),
+        "offered_qps": round(counts["sent"] / send_seconds, 4) if send_seconds else 0.0,
+        "throughput_qps": round(counts["completed"] / elapsed, 4) if elapsed else 0.0,
+        "end_to_end": end_to_end.snapshot(percentiles=PERCENTILES),
+        "stages": {name: histogram.snapshot(percentiles=PERCENTILES) for name, histogram in stage_latency.items()},
+        "dispatch_lag": dispatch_lag.snapshot(percentiles=PERCENTILES),
+        "error_messages": dict(errors.most_common(10)),
+    }
+    engine.close()
+
+    print(f"\nsent {report['sent']}  completed {report['completed']}  errors {report['errors']} ({report['error_rate']:.1%})  "
+          f"unfinished {report['unfinished']}")
+    print(f"offered {report['offered_qps']} qps  throughput {report['throughput_qps']} qps  elapsed {report['elapsed_seconds']}s")
+    print(histogram_line("end to end", end_to_end))
+    for name, histogram in stage_latency.items():
+        print(histogram_line(f"  {name}", histogram))
+    print(histogram_line("dispatch lag", dispatch_lag))
+    for message, count in errors.most_common(5):
+        print(f"error x{count}: {message}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open-loop load generator replaying process payloads")
+    parser.add_argument("--requests", required=True, help="JSONL file with process payloads")
+    parser.add_argument("--task-type", default="image2poster", help="Task type of payloads that do not name one")
+    rate = parser.add_mutually_exclusive_group(required=True)
+    rate.add_argument("--qps", type=float, help="Fixed arrival rate")
+    rate.add_argument("--ramp", help="Arrival rate going linearly from START to END qps over the duration, e.g. 0.2:2")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds requests are sent for")
+    parser.add_argument("--max-requests", type=int, default=0, help="Stop sending after this many requests, 0 for no limit")
+    parser.add_argument("--poisson", action="store_true", help="Exponential inter-arrival times instead of even spacing")
+    parser.add_argument("--vary-seed", action=argparse.BooleanOptionalAction, default=True,
+                        help="Give every request without a seed its own, so replayed payloads are not coalesced")
+    parser.add_argument("--output-path", help="Override output_path of every payload")
+    parser.add_argument("--report-interval", type=float, default=10, help="Seconds between two progress lines")
+    parser.add_argument("--drain-timeout", type=float, default=600, help="Seconds to wait for requests in flight after sending stops")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--stub", action="store_true", help="Run against tools/stub_servers.py started on free ports")
+    parser.add_argument("--stub-node-seconds", type=float, default=0.01)
+    parser.add_argument("--stub-llm-latency", type=float, default=0.3)
+    parser.add_argument("--stub-gpus", type=int, default=1)
+    parser.add_argument("--stub-fail-rate", type=float, default=0.0)
+    parser.add_argument("--stub-drop-seconds", type=float, default=0.0, help="Stub closes every websocket this often")
+    args = parser.parse_args()
+    if (args.qps is not None and args.qps <= 0) or (args.ramp and min(float(value) for value in args.ramp.split(":")) <= 0):
+        parser.error("arrival rates must be positive")
+
+    os.chdir(project_root)      # Template and workflow paths of the settings are relative to the project root
+    stub = start_stub(args) if args.stub else None
+    try:
+        asyncio.run(run(args))
+    finally:
+        if stub is not None:
+            stub.terminate()
+            stub.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""
+Local stand-in servers for ComfyUI and Azure OpenAI, good enough for load tests and smoke tests.
+
+    python tools/stub_servers.py --comfyui-port 8188 --llm-port 8189 --node-seconds 0.05 --gpus 2
+
+Point COMFYUI_BASE_API_URL at http://127.0.0.1:8188 and AZURE_OPENAI_ENDPOINT at http://127.0.0.1:8189.
+The ComfyUI stand-in speaks the websocket protocol, serves /history, /view, /queue and /object_info
+(schemas derived from a workflow file) and renders every node in node_seconds. The Azure OpenAI
+stand-in answers chat completions after llm_latency and can enforce a requests-per-minute limit.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import random
+import struct
+import time
+import urllib.parse
+import uuid
+from urllib.parse import urlsplit, parse_qs
+
+from PIL import Image
+
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class HttpRequest:
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        parts = urlsplit(target)
+        self.path = parts.path
+        self.query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b"{}")
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    body = b""
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    return HttpRequest(method, target, headers, body)
+
+
+def http_response(status, body=b"", content_type="application/json", headers=None):
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body).encode()
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 429: "Too Many Requests"}.get(status, "OK")
+    lines = [f"HTTP/1.1 {status} {reason}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+    for key, value in (headers or {}).items():
+        lines.append(f"{key}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+
+def parse_multipart(body, content_type):
+    boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+    fields, files = {}, {}
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        head, value = part.split(b"\r\n\r\n", 1)
+        value = value[:-2] if value.endswith(b"\r\n") else value
+        disposition = head.decode("latin-1")
+        name = disposition.split('name="', 1)[1].split('"', 1)[0]
+        if 'filename="' in disposition:
+            files[name] = (disposition.split('filename="', 1)[1].split('"', 1)[0], value)
+        else:
+            fields[name] = value.decode()
+    return fields, files
+
+
+def ws_frame(payload, opcode):
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 65536:
+        header += bytes([126]) + struct.pack(">H", length)
+    else:
+        header += bytes([127]) + struct.pack(">Q", length)
+    return header + payload
+
+
+class StubComfyUI:
+    """Executes queued prompts on `gpus` executors, each node takes node_seconds, output nodes stream a PNG"""
+    OUTPUT_CLASSES = ("SaveImageWebsocket", "SaveImage", "PreviewImage")
+
+    def __init__(self, node_seconds=0.01, fail_rate=0.0, gpus=1, drop_seconds=0.0):
+        self.node_seconds = node_seconds
+        self.drop_seconds = drop_seconds
+        self.gpus = gpus
+        self.fail_rate = fail_rate
+        self.queue = asyncio.Queue()
+        self.clients = {}       # client_id -> writer
+        self.history = {}
+        self.files = {}         # (type, subfolder, filename) -> bytes
+        self.counter = 0
+        self.schemas = {}
+        self.running = {}       # prompt_id -> queue number
+
+    def load_schemas(self, workflow_path):
+        """Node schemas synthesized from the literal values and links of an API-format workflow"""
+        with open(workflow_path, "r", encoding="utf-8") as file:
+            workflow = json.load(file)
+        schemas = {}
+        output_counts = {}
+        for node in workflow.values():
+            for value in node["inputs"].values():
+                if isinstance(value, list) and len(value) == 2:
+                    source_class = workflow[str(value[0])]["class_type"]
+                    output_counts[source_class] = max(output_counts.get(source_class, 1), value[1] + 1)
+        for node in workflow.values():
+            required = schemas.setdefault(node["class_type"], {"input": {"required": {}}})["input"]["required"]
+            for name, value in node["inputs"].items():
+                if isinstance(value, list):
+                    required[name] = ["*"]
+                elif isinstance(value, bool):
+                    required[name] = ["BOOLEAN", {}]
+                elif isinstance(value, int):
+                    required[name] = ["INT", {"min": 16, "max": 16384} if name in ("width", "height") else {"min": -2 ** 63, "max": 2 ** 64}]
+                elif isinstance(value, float):
+                    required[name] = ["FLOAT", {"min": -1e9, "max": 1e9}]
+                else:
+                    required[name] = ["STRING", {}]
+        for class_type, schema in schemas.items():
+            schema["output"] = ["*"] * output_counts.get(class_type, 1)
+            schema["output_node"] = class_type in self.OUTPUT_CLASSES
+        schemas["SaveImageWebsocket"] = {"input": {"required": {"images": ["IMAGE"]}}, "output": [], "output_node": True}
+        self.schemas = schemas
+
+    def object_info(self, class_type=None):
+        schemas = dict(self.schemas)
+        schemas["LoadImage"] = {"input": {"required": {"image": [sorted(name for (kind, _, name) in self.files if kind == "input"), {"image_upload": True}]}},
+                                "output": ["IMAGE", "MASK"], "output_node": False}
+        schemas["JoinImageWithAlpha"] = {"input": {"required": {"image": ["IMAGE"], "alpha": ["MASK"]}}, "output": ["IMAGE"], "output_node": False}
+        if class_type is None:
+            return schemas
+        return {class_type: schemas[class_type]} if class_type in schemas else {}
+
+    @staticmethod
+    def png(width=64, height=64, rgba=False):
+        color = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+        image = Image.new("RGBA" if rgba else "RGB", (width, height), color + ((200,) if rgba else ()))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    async def send(self, client_id, message=None, binary=None):
+        writer = self.clients.get(client_id)
+        if writer is None or writer.is_closing():
+            return
+        try:
+            if message is not None:
+                writer.write(ws_frame(json.dumps(message).encode(), 0x1))
+            else:
+                writer.write(ws_frame(binary, 0x2))
+            await writer.drain()
+        except ConnectionError:
+            self.clients.pop(client_id, None)
+
+    async def executor(self):
+        while True:
+            number, prompt_id, prompt, client_id = await self.queue.get()
+            self.running[prompt_id] = number
+            await self.send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id}})
+            outputs = {}
+            failed = random.random() < self.fail_rate
+            for node_id, node in prompt.items():
+                await self.send(client_id, {"type": "executing", "data": {"node": node_id, "prompt_id": prompt_id}})
+                await asyncio.sleep(self.node_seconds)
+                if failed:
+                    await self.send(client_id, {"type": "execution_error", "data": {
+                        "prompt_id": prompt_id, "node_id": node_id, "node_type": node["class_type"],
+                        "exception_message": "stub failure"}})
+                    break
+                if node["class_type"] in self.OUTPUT_CLASSES:
+                    data = self.png(rgba=True)
+                    if node["class_type"] == "SaveImageWebsocket":
+                        await self.send(client_id, binary=struct.pack(">II", 1, 2) + data)
+                    else:
+                        kind = "output" if node["class_type"] == "SaveImage" else "temp"
+                        filename = f"stub_{prompt_id}_{node_id}.png"
+                        self.files[(kind, "", filename)] = data
+                        outputs[node_id] = {"images": [{"filename": filename, "subfolder": "", "type": kind}]}
+            status = {"status_str": "error" if failed else "success", "completed": not failed}
+            self.history[prompt_id] = {"prompt": [number, prompt_id, prompt], "outputs": outputs, "status": status}
+            self.running.pop(prompt_id, None)
+            await self.send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+    async def drop_websockets(self):
+        """Close every websocket each drop_seconds, like a flaky network between the client and ComfyUI"""
+        while True:
+            await asyncio.sleep(self.drop_seconds)
+            for writer in list(self.clients.values()):
+                writer.close()
+            self.clients.clear()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                if request.headers.get("upgrade", "").lower() == "websocket":
+                    await self.websocket(request, reader, writer)
+                    return
+                writer.write(self.route(request))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def route(self, request):
+        path = request.path[4:] if request.path.startswith("/api/") else request.path
+        while path.startswith("/api/"):
+            path = path[4:]
+        if path == "/upload/image" and request.method == "POST":
+            fields, files = parse_multipart(request.body, request.headers["content-type"])
+            filename, data = files["image"]
+            subfolder = fields.get("subfolder", "")
+            self.files[("input", subfolder, filename)] = data
+            return http_response(200, {"name": filename, "subfolder": subfolder, "type": "input"})
+        if path == "/prompt" and request.method == "POST":
+            payload = request.json()
+            prompt_id = str(uuid.uuid4())
+            self.counter += 1
+            self.queue.put_nowait((self.counter, prompt_id, payload["prompt"], payload.get("client_id")))
+            return http_response(200, {"prompt_id": prompt_id, "number": self.counter, "node_errors": {}})
+        if path.startswith("/history/"):
+            prompt_id = path.split("/", 2)[2]
+            return http_response(200, {prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+        if path == "/view":
+            key = (request.query.get("type", "output"), request.query.get("subfolder", ""), request.query.get("filename"))
+            if key not in self.files:
+                return http_response(404, b"", "text/plain")
+            return http_response(200, self.files[key], "image/png")
+        if path == "/queue" and request.method == "POST":
+            deleted = set(request.json().get("delete", []))
+            kept = [entry for entry in self.queue._queue if entry[1] not in deleted]
+            self.queue._queue.clear()
+            self.queue._queue.extend(kept)
+            return http_response(200, {})
+        if path == "/queue":
+            return http_response(200, {"queue_running": [[number, prompt_id] for prompt_id, number in self.running.items()],
+                                       "queue_pending": [[entry[0], entry[1]] for entry in self.queue._queue]})
+        if path.startswith("/object_info"):
+            class_type = urllib.parse.unquote(path[len("/object_info/"):]) if path.startswith("/object_info/") else None
+            return http_response(200, self.object_info(class_type))
+        return http_response(404, {"error": "not found"})
+
+    async def websocket(self, request, reader, writer):
+        accept = base64.b64encode(hashlib.sha1((request.headers["sec-websocket-key"] + WS_MAGIC).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        await writer.drain()
+        client_id = request.query.get("clientId") or str(uuid.uuid4())
+        self.clients[client_id] = writer
+        await self.send(client_id, {"type": "status", "data": {"sid": client_id, "status": {"exec_info": {"queue_remaining": self.queue.qsize()}}}})
+        try:
+            while True:
+                head = await reader.readexactly(2)
+                length = head[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack(">H", await reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack(">Q", await reader.readexactly(8))[0]
+                await reader.readexactly(length + (4 if head[1] & 0x80 else 0))     # Mask and payload are ignored
+                if head[0] & 0x0F == 0x8:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if self.clients.get(client_id) is writer:
+                self.clients.pop(client_id, None)
+            writer.close()
+
+
+class StubAzureOpenAI:
+    """Answers chat completions, JSON mode returns a product placement, text mode returns a poster prompt"""
+    def __init__(self, latency=0.05, rpm_limit=0):
+        self.latency = latency
+        self.rpm_limit = rpm_limit
+        self.window = []
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                writer.write(await self.route(request))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def completion(self, payload):
+        json_mode = (payload.get("response_format") or {}).get("type") == "json_object"
+        choices = []
+        for index in range(int(payload.get("n") or 1)):
+            if json_mode:
+                content = json.dumps({"x_percent": random.randint(30, 70), "y_percent": random.randint(40, 70),
+                                      "scale": round(random.uniform(0.3, 0.7), 2)})
+            else:
+                content = random.choice(["A bright studio poster of the product on a marble table, soft light, high detail",
+                                         "A cinematic advertising photo of the product in a sunny garden, bokeh, photorealistic"])
+            choices.append({"index": index, "finish_reason": "stop", "message": {"role": "assistant", "content": content}})
+        return {"id": str(uuid.uuid4()), "object": "chat.completion", "created": int(time.time()),
+                "model": payload.get("model", "stub"), "choices": choices,
+                "usage": {"prompt_tokens": 100, "completion_tokens": 50 * len(choices), "total_tokens": 100 + 50 * len(choices)}}
+
+    async def route(self, request):
+        if not request.path.endswith("/chat/completions"):
+            return http_response(404, {"error": {"message": "not found"}})
+        now = time.time()
+        self.window = [t for t in self.window if now - t < 60]
+        if self.rpm_limit and len(self.window) >= self.rpm_limit:
+            return http_response(429, {"error": {"code": "429", "message": "Rate limit"}},
+                                 headers={"retry-after": str(max(1, int(60 - (now - self.window[0]) + 1))), "x-ratelimit-remaining-requests": "0"})
+        self.window.append(now)
+        await asyncio.sleep(self.latency)
+        remaining = self.rpm_limit - len(self.window) if self.rpm_limit else 1000
+        return http_response(200, self.completion(request.json()),
+                             headers={"x-ratelimit-remaining-requests": str(remaining), "x-ratelimit-remaining-tokens": "100000"})
+
+
+async def serve(comfyui_port, llm_port, node_seconds=0.01, llm_latency=0.05, fail_rate=0.0, gpus=1, llm_rpm_limit=0,
+                workflow_path=None, host="127.0.0.1", drop_seconds=0.0):
+    comfyui = StubComfyUI(node_seconds=node_seconds, fail_rate=fail_rate, gpus=gpus, drop_seconds=drop_seconds)
+    if workflow_path:
+        comfyui.load_schemas(workflow_path)
+    llm = StubAzureOpenAI(latency=llm_latency, rpm_limit=llm_rpm_limit)
+    executors = [asyncio.ensure_future(comfyui.executor()) for _ in range(gpus)]
+    if drop_seconds > 0:
+        executors.append(asyncio.ensure_future(comfyui.drop_websockets()))
+    comfyui_server = await asyncio.start_server(comfyui.handle, host, comfyui_port)
+    llm_server = await asyncio.start_server(llm.handle, host, llm_port)
+    print(f"stub ComfyUI on http://{host}:{comfyui_port}, stub Azure OpenAI on http://{host}:{llm_port}", flush=True)
+    try:
+        async with comfyui_server, llm_server:
+            await asyncio.gather(comfyui_server.serve_forever(), llm_server.serve_forever())
+    finally:
+        for executor in executors:
+            executor.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in ComfyUI and Azure OpenAI servers")
+    parser.add_argument("--comfyui-port", type=int, default=8188)
+    parser.add_argument("--llm-port", type=int, default=8189)
+    parser.add_argument("--node-seconds", type=float, default=0.01, help="Simulated GPU time per workflow node")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Simulated LLM latency in seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of prompts that fail with execution_error")
+    parser.add_argument("--gpus", type=int, default=1, help="Prompts rendered at the same time")
+    parser.add_argument("--llm-rpm-limit", type=int, default=0, help="Requests per minute before the LLM answers 429")
+    parser.add_argument("--drop-seconds", type=float, default=0.0, help="Close every websocket this often, 0 never")
+    parser.add_argument("--workflow", default="templates/comfyui_workflows/image2poster.json",
+                        help="API-format workflow the /object_info schemas are derived from")
+    args = parser.parse_args()
+    asyncio.run(serve(args.comfyui_port, args.llm_port, node_seconds=args.node_seconds, llm_latency=args.llm_latency,
+                      fail_rate=args.fail_rate, gpus=args.gpus, llm_rpm_limit=args.llm_rpm_limit, workflow_path=args.workflow,
+                      drop_seconds=args.drop_seconds))
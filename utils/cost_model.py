@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from utils.logger import logger
+from utils.setting import settings
+from utils.scheduler import PRIORITY_INTERACTIVE, PRIORITY_BULK
+
+
+class NodeCost:
+    """
+    Execution time of one workflow node as a + b * megapixels, fitted by least squares over decayed
+    observations, so the model follows GPU, driver and workflow changes. Until two resolutions were
+    seen the time is assumed proportional to the pixel count.
+    """
+    __slots__ = ("weight", "sum_x", "sum_y", "sum_xx", "sum_xy")
+
+    def __init__(self, weight: float = 0.0, sum_x: float = 0.0, sum_y: float = 0.0, sum_xx: float = 0.0, sum_xy: float = 0.0) -> None:
+        self.weight, self.sum_x, self.sum_y, self.sum_xx, self.sum_xy = weight, sum_x, sum_y, sum_xx, sum_xy
+
+    def add(self, megapixels: float, seconds: float, decay: float) -> None:
+        self.weight = self.weight * decay + 1
+        self.sum_x = self.sum_x * decay + megapixels
+        self.sum_y = self.sum_y * decay + seconds
+        self.sum_xx = self.sum_xx * decay + megapixels * megapixels
+        self.sum_xy = self.sum_xy * decay + megapixels * seconds
+
+    def predict(self, megapixels: float) -> float:
+        mean_x = self.sum_x / self.weight
+        mean_y = self.sum_y / self.weight
+        variance = self.sum_xx / self.weight - mean_x * mean_x
+        if variance > 1e-3 * max(mean_x * mean_x, 1e-6):
+            slope = max((self.sum_xy / self.weight - mean_x * mean_y) / variance, 0.0)
+            intercept = max(mean_y - slope * mean_x, 0.0)
+            return intercept + slope * megapixels
+        return mean_y * megapixels / mean_x if mean_x > 0 else mean_y
+
+    def to_list(self) -> list:
+        return [self.weight, self.sum_x, self.sum_y, self.sum_xx, self.sum_xy]
+
+
+class CostModel:
+    """
+    Expected GPU seconds of an image, the sum of the fitted times of the nodes of its task type. Trained
+    from the node timings ComfyUI reports on the websocket (observe_prompt), kept in a JSON file so new
+    workers start with the times the earlier ones measured.
+    """
+    def __init__(self, path: str = settings.COST_MODEL_PATH, default_image_seconds: float = settings.COST_MODEL_DEFAULT_IMAGE_SECONDS,
+                 decay: float = 0.98, save_interval: float = 30.0) -> None:
+        self.path = path
+        self.default_image_seconds = default_image_seconds
+        self.decay = decay
+        self.save_interval = save_interval
+        self.nodes: Dict[str, Dict[str, NodeCost]] = {}     # task type -> node ID -> cost
+        self.observed: Dict[str, int] = {}                  # task type -> prompts observed
+        self._expected: Dict[str, tuple] = {}               # prompt_id -> (task type, megapixels)
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+        self._load()
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+            for task_type, nodes in state.get("nodes", {}).items():
+                self.nodes[task_type] = {node_id: NodeCost(*values) for node_id, values in nodes.items()}
+            self.observed = state.get("observed", {})
+        except Exception as e:
+            logger.warning(f"cannot load cost model {self.path}: {e}")
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            state = {"nodes": {task_type: {node_id: cost.to_list() for node_id, cost in nodes.items()}
+                               for task_type, nodes in self.nodes.items()},
+                     "observed": dict(self.observed)}
+            self._saved_at = time.monotonic()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+        os.replace(temporary, self.path)
+
+    def expect(self, prompt_id: str, task_type: str, megapixels: float) -> None:
+        """Remember what a queued prompt renders, its timings are attributed to that task type and size"""
+        with self._lock:
+            self._expected[prompt_id] = (task_type, megapixels)
+
+    def forget(self, prompt_id: str) -> None:
+        with self._lock:
+            self._expected.pop(prompt_id, None)
+
+    def observe_prompt(self, prompt_id: str, node_times: Dict[str, float]) -> None:
+        """Node execution times of a finished prompt, cached nodes count with 0 seconds"""
+        with self._lock:
+            expected = self._expected.pop(prompt_id, None)
+            if expected is None or not node_times:
+                return
+            task_type, megapixels = expected
+            nodes = self.nodes.setdefault(task_type, {})
+            for node_id, seconds in node_times.items():
+                nodes.setdefault(node_id, NodeCost()).add(megapixels, seconds, self.decay)
+            self.observed[task_type] = self.observed.get(task_type, 0) + 1
+            save = time.monotonic() - self._saved_at >= self.save_interval
+        if save:
+            try:
+                self.save()
+            except Exception as e:
+                logger.warning(f"cannot save cost model {self.path}: {e}")
+
+    def predict_image(self, task_type: str, width: int, height: int) -> float:
+        """Expected GPU seconds of one image, default_image_seconds scaled by size before anything was observed"""
+        megapixels = width * height / 1e6
+        with self._lock:
+            nodes = self.nodes.get(task_type)
+            if nodes:
+                return sum(cost.predict(megapixels) for cost in nodes.values())
+        return self.default_image_seconds * megapixels
+
+    def predict_request(self, task_type: str, width: int, height: int, images: int) -> float:
+        return self.predict_image(task_type, width, height) * max(images, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {task_type: {"prompts": self.observed.get(task_type, 0),
+                                "image_seconds_1mp": round(sum(cost.predict(1.0) for cost in nodes.values()), 3)}
+                    for task_type, nodes in self.nodes.items()}
+
+
+class AdmissionController:
+    """
+    Estimates how long a new request would wait for the GPU from the images this process admitted and has
+    not rendered yet, priced with the current cost model, plus the prompts other clients have on ComfyUI.
+    Interactive requests only wait for interactive work (the scheduler serves them first).
+
+    A request whose wait exceeds the queue-time SLO of its priority class is rejected; bulk requests are
+    first deferred for up to defer_seconds, waiting for the queue to drain.
+    """
+    def __init__(self, model: CostModel, gpu_workers: int = settings.ADMISSION_GPU_WORKERS,
+                 slo_seconds: Optional[Dict[str, float]] = None, defer_seconds: float = settings.ADMISSION_DEFER_SECONDS,
+                 poll_seconds: float = 1.0) -> None:
+        self.model = model
+        self.gpu_workers = max(1, gpu_workers)
+        self.slo_seconds = slo_seconds if slo_seconds is not None else {
+            PRIORITY_INTERACTIVE: settings.ADMISSION_QUEUE_SLO_INTERACTIVE,
+            PRIORITY_BULK: settings.ADMISSION_QUEUE_SLO_BULK,
+        }
+        self.defer_seconds = defer_seconds
+        self.poll_seconds = poll_seconds
+        self._outstanding: Dict[str, list] = {}    # task_id -> [priority, task type, width, height, images left]
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.deferred = 0
+
+    @property
+    def enabled(self) -> bool:
+        return any(slo > 0 for slo in self.slo_seconds.values())
+
+    def queue_seconds(self, priority: str, external_seconds: float = 0.0) -> float:
+        """Expected wait for the GPU of a request admitted now"""
+        with self._lock:
+            waiting_for = [entry for entry in self._outstanding.values()
+                           if priority == PRIORITY_BULK or entry[0] == PRIORITY_INTERACTIVE]
+        work = sum(self.model.predict_request(task_type, width, height, images) for _, task_type, width, height, images in waiting_for)
+        return (work + external_seconds) / self.gpu_workers
+
+    async def admit(self, task_id: str, priority: str, task_type: str, width: int, height: int, images: int,
+                    external_seconds: float = 0.0) -> Dict[str, Any]:
+        """
+        Admit a request or tell why not
+        Returns:
+            dict: admitted, queue_seconds (expected wait), cost_seconds, eta_seconds (expected seconds to completion)
+        """
+        cost_seconds = self.model.predict_request(task_type, width, height, images)
+        slo = self.slo_seconds.get(priority, 0)
+        queue_seconds = self.queue_seconds(priority, external_seconds)
+        if slo > 0 and queue_seconds > slo and priority == PRIORITY_BULK and self.defer_seconds > 0:
+            self.deferred += 1
+            deadline = time.monotonic() + self.defer_seconds
+            while queue_seconds > slo and time.monotonic() < deadline:
+                await asyncio.sleep(self.poll_seconds)
+                # Prompts of other clients are not tracked, they are assumed to drain at the same pace
+                queue_seconds = self.queue_seconds(priority)
+        admitted = slo <= 0 or queue_seconds <= slo
+        if admitted:
+            with self._lock:
+                self._outstanding[task_id] = [priority, task_type, width, height, images]
+        else:
+            self.rejected += 1
+        return {"admitted": admitted, "queue_seconds": queue_seconds, "cost_seconds": cost_seconds,
+                "eta_seconds": queue_seconds + cost_seconds / self.gpu_workers}
+
+    def progress(self, task_id: str, images: int = 1) -> None:
+        """Images of an admitted request were rendered"""
+        with self._lock:
+            entry = self._outstanding.get(task_id)
+            if entry is not None:
+                entry[4] = max(entry[4] - images, 0)
+
+    def finish(self, task_id: str) -> None:
+        with self._lock:
+            self._outstanding.pop(task_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            outstanding = len(self._outstanding)
+        return {"outstanding": outstanding, "rejected": self.rejected, "deferred": self.deferred,
+                "queue_seconds": {priority: round(self.queue_seconds(priority), 3) for priority in self.slo_seconds}}
+
+
+def _job_formats(data: Dict[str, Any]) -> list:
+    """(width, height) of every format a job renders"""
+    if "sizes" in data:
+        return [(size["width"], size["height"]) if isinstance(size, dict) else tuple(size) for size in data["sizes"]]
+    return [(data.get("width", settings.IMAGE2POSTER_OUTPUT_SIZE_WIDTH), data.get("height", settings.IMAGE2POSTER_OUTPUT_SIZE_HEIGHT))]
+
+
+def estimate_backlog_seconds(jobs: Iterable[Dict[str, Any]], model: "CostModel") -> float:
+    """Expected GPU seconds of queued or running jobs, e.g. the ones a new job of the job store waits for"""
+    # Drafts are counted at full size and finalize calls by their chosen images, both err on the long side
+    return sum(model.predict_request(job["task_type"], int(width), int(height),
+                                     len(job["data"]["indices"]) if "indices" in job["data"] else int(job["data"].get("batchsize", 1)))
+               for job in jobs for width, height in _job_formats(job["data"]))
+
+
+# Shared by every processor of this process
+cost_model = CostModel()
+admission = AdmissionController(cost_model)
@@ -0,0 +1,71 @@
+import json
+import os
+import re
+import time
+from typing import Any, Dict, Optional
+
+from utils.logger import logger
+from utils.setting import settings
+
+
+DRAFT_ID_PATTERN = re.compile(r"[A-Za-z0-9_.-]{1,128}")
+
+
+class DraftStore:
+    """
+    What a finalize call needs to re-render images of a draft at full quality: the uploaded input image,
+    the full output size and the prompt, seed and placement of every image. One JSON file per draft,
+    shared by every worker of the host, removed once it is older than ttl seconds.
+    """
+    def __init__(self, root: str = settings.IMAGE2POSTER_DRAFT_DIR, ttl: float = settings.IMAGE2POSTER_DRAFT_TTL,
+                 prune_interval: float = 600.0) -> None:
+        self.root = root
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._pruned_at = 0.0
+
+    def _path(self, draft_id: str) -> str:
+        if not DRAFT_ID_PATTERN.fullmatch(draft_id) or draft_id.startswith("."):
+            raise ValueError(f"invalid draft_id: {draft_id!r}")
+        return os.path.join(self.root, f"{draft_id}.json")
+
+    def _expired(self, path: str) -> bool:
+        return self.ttl > 0 and time.time() - os.path.getmtime(path) > self.ttl
+
+    def put(self, draft_id: str, state: Dict[str, Any]) -> None:
+        path = self._path(draft_id)
+        os.makedirs(self.root, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(dict(state, draft_id=draft_id, created_at=time.time()), file, ensure_ascii=False)
+        os.replace(temporary, path)
+        if time.monotonic() - self._pruned_at >= self.prune_interval:
+            self.prune()
+
+    def get(self, draft_id: str) -> Optional[Dict[str, Any]]:
+        """Stored draft, None when it does not exist or expired"""
+        path = self._path(draft_id)
+        try:
+            if self._expired(path):
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def prune(self) -> int:
+        """Remove expired drafts, returns how many"""
+        self._pruned_at = time.monotonic()
+        removed = 0
+        if self.ttl <= 0 or not os.path.isdir(self.root):
+            return removed
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if name.endswith(".json") and self._expired(path):
+                    os.remove(path)
+                    removed += 1
+            except OSError as e:
+                logger.warning(f"cannot remove draft {path}: {e}")
+        return removed
@@ -0,0 +1,329 @@
+import asyncio
+import hashlib
+import io
+import ipaddress
+import os
+import posixpath
+import socket
+import urllib.parse
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, Iterator, Optional, Tuple
+
+import httpx
+
+from utils.setting import settings
+
+
+# Magic bytes of the image formats LoadImage reads -> (content type, file extension)
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png", ".png"),
+    (b"\xff\xd8\xff", "image/jpeg", ".jpg"),
+    (b"GIF87a", "image/gif", ".gif"),
+    (b"GIF89a", "image/gif", ".gif"),
+    (b"BM", "image/bmp", ".bmp"),
+)
+SNIFF_BYTES = 12
+CHUNK_SIZE = 1 << 16
+
+
+class ImageInputError(ValueError):
+    """The input image is missing, too large or not an image"""
+
+
+def sniff_image_type(head: bytes) -> Tuple[str, str]:
+    """
+    Content type and file extension of an image from its first bytes, whatever its name or headers say
+    Raises:
+        ImageInputError: When the bytes are not a PNG, JPEG, WEBP, GIF or BMP image
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp", ".webp"
+    for signature, content_type, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type, extension
+    raise ImageInputError("input is not a PNG, JPEG, WEBP, GIF or BMP image")
+
+
+@lru_cache(maxsize=256)
+def _file_digest(image_path: str, mtime_ns: int, size: int) -> str:
+    """sha256 of a file, cached while the file does not change"""
+    digest = hashlib.sha256()
+    with open(image_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_url(value: str) -> bool:
+    return value.startswith(("http://", "https://"))
+
+
+def check_image_url(url: str) -> None:
+    """
+    Refuse a URL the service must not download from: a host outside IMAGE_INPUT_URL_HOSTS (when set) and,
+    unless IMAGE_INPUT_ALLOW_PRIVATE_URLS, a host resolving to a loopback, private, link-local or reserved
+    address, e.g. a cloud metadata endpoint or an internal service. Every redirect is checked as well
+    Raises:
+        ImageInputError: When the URL is refused
+    """
+    parts = urllib.parse.urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https") or not host:
+        raise ImageInputError(f"not an http(s) URL: {parts.scheme}://{host}")
+    hosts = settings.IMAGE_INPUT_URL_HOSTS
+    if hosts and not any(host == allowed or (allowed.startswith(".") and host.endswith(allowed)) for allowed in hosts):
+        raise ImageInputError(f"input images are not downloaded from {host}")
+    if settings.IMAGE_INPUT_ALLOW_PRIVATE_URLS:
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or (443 if parts.scheme == "https" else 80),
+                                                               proto=socket.IPPROTO_TCP)}
+    except socket.gaierror as e:
+        raise ImageInputError(f"cannot resolve {host}: {e}")
+    for address in addresses:
+        if not ipaddress.ip_address(address.split("%")[0]).is_global:
+            raise ImageInputError(f"input images are not downloaded from {host}, it resolves to the non-public address {address}")
+
+
+async def _check_request(request: httpx.Request) -> None:
+    await asyncio.to_thread(check_image_url, str(request.url))
+
+
+def _check_request_sync(request: httpx.Request) -> None:
+    check_image_url(str(request.url))
+
+
+class ImageSource:
+    """
+    Input image of a process call: a local file, bytes, a binary file object or an HTTP(S) URL. None of
+    them goes through a temporary file: files and file objects are read in chunks by the upload, bytes are
+    sent as they are and URL downloads stream straight into the upload request (see download), hashed on
+    the way. The content type is sniffed from the first bytes, content over max_bytes is refused.
+
+    A file object that cannot seek is read into memory once, it has to be read again for the placement.
+    """
+    def __init__(self, path: Optional[str] = None, data: Optional[bytes] = None, file: Optional[BinaryIO] = None,
+                 url: Optional[str] = None, max_bytes: int = settings.IMAGE_INPUT_MAX_BYTES) -> None:
+        if sum(value is not None for value in (path, data, file, url)) != 1:
+            raise ImageInputError("exactly one of path, data, file and url is needed")
+        if url is not None and not _is_url(url):
+            raise ImageInputError(f"not an http(s) URL: {url}")
+        self.max_bytes = max_bytes
+        self.path = path
+        self.url = url
+        self.file = None
+        self.data = None
+        if file is not None and not (hasattr(file, 'seekable') and file.seekable()):
+            data = file.read(max_bytes + 1)
+        elif file is not None:
+            self.file = file
+        if data is not None:
+            self.data = data if isinstance(data, bytes) else bytes(data)
+        self.digest: Optional[str] = None      # sha256 of the content, known after compute_digest or a URL upload
+        self.product_profile = None             # Set by utils.placement.analyze_product, or by analyzer
+        # Computes product_profile from the content of a URL input while it is downloaded, so it is not downloaded again
+        self.analyzer: Optional[Callable[[BinaryIO], Any]] = None
+
+    @classmethod
+    def from_request(cls, data: Dict[str, Any]) -> "ImageSource":
+        """
+        The input image of process data: data['image'] (bytes, a file object, a URL or a path),
+        data['image_url'] or data['image_path'] (a path or a URL)
+        """
+        value = data.get("image", data.get("image_url"))
+        if value is None:
+            value = data["image_path"]
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return cls(data=value)
+        if hasattr(value, 'read'):
+            return cls(file=value)
+        value = str(value)
+        return cls(url=value) if _is_url(value) else cls(path=value)
+
+    @staticmethod
+    def request_key_data(data: Dict[str, Any]) -> Dict[str, Any]:
+        """Process data to build a singleflight key from: bytes are replaced by their hash, file objects by their identity"""
+        value = data.get("image")
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return dict(data, image=hashlib.sha256(value).hexdigest())
+        if hasattr(value, 'read'):
+            return dict(data, image=f"file:{id(value)}")
+        return data
+
+    @property
+    def kind(self) -> str:
+        if self.path is not None:
+            return "path"
+        if self.url is not None:
+            return "url"
+        return "bytes" if self.data is not None else "file"
+
+    @property
+    def label(self) -> str:
+        """Description for logs, URLs without their query (it often holds a signature)"""
+        if self.path is not None:
+            return self.path
+        if self.url is not None:
+            return urllib.parse.urlsplit(self.url)._replace(query="", fragment="").geturl()
+        return f"<{self.kind} input>"
+
+    @property
+    def stem(self) -> str:
+        """File name of the input without its extension, the upload gets the extension of the sniffed type"""
+        if self.path is not None:
+            name = os.path.basename(self.path)
+        elif self.url is not None:
+            name = posixpath.basename(urllib.parse.urlsplit(self.url).path)
+        else:
+            name = getattr(self.file, 'name', None)
+            name = os.path.basename(name) if isinstance(name, str) else ""
+        return os.path.splitext(name)[0] or "image"
+
+    def _size(self) -> int:
+        if self.path is not None:
+            return os.path.getsize(self.path)
+        if self.data is not None:
+            return len(self.data)
+        position = self.file.tell()
+        try:
+            return self.file.seek(0, os.SEEK_END)
+        finally:
+            self.file.seek(position)
+
+    def _head(self) -> bytes:
+        if self.path is not None:
+            with open(self.path, 'rb') as file:
+                return file.read(SNIFF_BYTES)
+        if self.data is not None:
+            return self.data[:SNIFF_BYTES]
+        self.file.seek(0)
+        try:
+            return self.file.read(SNIFF_BYTES)
+        finally:
+            self.file.seek(0)
+
+    def inspect(self) -> Tuple[str, str]:
+        """
+        Content type and extension of a local input (not a URL), checked against max_bytes
+        Raises:
+            ImageInputError: When it is too large or not an image
+        """
+        size = self._size()
+        if size > self.max_bytes:
+            raise ImageInputError(f"input image has {size} bytes, more than {self.max_bytes}")
+        return sniff_image_type(self._head())
+
+    def upload_content(self) -> Any:
+        """Content to hand to the httpx multipart upload of a bytes or file object input: the bytes, or the file object at its start"""
+        if self.data is not None:
+            return self.data
+        self.file.seek(0)
+        return self.file
+
+    def compute_digest(self) -> Optional[str]:
+        """sha256 of a local input, None for a URL before it was uploaded"""
+        if self.digest is None and self.url is None:
+            if self.path is not None:
+                stat = os.stat(self.path)
+                self.digest = _file_digest(os.path.abspath(self.path), stat.st_mtime_ns, stat.st_size)
+            elif self.data is not None:
+                self.digest = hashlib.sha256(self.data).hexdigest()
+            else:
+                digest = hashlib.sha256()
+                self.file.seek(0)
+                for chunk in iter(lambda: self.file.read(1 << 20), b""):
+                    digest.update(chunk)
+                self.file.seek(0)
+                self.digest = digest.hexdigest()
+        return self.digest
+
+    @asynccontextmanager
+    async def download(self) -> AsyncIterator[Tuple[str, str, AsyncIterator[bytes]]]:
+        """
+        Stream a URL input: (content type, extension, chunks). Only the first bytes are read before the chunks
+        are handed out, to sniff the type; the chunks are checked against max_bytes and hashed as they are
+        consumed, the digest is set once the last one was. With an analyzer the chunks are kept until the
+        last one, product_profile is computed from them and they are dropped.
+        Raises:
+            ImageInputError: When the URL is refused (see check_image_url), the download fails, is too large or is not an image
+        """
+        async with httpx.AsyncClient(timeout=settings.IMAGE_INPUT_TIMEOUT, follow_redirects=True,
+                                     event_hooks={'request': [_check_request]}) as client, \
+                client.stream("GET", self.url) as response:
+            if response.status_code != 200:
+                raise ImageInputError(f"cannot download {self.label}: HTTP {response.status_code}")
+            length = response.headers.get("content-length")
+            if length is not None and length.isdigit() and int(length) > self.max_bytes:
+                raise ImageInputError(f"input image has {length} bytes, more than {self.max_bytes}")
+            iterator = response.aiter_bytes(CHUNK_SIZE)
+            head = b""
+            async for chunk in iterator:
+                head += chunk
+                if len(head) >= SNIFF_BYTES:
+                    break
+            content_type, extension = sniff_image_type(head)
+
+            async def chunks() -> AsyncIterator[bytes]:
+                digest = hashlib.sha256(head)
+                size = len(head)
+                content = io.BytesIO(head) if self.analyzer is not None else None
+                yield head
+                async for chunk in iterator:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ImageInputError(f"input image has more than {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    if content is not None:
+                        content.write(chunk)
+                    yield chunk
+                self.digest = digest.hexdigest()
+                if content is not None:
+                    content.seek(0)
+                    try:
+                        self.product_profile = await asyncio.to_thread(self.analyzer, content)
+                    except Exception:
+                        pass     # open() downloads it again when the profile is needed
+            yield content_type, extension, chunks()
+
+    @contextmanager
+    def open(self) -> Iterator[BinaryIO]:
+        """
+        The content as a binary file, to decode it (the placement needs the pixels). A URL input is
+        downloaded again into memory, only when it is needed: set analyzer to have it analyzed by its upload
+        """
+        if self.path is not None:
+            with open(self.path, 'rb') as file:
+                yield file
+        elif self.data is not None:
+            yield io.BytesIO(self.data)
+        elif self.file is not None:
+            self.file.seek(0)
+            yield self.file
+        else:
+            buffer = io.BytesIO()
+            with httpx.Client(timeout=settings.IMAGE_INPUT_TIMEOUT, follow_redirects=True,
+                              event_hooks={'request': [_check_request_sync]}) as client, \
+                    client.stream("GET", self.url) as response:
+                response.raise_for_status()
+                for chunk in response.iter_bytes(CHUNK_SIZE):
+                    if buffer.tell() + len(chunk) > self.max_bytes:
+                        raise ImageInputError(f"input image has more than {self.max_bytes} bytes")
+                    buffer.write(chunk)
+            buffer.seek(0)
+            yield buffer
+
+
+def multipart_stream(boundary: str, fields: Dict[str, str], field: str, filename: str, content_type: str,
+                     chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """multipart/form-data body of form fields and one file whose content arrives in chunks, for a streamed upload"""
+    async def body() -> AsyncIterator[bytes]:
+        for name, value in fields.items():
+            yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n').encode('utf-8')
+        quoted = filename.replace('\\', '\\\\').replace('"', '\\"')
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{quoted}"\r\n'
+               f'Content-Type: {content_type}\r\n\r\n').encode('utf-8')
+        async for chunk in chunks:
+            yield chunk
+        yield f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return body()
@@ -0,0 +1,207 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from utils.setting import settings
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+ITEM_SUBMITTED = "submitted"    # Queued on ComfyUI, prompt_id is known
+ITEM_DONE = "done"              # Images saved, output paths are known
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    task_type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority, created_at);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id TEXT NOT NULL,
+    item_index INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    prompt_id TEXT,
+    params TEXT,
+    outputs TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (job_id, item_index)
+);
+"""
+
+
+class JobStore:
+    """
+    Durable job queue in one SQLite file, shared by every worker process of a host.
+
+    A worker claims a job with a lease and extends it with heartbeat(). When a worker dies its lease
+    expires and the job is claimed again; the items it already queued on ComfyUI are recorded with
+    their prompt_id, so the next worker can re-attach to them instead of rendering them again.
+    """
+    def __init__(self, db_path: str = settings.JOB_STORE_PATH, lease_seconds: float = settings.JOB_LEASE_SECONDS,
+                 max_attempts: int = settings.JOB_MAX_ATTEMPTS) -> None:
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # One short lived connection per call, so the store can be used from any thread or process
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, task_type: str, data: Dict[str, Any], job_id: Optional[str] = None, priority: int = 0) -> str:
+        """
+        Add a job, a lower priority value is claimed first
+        Returns:
+            str: job_id, also used as task_id of the process call
+        """
+        job_id = job_id or str(uuid.uuid4())
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, task_type, payload, status, priority, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, task_type, json.dumps(data), JOB_QUEUED, priority, now, now))
+        return job_id
+
+    def claim(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Lease the next queued job, or a running job whose lease expired
+        Returns:
+            dict: job_id, task_type, data and attempts, None when there is nothing to do
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Jobs whose worker died too often are given up
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_owner = NULL, updated_at = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (JOB_FAILED, "lease expired too many times", now, JOB_RUNNING, now, self.max_attempts))
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE (status = ? OR (status = ? AND lease_expires < ?)) AND attempts < ? "
+                "ORDER BY priority, created_at LIMIT 1",
+                (JOB_QUEUED, JOB_RUNNING, now, self.max_attempts)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? WHERE job_id = ?",
+                (JOB_RUNNING, worker_id, now + self.lease_seconds, now, row["job_id"]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return {"job_id": row["job_id"], "task_type": row["task_type"], "data": json.loads(row["payload"]),
+                "attempts": row["attempts"] + 1}
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """Extend the lease, returns False when the job is no longer leased by this worker"""
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE job_id = ? AND lease_owner = ? AND status = ?",
+                (now + self.lease_seconds, now, job_id, worker_id, JOB_RUNNING))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, result: Dict[str, Any]) -> None:
+        self._finish(job_id, worker_id, JOB_DONE, result=json.dumps(result))
+
+    def fail(self, job_id: str, worker_id: str, error: str, retry: bool = False) -> None:
+        """Mark a job failed, or put it back in the queue when retry is set and attempts are left"""
+        with self._connection() as conn:
+            row = conn.execute("SELECT attempts FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        status = JOB_QUEUED if retry and row is not None and row["attempts"] < self.max_attempts else JOB_FAILED
+        self._finish(job_id, worker_id, status, error=error)
+
+    def _finish(self, job_id: str, worker_id: str, status: str, result: Optional[str] = None, error: Optional[str] = None) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE job_id = ? AND lease_owner = ?",
+                (status, result, error, time.time(), job_id, worker_id))
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connection() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["data"] = json.loads(job.pop("payload"))
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["items"] = self.get_items(job_id)
+        return job
+
+    def record_item_submitted(self, job_id: str, item_index: int, prompt_id: str, params: Dict[str, Any]) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_items (job_id, item_index, status, prompt_id, params, outputs, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, NULL, ?)",
+                (job_id, item_index, ITEM_SUBMITTED, prompt_id, json.dumps(params), time.time()))
+
+    def record_item_done(self, job_id: str, item_index: int, outputs: Dict[str, Any]) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE job_items SET status = ?, outputs = ?, updated_at = ? WHERE job_id = ? AND item_index = ?",
+                (ITEM_DONE, json.dumps(outputs), time.time(), job_id, item_index))
+
+    def get_items(self, job_id: str) -> Dict[int, Dict[str, Any]]:
+        """Recorded batch items of a job, keyed by item index"""
+        with self._connection() as conn:
+            rows = conn.execute("SELECT * FROM job_items WHERE job_id = ?", (job_id,)).fetchall()
+        return {row["item_index"]: {
+                    "status": row["status"],
+                    "prompt_id": row["prompt_id"],
+                    "params": json.loads(row["params"]) if row["params"] else None,
+                    "outputs": json.loads(row["outputs"]) if row["outputs"] else None,
+                } for row in rows}
+
+    def jobs_ahead(self, job_id: str) -> List[Dict[str, Any]]:
+        """Running jobs and the queued jobs claimed before job_id, with their task_type and data"""
+        with self._connection() as conn:
+            job = conn.execute("SELECT priority, created_at FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if job is None:
+                return []
+            rows = conn.execute(
+                "SELECT job_id, task_type, payload FROM jobs WHERE job_id != ? AND "
+                "(status = ? OR (status = ? AND (priority < ? OR (priority = ? AND created_at <= ?))))",
+                (job_id, JOB_RUNNING, JOB_QUEUED, job["priority"], job["priority"], job["created_at"])).fetchall()
+        return [{"job_id": row["job_id"], "task_type": row["task_type"], "data": json.loads(row["payload"])} for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs per status"""
+        with self._connection() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
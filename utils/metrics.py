@@ -0,0 +1,109 @@
+import math
+import threading
+from typing import Any, Dict, Iterable, Optional
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram: values are counted in logarithmic buckets, so memory stays constant and every
+    reported percentile is within `precision` (relative) of the recorded value, from microseconds to hours.
+    Thread safe, values are in seconds.
+    """
+    def __init__(self, lowest: float = 1e-6, highest: float = 3600.0, precision: float = 0.01) -> None:
+        self.lowest = lowest
+        self.highest = highest
+        self.precision = precision
+        self._log_base = math.log1p(precision)
+        self._bucket_count = int(math.log(highest / lowest) / self._log_base) + 2
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def _bucket(self, value: float) -> int:
+        if value <= self.lowest:
+            return 0
+        return min(int(math.log(value / self.lowest) / self._log_base) + 1, self._bucket_count - 1)
+
+    def _bucket_value(self, bucket: int) -> float:
+        if bucket == 0:
+            return self.lowest
+        # Geometric middle of the bucket
+        return self.lowest * math.exp((bucket - 0.5) * self._log_base)
+
+    def record(self, value: float, count: int = 1) -> None:
+        value = max(0.0, float(value))
+        bucket = self._bucket(value)
+        with self._lock:
+            self._counts[bucket] = self._counts.get(bucket, 0) + count
+            self.count += count
+            self.total += value * count
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        with other._lock:
+            counts = dict(other._counts)
+            count, total, low, high = other.count, other.total, other.min, other.max
+        with self._lock:
+            for bucket, bucket_count in counts.items():
+                self._counts[bucket] = self._counts.get(bucket, 0) + bucket_count
+            self.count += count
+            self.total += total
+            if low is not None:
+                self.min = low if self.min is None else min(self.min, low)
+                self.max = high if self.max is None else max(self.max, high)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        with self._lock:
+            if self.count == 0:
+                return None
+            rank = max(1, math.ceil(self.count * percent / 100.0))
+            seen = 0
+            for bucket in sorted(self._counts):
+                seen += self._counts[bucket]
+                if seen >= rank:
+                    return min(max(self._bucket_value(bucket), self.min), self.max)
+            return self.max
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts.clear()
+            self.count = 0
+            self.total = 0.0
+            self.min = None
+            self.max = None
+
+    def buckets(self) -> Iterable[tuple]:
+        """(upper bound in seconds, count) of every non-empty bucket, in increasing order"""
+        with self._lock:
+            counts = sorted(self._counts.items())
+        return [(self.lowest * math.exp(bucket * self._log_base), count) for bucket, count in counts]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """State for a JSON file, from_dict restores it"""
+        with self._lock:
+            return {"lowest": self.lowest, "highest": self.highest, "precision": self.precision,
+                    "counts": {str(bucket): count for bucket, count in self._counts.items()},
+                    "count": self.count, "total": self.total, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, state: Dict[str, Any]) -> "LatencyHistogram":
+        histogram = cls(state["lowest"], state["highest"], state["precision"])
+        histogram._counts = {int(bucket): count for bucket, count in state["counts"].items()}
+        histogram.count, histogram.total, histogram.min, histogram.max = state["count"], state["total"], state["min"], state["max"]
+        return histogram
+
+    def snapshot(self, percentiles: Iterable[float] = (50, 95, 99)) -> Dict[str, Optional[float]]:
+        result = {
+            "count": self.count,
+            "mean": round(self.total / self.count, 6) if self.count else None,
+            "min": self.min,
+            "max": self.max,
+        }
+        for percent in percentiles:
+            value = self.percentile(percent)
+            result[f"p{percent:g}"] = round(value, 6) if value is not None else None
+        return result
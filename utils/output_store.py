@@ -0,0 +1,120 @@
+import hashlib
+import os
+import shutil
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Dict, Optional
+
+import yaml
+from PIL import Image, features
+
+from utils.logger import logger
+from utils.setting import settings
+
+
+FORMAT_EXTENSIONS = {"webp": "webp", "avif": "avif", "jpeg": "jpg", "png": "png"}
+
+
+def build_derivative(source_path: str, target_path: str, spec: Dict[str, Any]) -> str:
+    """Write one rendition of source_path, runs in a worker process"""
+    if os.path.exists(target_path):
+        return target_path
+    image_format = spec.get("format", "webp").lower()
+    with Image.open(source_path) as image:
+        image.load()
+        if spec.get("max_size"):
+            image.thumbnail((spec["max_size"], spec["max_size"]), Image.LANCZOS)
+        if image_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        save_kwargs = {}
+        if image_format in ("webp", "avif", "jpeg"):
+            save_kwargs["quality"] = int(spec.get("quality", 80))
+        tmp_path = f"{target_path}.{os.getpid()}.tmp"
+        image.save(tmp_path, format=image_format.upper(), **save_kwargs)
+    os.replace(tmp_path, target_path)   # Atomic, concurrent writers of the same rendition do not clash
+    return target_path
+
+
+class OutputStore:
+    """
+    Content-addressed store for generated images.
+
+    Every image is written once under objects/<sha256[:2]>/<sha256>.<ext>, identical outputs share one
+    file and the per-task output path is a hard link to it. Derivatives (thumbnails, resized and lossy
+    versions) are built by a process pool and stored by the hash of their source as well.
+    """
+    def __init__(self, root: str = settings.OUTPUT_STORE_ROOT, renditions_path: str = settings.OUTPUT_STORE_RENDITIONS,
+                 max_workers: int = settings.OUTPUT_STORE_WORKERS) -> None:
+        self.root = root
+        self.max_workers = max_workers
+        with open(renditions_path, 'r', encoding='utf-8') as file:
+            config = yaml.safe_load(file) or {}
+        self.apply_to = set(config.get("apply_to") or [])
+        self.derivatives = {}
+        for name, spec in (config.get("derivatives") or {}).items():
+            image_format = spec.get("format", "webp").lower()
+            if image_format not in FORMAT_EXTENSIONS:
+                raise ValueError(f"Unsupported rendition format {image_format} of {name}")
+            if image_format in ("webp", "avif") and not features.check(image_format):
+                logger.warning(f"output store: Pillow has no {image_format} support, rendition {name} is skipped")
+                continue
+            self.derivatives[name] = spec
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def _object_path(self, digest: str, extension: str, suffix: str = "") -> str:
+        return os.path.join(self.root, "objects", digest[:2], f"{digest}{suffix}.{extension}")
+
+    def put(self, data: bytes, extension: str = "png") -> tuple:
+        """
+        Store image bytes once
+        Returns:
+            tuple: (sha256 hex digest, path of the stored object)
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest, extension)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        return digest, path
+
+    @staticmethod
+    def link(object_path: str, target_path: str) -> None:
+        """Expose a stored object under another path, without copying when the file system allows it"""
+        os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(object_path, target_path)
+        except OSError:
+            shutil.copyfile(object_path, target_path)
+
+    def wants_derivatives(self, result_name: str) -> bool:
+        return bool(self.derivatives) and (not self.apply_to or result_name in self.apply_to)
+
+    def submit_derivatives(self, digest: str, object_path: str) -> Dict[str, Future]:
+        """Queue every configured rendition of a stored object on the process pool"""
+        futures = {}
+        for name, spec in self.derivatives.items():
+            extension = FORMAT_EXTENSIONS[spec.get("format", "webp").lower()]
+            target_path = self._object_path(digest, extension, suffix=f"-{name}")
+            if os.path.exists(target_path):
+                future = Future()
+                future.set_result(target_path)
+            else:
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                future = self.pool.submit(build_derivative, object_path, target_path, spec)
+            futures[name] = future
+        return futures
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
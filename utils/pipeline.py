@@ -0,0 +1,157 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from utils.metrics import LatencyHistogram
+
+
+class StageError(Exception):
+    """Raised by a stage handler to abort the pipeline with a user facing message"""
+    def __init__(self, message: str, detail: Optional[str] = None) -> None:
+        super().__init__(message)
+        self.message = message
+        self.detail = detail or message
+
+
+class PipelineStage:
+    def __init__(self, name: str, handler: Callable[[Any], Awaitable[Optional[Iterable[Any]]]], workers: int = 1) -> None:
+        """
+        One step of a pipeline
+        Args:
+            name: Stage name, used for occupancy statistics
+            handler: Coroutine function receiving one item and returning the items for the next stage (fan-out allowed)
+            workers: Number of items this stage works on at the same time
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, int(workers))
+
+
+class StageStats:
+    def __init__(self, name: str, workers: int) -> None:
+        self.name = name
+        self.workers = workers
+        self.processed = 0
+        self.in_flight = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self.latency = LatencyHistogram()     # Handler time per item
+
+    def as_dict(self, elapsed: float) -> Dict[str, Any]:
+        capacity = elapsed * self.workers
+        return {
+            "processed": self.processed,
+            "in_flight": self.in_flight,
+            "busy_seconds": round(self.busy_seconds, 4),
+            "occupancy": round(self.busy_seconds / capacity, 4) if capacity > 0 else 0.0,
+            "max_queue_depth": self.max_queue_depth,
+            "latency": self.latency.snapshot(percentiles=(50, 99)),
+        }
+
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Run items through a chain of stages connected by bounded queues.
+
+    Every stage pulls from its own queue, so while the last stage saves the results of item k
+    the first stage can already work on item k+n. The bounded queues keep fast stages from
+    running too far ahead of slow ones.
+    """
+    def __init__(self, name: str, stages: List[PipelineStage], queue_size: int = 2) -> None:
+        self.name = name
+        self.stages = stages
+        self.queue_size = max(1, int(queue_size))
+        self.stage_stats = {stage.name: StageStats(stage.name, stage.workers) for stage in stages}
+        self._queues: List[asyncio.Queue] = []
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+    async def run(self, items: Iterable[Any]) -> List[Any]:
+        """
+        Feed items into the first stage and wait until every stage is drained
+        Returns:
+            list: Outputs of the last stage, in completion order
+        Raises:
+            Exception: The first exception raised by any stage handler, all other workers are cancelled
+        """
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        outputs: List[Any] = []
+        self._started_at = time.perf_counter()
+        self._finished_at = None
+
+        async def feed():
+            for item in items:
+                await self._queues[0].put(item)
+            for _ in range(self.stages[0].workers):
+                await self._queues[0].put(_DONE)
+
+        async def work(index: int):
+            stage = self.stages[index]
+            stats = self.stage_stats[stage.name]
+            inbox = self._queues[index]
+            outbox = self._queues[index + 1] if index + 1 < len(self.stages) else None
+            while True:
+                item = await inbox.get()
+                if item is _DONE:
+                    break
+                stats.in_flight += 1
+                started = time.perf_counter()
+                try:
+                    produced = await stage.handler(item)
+                finally:
+                    stats.in_flight -= 1
+                    stats.busy_seconds += time.perf_counter() - started
+                stats.processed += 1
+                stats.latency.record(time.perf_counter() - started)
+                for out in produced or ():
+                    if outbox is None:
+                        outputs.append(out)
+                    else:
+                        await outbox.put(out)
+                        next_stats = self.stage_stats[self.stages[index + 1].name]
+                        next_stats.max_queue_depth = max(next_stats.max_queue_depth, outbox.qsize())
+            remaining[index] -= 1
+            if remaining[index] == 0 and outbox is not None:
+                for _ in range(self.stages[index + 1].workers):
+                    await outbox.put(_DONE)
+
+        tasks = [asyncio.ensure_future(feed())]
+        for index, stage in enumerate(self.stages):
+            tasks.extend(asyncio.ensure_future(work(index)) for _ in range(stage.workers))
+
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._finished_at = time.perf_counter()
+        return outputs
+
+    def queue_depths(self) -> Dict[str, int]:
+        """Current number of items waiting in front of each stage"""
+        return {stage.name: queue.qsize() for stage, queue in zip(self.stages, self._queues)}
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Stage occupancy of the current (or last) run
+        Returns:
+            dict: elapsed seconds and, per stage, processed items, busy seconds and occupancy (busy / (elapsed * workers))
+        """
+        if self._started_at is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._finished_at or time.perf_counter()) - self._started_at
+        return {
+            "pipeline": self.name,
+            "elapsed_seconds": round(elapsed, 4),
+            "stages": {name: stats.as_dict(elapsed) for name, stats in self.stage_stats.items()},
+        }
@@ -0,0 +1,203 @@
+import os
+import re
+from functools import lru_cache
+from typing import Dict, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from utils.image_source import ImageSource
+from utils.setting import settings
+
+
+PLACEMENT_MODES = ("llm", "local", "llm_with_fallback")
+
+# Composition keywords of the image prompt -> product center on the canvas (percent) or share of the canvas it fills
+HORIZONTAL_KEYWORDS = (
+    (re.compile(r"\b(left)\b"), 33),
+    (re.compile(r"\b(right)\b"), 67),
+)
+VERTICAL_KEYWORDS = (
+    (re.compile(r"\b(top|above|sky|floating|hanging|flying)\b"), 40),
+    (re.compile(r"\b(table|floor|ground|desk|shelf|counter|podium|pedestal|sand|grass|bottom|standing|sitting|placed)\b"), 64),
+)
+CENTER_KEYWORDS = re.compile(r"\b(center|centered|centre|centred|middle)\b")
+CLOSE_UP_KEYWORDS = re.compile(r"\b(close-up|closeup|close up|macro|hero shot|detail|details)\b")
+WIDE_KEYWORDS = re.compile(r"\b(landscape|scene|scenery|room|wide|panorama|panoramic|city|street|beach|mountains?|forest|outdoors?)\b")
+
+ANALYSIS_SIZE = 256     # Longest side the product image is analyzed at
+EDGE_MARGIN = 0.04      # Smallest gap between the product and the canvas edge, share of the canvas
+
+
+class ProductProfile:
+    """Bounding box of the product in its image, fractions of the image size, and the image size in pixels"""
+    __slots__ = ("left", "top", "right", "bottom", "width", "height")
+
+    def __init__(self, left: float, top: float, right: float, bottom: float, width: int, height: int) -> None:
+        self.left, self.top, self.right, self.bottom = left, top, right, bottom
+        self.width, self.height = width, height
+
+    @property
+    def aspect_ratio(self) -> float:
+        return ((self.right - self.left) * self.width) / max((self.bottom - self.top) * self.height, 1e-6)
+
+
+def _foreground_mask(pixels: np.ndarray) -> np.ndarray:
+    """
+    Product pixels of an RGB or RGBA array: the alpha channel of cut-out images, otherwise the pixels that
+    differ from the background color, estimated as the median of the image border
+    """
+    if pixels.shape[2] == 4 and pixels[..., 3].min() < 250:
+        return pixels[..., 3] > 127
+    rgb = pixels[..., :3].astype(np.int16)
+    border = max(1, int(min(rgb.shape[:2]) * 0.04))
+    frame = np.concatenate([rgb[:border].reshape(-1, 3), rgb[-border:].reshape(-1, 3),
+                            rgb[:, :border].reshape(-1, 3), rgb[:, -border:].reshape(-1, 3)])
+    background = np.median(frame, axis=0)
+    distance = np.abs(rgb - background).sum(axis=2)
+    # Busy borders (no plain backdrop) need a larger difference to count as product
+    threshold = max(60.0, float(np.percentile(np.abs(frame - background).sum(axis=1), 95)) * 1.5)
+    return distance > threshold
+
+
+def _bounds(counts: np.ndarray, trim: float = 0.01) -> Tuple[float, float]:
+    """Span of a mask projection holding all but `trim` of its pixels at each end, fractions of its length"""
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    start = int(np.searchsorted(cumulative, total * trim, side="right"))
+    end = int(np.searchsorted(cumulative, total * (1 - trim), side="left")) + 1
+    return start / len(counts), min(end, len(counts)) / len(counts)
+
+
+def profile_product(file) -> ProductProfile:
+    """Product bounding box of an image file or binary file object"""
+    with Image.open(file) as image:
+        width, height = image.size
+        image.draft("RGB", (ANALYSIS_SIZE, ANALYSIS_SIZE))     # JPEG decodes straight to a smaller size
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        image.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE))
+        pixels = np.asarray(image)
+    mask = _foreground_mask(pixels)
+    share = mask.mean()
+    if share < 0.005 or share > 0.98:
+        # No product found, or nothing but product: the whole image is the product
+        return ProductProfile(0.0, 0.0, 1.0, 1.0, width, height)
+    left, right = _bounds(mask.sum(axis=0))
+    top, bottom = _bounds(mask.sum(axis=1))
+    return ProductProfile(left, top, right, bottom, width, height)
+
+
+@lru_cache(maxsize=256)
+def _profile_file(image_path: str, mtime_ns: int, size: int) -> ProductProfile:
+    return profile_product(image_path)
+
+
+def analyze_product(image: Union[str, ImageSource]) -> ProductProfile:
+    """
+    Product bounding box of an image file, cached while the file does not change, or of an ImageSource,
+    cached on the source
+    """
+    image_path = image if isinstance(image, str) else image.path
+    if image_path is not None:
+        stat = os.stat(image_path)
+        return _profile_file(image_path, stat.st_mtime_ns, stat.st_size)
+    if image.product_profile is None:
+        with image.open() as file:
+            image.product_profile = profile_product(file)
+    return image.product_profile
+
+
+class LocalPlacementEstimator:
+    """
+    Product position and scale without an LLM call: the product bounding box of the input image, composition
+    rules for the canvas shape and keywords of the image prompt. Takes a few milliseconds per image.
+
+    The values mean what LayerUtility: ImageBlendAdvance V2 makes of them: x_percent and y_percent place the
+    center of the whole product image, scale resizes it relative to its own pixel size.
+    """
+    def __init__(self, scale_min: float = settings.IMAGE2POSTER_SCALE_MIN, scale_max: float = settings.IMAGE2POSTER_SCALE_MAX) -> None:
+        self.scale_min = scale_min
+        self.scale_max = scale_max
+
+    @staticmethod
+    def composition(flux_prompt: str, width: int, height: int) -> Tuple[float, float, float]:
+        """
+        Returns:
+            tuple: product center x and y (percent of the canvas) and the share of the canvas the product fills
+        """
+        prompt = flux_prompt.lower()
+        x = 50.0
+        y = 60.0 if height > width * 1.15 else 55.0     # Products rest slightly below the middle, more so on tall posters
+        fill = 0.5
+        if width > height * 1.15:
+            fill = 0.45
+        for pattern, value in HORIZONTAL_KEYWORDS:
+            if pattern.search(prompt):
+                x = value
+                break
+        for pattern, value in VERTICAL_KEYWORDS:
+            if pattern.search(prompt):
+                y = value
+                break
+        if CENTER_KEYWORDS.search(prompt):
+            x, y = 50.0, 50.0
+        if CLOSE_UP_KEYWORDS.search(prompt):
+            fill = 0.65
+        elif WIDE_KEYWORDS.search(prompt):
+            fill = 0.38
+        return x, y, fill
+
+    def estimate(self, image: Union[str, ImageSource], flux_prompt: str, width: int, height: int) -> Dict[str, float]:
+        """
+        Returns:
+            dict: {'x_percent': int, 'y_percent': int, 'scale': float}, the format of PositionGenerator.generator_position
+        """
+        profile = analyze_product(image)
+        target_x, target_y, fill = self.composition(flux_prompt or "", width, height)
+
+        # Product size on the canvas at scale 1, fractions of the canvas
+        product_width = (profile.right - profile.left) * profile.width / width
+        product_height = (profile.bottom - profile.top) * profile.height / height
+        scale = fill / max(product_width, product_height, 1e-6)
+        scale = min(max(scale, self.scale_min), self.scale_max)
+        return self._fit(profile, target_x / 100, target_y / 100, scale, width, height)
+
+    @staticmethod
+    def _fit(profile: ProductProfile, target_x: float, target_y: float, scale: float, width: int, height: int) -> Dict[str, float]:
+        """Keep the product inside the canvas, then move the image center so the product center lands on the target"""
+        product_width = (profile.right - profile.left) * profile.width / width
+        product_height = (profile.bottom - profile.top) * profile.height / height
+        half_width = min(product_width * scale / 2 + EDGE_MARGIN, 0.5)
+        half_height = min(product_height * scale / 2 + EDGE_MARGIN, 0.5)
+        center_x = min(max(target_x, half_width), 1 - half_width)
+        center_y = min(max(target_y, half_height), 1 - half_height)
+        offset_x, offset_y = _product_offset(profile, scale, width, height)
+        return {
+            'x_percent': int(round(min(max(center_x - offset_x, 0.0), 1.0) * 100)),
+            'y_percent': int(round(min(max(center_y - offset_y, 0.0), 1.0) * 100)),
+            'scale': round(scale, 3),
+        }
+
+    def adapt(self, position: Dict[str, float], image: Union[str, ImageSource], width: int, height: int,
+              target_width: int, target_height: int) -> Dict[str, float]:
+        """
+        A placement for a width x height canvas moved to a canvas of another size or aspect ratio: the product
+        keeps its share of the canvas side that limits it and its relative position, moved inward when it
+        would leave the canvas, and its scale kept within scale_min and scale_max. One LLM placement serves
+        every format of a request this way.
+        """
+        if (width, height) == (target_width, target_height):
+            return dict(position)
+        profile = analyze_product(image)
+        scale = position['scale'] * min(target_width / width, target_height / height)
+        scale = min(max(scale, self.scale_min), self.scale_max)
+        # Product center of the source placement, fractions of the canvas
+        offset_x, offset_y = _product_offset(profile, position['scale'], width, height)
+        return self._fit(profile, position['x_percent'] / 100 + offset_x, position['y_percent'] / 100 + offset_y,
+                         scale, target_width, target_height)
+
+
+def _product_offset(profile: ProductProfile, scale: float, width: int, height: int) -> Tuple[float, float]:
+    """Distance from the image center to the product center on the canvas, fractions of the canvas"""
+    return (((profile.left + profile.right) / 2 - 0.5) * profile.width * scale / width,
+            ((profile.top + profile.bottom) / 2 - 0.5) * profile.height * scale / height)
@@ -15,6 +15,7 @@ if __name__ == "__main__" or not __package__:
 
 try:
     from utils.setting import settings
+    from utils.rate_limiter import chat_completion
 except ModuleNotFoundError as e:
     print(f"Import error: {e}")
     print("Please ensure this file is run from the project root directory")
@@ -102,8 +103,9 @@ class PositionGenerator():
 
         message = self._prepare_messages(system_prompt=system_prompt, user_prompt= real_user_template_prompt, image_urls=image_url)
 
-        # Call Azure OpenAI API
-        response = self.model_client.chat.completions.create(
+        # Call Azure OpenAI API behind the host-wide rate limiter
+        response = chat_completion(
+            self.model_client,
             model=self.model_name,
             response_format={ "type": "json_object" },     # Response types: 'text', 'json_object' and 'json_schema'
             messages=message
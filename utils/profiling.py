@@ -0,0 +1,218 @@
+import asyncio
+import collections
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional
+
+from utils.logger import logger
+from utils.metrics import LatencyHistogram
+from utils.setting import settings
+
+
+# Threads of this module, left out of the profiles
+OWN_THREAD_PREFIXES = ("loop-lag-watchdog", "sampling-profiler")
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop runs a callback scheduled interval seconds ahead. A lag means some
+    callback held the loop, e.g. a blocking call made from async code.
+
+    A watchdog thread logs the stack of the loop thread once a stall passes threshold seconds, while the
+    blocking call is still on it.
+    """
+    def __init__(self, interval: float = 0.05, threshold: float = 0.2) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = LatencyHistogram()
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        """Start monitoring the running loop, must be called from a coroutine"""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopping.clear()
+        self.loop = asyncio.get_running_loop()
+        self._task = self.loop.create_task(self._measure())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _measure(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.lag.record(lag)
+            self._heartbeat = now
+            if lag >= self.threshold:
+                logger.warning(f"event loop blocked for {lag:.3f}s")
+
+    def _watch(self) -> None:
+        reported = None
+        while not self._stopping.wait(self.threshold / 4):
+            heartbeat = self._heartbeat
+            if time.monotonic() - heartbeat < self.interval + self.threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "unavailable\n"
+            logger.warning(f"event loop blocked for more than {self.threshold:.3f}s, loop thread stack:\n{stack}")
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        snapshot = self.lag.snapshot(percentiles=(50, 99, 99.9))
+        snapshot["stalls"] = self.stalls
+        return snapshot
+
+
+_monitors: Dict[int, LoopLagMonitor] = {}
+
+
+def ensure_loop_lag_monitor() -> Optional[LoopLagMonitor]:
+    """
+    Monitor of the running loop, started on first use when LOOP_LAG_MONITOR_ENABLED is set.
+    Cheap to call from every request.
+    """
+    if not settings.LOOP_LAG_MONITOR_ENABLED:
+        return None
+    loop = asyncio.get_running_loop()
+    monitor = _monitors.get(id(loop))
+    if monitor is None or monitor.loop is not loop:
+        monitor = LoopLagMonitor(interval=settings.LOOP_LAG_INTERVAL, threshold=settings.LOOP_LAG_THRESHOLD)
+        _monitors[id(loop)] = monitor
+        monitor.start()
+        logger.info(f"loop lag monitor started, threshold {monitor.threshold}s")
+    return monitor
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread (the loop thread and the to_thread workers) at a fixed interval
+    and writes them in the folded format of flamegraph.pl and speedscope: 'thread;outer;...;inner count'.
+    Only one profile runs at a time in a process.
+    """
+    _active_lock = threading.Lock()
+
+    def __init__(self, output_dir: str = settings.PROFILER_OUTPUT_DIR, interval: float = settings.PROFILER_INTERVAL) -> None:
+        self.output_dir = output_dir
+        self.interval = interval
+        self.samples: Dict[str, int] = collections.Counter()
+        self._names = {}    # code object -> frame name
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._owns_lock = False
+
+    def _frame_name(self, frame) -> str:
+        code = frame.f_code
+        name = self._names.get(code)
+        if name is None:
+            name = f"{code.co_name} ({os.path.relpath(code.co_filename)}:{code.co_firstlineno})"
+            self._names[code] = name
+        return name
+
+    def _sample(self) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if names.get(thread_id, "").startswith(OWN_THREAD_PREFIXES):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.samples[";".join(reversed(stack))] += 1
+
+    def _run(self, deadline: Optional[float]) -> None:
+        while not self._stopping.wait(self.interval):
+            self._sample()
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+
+    def start(self, seconds: Optional[float] = None) -> bool:
+        """
+        Start sampling, for `seconds` or until stop()
+        Returns:
+            bool: False when another profile is already running
+        """
+        if not SamplingProfiler._active_lock.acquire(blocking=False):
+            return False
+        self._owns_lock = True
+        self._stopping.clear()
+        deadline = time.monotonic() + seconds if seconds else None
+        self._thread = threading.Thread(target=self._run, args=(deadline,), name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, name: str = "profile") -> Optional[str]:
+        """
+        Stop sampling and write the folded stacks
+        Returns:
+            str: Path of the written file, None when nothing was sampled
+        """
+        if self._thread is None:
+            return None
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        if self._owns_lock:
+            self._owns_lock = False
+            SamplingProfiler._active_lock.release()
+        if not self.samples:
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded")
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in sorted(self.samples.items()):
+                file.write(f"{stack} {count}\n")
+        logger.info(f"profile written to {path}, {sum(self.samples.values())} samples")
+        return path
+
+    def wait(self) -> None:
+        """Block until a profile started with a duration has run out"""
+        if self._thread is not None:
+            self._thread.join()
+
+
+def profile_for(seconds: float, name: str = "on-demand") -> bool:
+    """
+    Profile the whole process for `seconds` in the background, e.g. from a signal handler
+    Returns:
+        bool: False when another profile is already running
+    """
+    profiler = SamplingProfiler()
+    if not profiler.start(seconds):
+        return False
+
+    def finish() -> None:
+        profiler.wait()
+        profiler.stop(name)
+    threading.Thread(target=finish, name="sampling-profiler-writer", daemon=True).start()
+    logger.info(f"profiling for {seconds}s")
+    return True
+
+
+def maybe_profile_call() -> Optional[SamplingProfiler]:
+    """A running profiler for a PROFILER_SAMPLE_RATE fraction of calls, None for the others"""
+    if settings.PROFILER_SAMPLE_RATE <= 0 or random.random() >= settings.PROFILER_SAMPLE_RATE:
+        return None
+    profiler = SamplingProfiler()
+    return profiler if profiler.start() else None
@@ -1,27 +1,87 @@
+import asyncio
+import sys
+from pathlib import Path
+
+# Add project root directory to path if running this file directly
+if __name__ == "__main__" or not __package__:
+    current_file = Path(__file__).resolve()
+    project_root = current_file.parents[1]  # Go up one level to project root directory
+    sys.path.insert(0, str(project_root))  # Use insert(0,...) to ensure project path has highest priority
+
+try:
+    from utils.setting import settings
+    from utils.rate_limiter import chat_completion
+    from utils.singleflight import get_singleflight, make_key
+except ModuleNotFoundError as e:
+    print(f"Import error: {e}")
+    print("Please ensure this file is run from the project root directory")
+    sys.exit(1)
+
 
 class GeneratePrompt():
-    def __init__(self, model_client, model_name, max_retry_time=5) -> None:
+    CONTENT_REVIEW_MESSAGE = "The content you generated does not comply with content review standards, please use appropriate prompts"
+    MAX_CHOICES_PER_REQUEST = 128   # Upper bound of the chat API 'n' parameter
+
+    def __init__(self, model_client, model_name, max_retry_time=5, candidates=1) -> None:
         self.max_retry_time = max_retry_time     # Maximum retry attempts (5) when the large language model returns an exception
         self.model_client = model_client
         self.model_name = model_name
-        
+        self.candidates = max(1, int(candidates))   # Candidates requested per prompt, the first valid one is used
+        # Identical requests in flight share one LLM call
+        self.llm_flight = get_singleflight("llm", enabled=settings.SINGLEFLIGHT_ENABLED)
+
     async def generate_prompt(self, system_prompt: str, input_prompt: str) -> str:
+        prompts = await self.generate_prompts(system_prompt, input_prompt, count=1)
+        return prompts[0]
+
+    async def generate_prompts(self, system_prompt: str, input_prompt: str, count: int) -> list:
+        """
+        Generate `count` prompts with as few LLM round trips as possible.
+
+        Every request asks for `count * candidates` choices at once (chat API 'n' parameter), the first valid
+        choices are used. Only the prompts that are still missing are requested again, with the validation
+        message of a rejected choice appended to the input prompt.
+
+        Args:
+            system_prompt: System prompt, can be any language
+            input_prompt: User input prompt, can be any language
+            count: Number of prompts to return
+        Returns:
+            list: `count` prompts, a missing prompt is None. If the content review rejected every choice, the
+                  review message is returned in place of the prompt
+        """
         raw_input_prompt = input_prompt
+        prompts = []
+        review_message = None
         for i in range(self.max_retry_time):
-            prompt_message = await self._generate_prompt(system_prompt, input_prompt)
-            status, message = self.validate_prompt_format(prompt_message)
-            if status:
-                return message
-            if "The content you generated does not comply with content review standards, please use appropriate prompts" in message:
-                return message
-            if "Error validating prompt format" in message:   
-                print(message)
-                return None
-            input_prompt = raw_input_prompt + ", " + message
-            print(f"error_prompt is: {prompt_message}")
-            print("Regenerating prompt...")
+            missing = count - len(prompts)
+            n = min(missing * self.candidates, self.MAX_CHOICES_PER_REQUEST)
+            key = make_key("generate_prompts", self.model_name, system_prompt, input_prompt, n)
+            prompt_messages = await self.llm_flight.do(key, lambda: self._generate_prompts(system_prompt, input_prompt, n))
+            feedback = None
+            for prompt_message in prompt_messages:
+                status, message = self.validate_prompt_format(prompt_message)
+                if status:
+                    if len(prompts) < count:
+                        prompts.append(message)
+                    continue
+                if self.CONTENT_REVIEW_MESSAGE in message:
+                    review_message = message
+                    continue
+                if "Error validating prompt format" in message:
+                    print(message)
+                    continue
+                feedback = feedback or message
+                print(f"error_prompt is: {prompt_message}")
+            if len(prompts) >= count:
+                return prompts
+            if review_message is not None and not prompts:
+                return [review_message] * count
+            if feedback is not None:
+                input_prompt = raw_input_prompt + ", " + feedback
+            print(f"Regenerating {count - len(prompts)} prompt(s)...")
         print(f"Attempted more than the maximum number of times ({self.max_retry_time}), unable to obtain the corresponding prompt from openai.")
-        return None
+        return prompts + [None] * (count - len(prompts))
 
     async def _generate_prompt(self, system_prompt: str, input_prompt: str) -> str:
         """
@@ -34,6 +94,17 @@ class GeneratePrompt():
         Returns:
             str: Optimized English prompt string
         """
+        prompts = await self._generate_prompts(system_prompt, input_prompt, 1)
+        return prompts[0]
+
+    async def _generate_prompts(self, system_prompt: str, input_prompt: str, n: int) -> list:
+        """
+        Same as _generate_prompt, but returns n independent choices of one chat completion request
+
+        Returns:
+            list: n optimized English prompt strings
+        """
+        response = None
         try:
             # Build prompt information
             messages = [
@@ -47,30 +118,39 @@ class GeneratePrompt():
                 }
             ]
             
-            # Call Azure OpenAI API
-            response = self.model_client.chat.completions.create(
+            # Call Azure OpenAI API in a worker thread, the client is synchronous and would block the event loop.
+            # The call waits for the host-wide rate limiter and retries 429 responses
+            response = await asyncio.to_thread(
+                chat_completion,
+                self.model_client,
                 model=self.model_name,
                 response_format={ "type": "text" },     # There are 3 types of return types: 'text' 'json_object' and 'json_schema'
                 messages=messages,
                 temperature=0.7,
-                max_tokens=300
+                max_tokens=300,
+                n=n
             )
-            
-            # Get the optimized prompt
-            optimized_prompt = response.choices[0].message.content.strip()
-            
-            # Ensure the prompt format is correct
-            optimized_prompt = optimized_prompt.replace("\n", ", ")
-            optimized_prompt = ", ".join(filter(None, [x.strip() for x in optimized_prompt.split(",")]))
-            return optimized_prompt
+
+            optimized_prompts = []
+            for choice in response.choices:
+                if choice.finish_reason == "content_filter" or choice.message.content is None:
+                    optimized_prompts.append(self.CONTENT_REVIEW_MESSAGE)
+                    continue
+                # Get the optimized prompt
+                optimized_prompt = choice.message.content.strip()
+
+                # Ensure the prompt format is correct
+                optimized_prompt = optimized_prompt.replace("\n", ", ")
+                optimized_prompt = ", ".join(filter(None, [x.strip() for x in optimized_prompt.split(",")]))
+                optimized_prompts.append(optimized_prompt)
+            return optimized_prompts
         except Exception as e:
             # Check if it is a content review error
-            error_str = str(response.choices[0])
-            if "content_filter" in error_str:
-                return "The content you generated does not comply with content review standards, please use appropriate prompts"
+            if response is not None and "content_filter" in str(response.choices[0]):
+                return [self.CONTENT_REVIEW_MESSAGE]
             print(f"Error generating prompt: {str(e)}")
             # If other API calls fail, return a simple combined prompt
-            return f"{system_prompt}, {input_prompt}"
+            return [f"{system_prompt}, {input_prompt}"]
 
     @staticmethod
     def validate_prompt_format(prompt: str) -> tuple[bool, str]:
@@ -91,8 +171,8 @@ class GeneratePrompt():
             if "prompt" in prompt.lower():
                 return False, "The prompt contains non-essential keywords 'prompt', please return a pure text prompt information directly, without any prompt keyword structure information"
             # Check if it contains specific keywords
-            if "The content you generated does not comply with content review standards, please use appropriate prompts" in prompt:
-                return False, "The content you generated does not comply with content review standards, please use appropriate prompts"
+            if GeneratePrompt.CONTENT_REVIEW_MESSAGE in prompt:
+                return False, GeneratePrompt.CONTENT_REVIEW_MESSAGE
             # Check if the prompt contains Chinese characters
             if any('\u4e00' <= char <= '\u9fff' for char in prompt):
                 return False, "The prompt contains Chinese characters"
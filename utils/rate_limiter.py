@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+try:
+    import fcntl     # POSIX only, without it the buckets are shared by the threads of one process
+except ImportError:
+    fcntl = None
+
+import openai
+
+from utils.logger import logger
+from utils.setting import settings
+
+
+DEFAULT_COMPLETION_TOKENS = 1000     # charged when a request sets no max_tokens
+# Backoff of the retries of transient errors, the values of the openai SDK
+RETRY_INITIAL_SECONDS = 0.5
+RETRY_MAX_SECONDS = 8.0
+
+
+class TokenBucketLimiter:
+    """
+    Client-side requests-per-minute and tokens-per-minute buckets for one Azure OpenAI deployment.
+
+    The bucket levels live in a small JSON file guarded by flock, so every worker process of a host
+    draws from the same buckets. Each request is charged an estimate before it is sent; the estimate is
+    corrected with the usage of the response and the levels are lowered to Azure's
+    x-ratelimit-remaining-requests / x-ratelimit-remaining-tokens headers. A 429 blocks every caller
+    until its retry-after has passed.
+    """
+    def __init__(self, name: str, requests_per_minute: int, tokens_per_minute: int, state_dir: Optional[str] = None) -> None:
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.enabled = requests_per_minute > 0 or tokens_per_minute > 0
+        state_dir = state_dir or tempfile.gettempdir()
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_path = os.path.join(state_dir, f"rate_limit_{name}.json")
+        self._thread_lock = threading.Lock()
+        self.waited_seconds = 0.0
+        self.rate_limited = 0
+
+    @classmethod
+    def from_settings(cls) -> "TokenBucketLimiter":
+        deployment = f"{settings.AZURE_OPENAI_ENDPOINT}|{settings.AZURE_OPENAI_MODEL}"
+        name = hashlib.sha1(deployment.encode('utf-8')).hexdigest()[:12]
+        return cls(name, settings.AZURE_OPENAI_RPM_LIMIT, settings.AZURE_OPENAI_TPM_LIMIT, settings.RATE_LIMIT_STATE_DIR or None)
+
+    @contextmanager
+    def _locked_state(self):
+        with self._thread_lock:
+            with open(self.state_path, 'a+', encoding='utf-8') as file:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_EX)
+                try:
+                    file.seek(0)
+                    raw = file.read()
+                    state = json.loads(raw) if raw else {}
+                    state = self._refill(state)
+                    yield state
+                    file.seek(0)
+                    file.truncate()
+                    file.write(json.dumps(state))
+                    file.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _refill(self, state: Dict[str, float]) -> Dict[str, float]:
+        now = time.time()
+        if not state:
+            return {"requests": float(self.requests_per_minute), "tokens": float(self.tokens_per_minute),
+                    "updated_at": now, "blocked_until": 0.0}
+        elapsed = max(0.0, now - state["updated_at"])
+        state["requests"] = min(float(self.requests_per_minute), state["requests"] + elapsed * self.requests_per_minute / 60.0)
+        state["tokens"] = min(float(self.tokens_per_minute), state["tokens"] + elapsed * self.tokens_per_minute / 60.0)
+        state["updated_at"] = now
+        return state
+
+    def _wait_seconds(self, state: Dict[str, float], tokens: int) -> float:
+        """Time until both buckets can pay for the request, 0 when they can now"""
+        wait = max(0.0, state["blocked_until"] - time.time())
+        if self.requests_per_minute > 0 and state["requests"] < 1:
+            wait = max(wait, (1 - state["requests"]) * 60.0 / self.requests_per_minute)
+        if self.tokens_per_minute > 0:
+            # A request larger than the whole bucket waits for a full bucket only
+            needed = min(tokens, self.tokens_per_minute)
+            if state["tokens"] < needed:
+                wait = max(wait, (needed - state["tokens"]) * 60.0 / self.tokens_per_minute)
+        return wait
+
+    def acquire(self, tokens: int) -> None:
+        """Block until the request may be sent, and charge it to the buckets"""
+        if not self.enabled:
+            return
+        while True:
+            with self._locked_state() as state:
+                wait = self._wait_seconds(state, tokens)
+                if wait <= 0:
+                    if self.requests_per_minute > 0:
+                        state["requests"] -= 1
+                    if self.tokens_per_minute > 0:
+                        state["tokens"] -= tokens
+                    return
+            self.waited_seconds += wait
+            time.sleep(wait)
+
+    def update(self, headers: Any, estimated_tokens: int, used_tokens: Optional[int]) -> None:
+        """Correct the buckets with the real usage and the remaining quota reported by Azure"""
+        if not self.enabled:
+            return
+        remaining_requests = _header_number(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _header_number(headers, "x-ratelimit-remaining-tokens")
+        with self._locked_state() as state:
+            if self.tokens_per_minute > 0 and used_tokens is not None:
+                state["tokens"] -= used_tokens - estimated_tokens
+            if self.requests_per_minute > 0 and remaining_requests is not None:
+                state["requests"] = min(state["requests"], remaining_requests)
+            if self.tokens_per_minute > 0 and remaining_tokens is not None:
+                state["tokens"] = min(state["tokens"], remaining_tokens)
+
+    def block(self, retry_after: float) -> None:
+        """A 429 was received, nobody on this host sends until retry_after has passed"""
+        self.rate_limited += 1
+        if not self.enabled:
+            # Without shared buckets only the caller backs off
+            self.waited_seconds += retry_after
+            time.sleep(retry_after)
+            return
+        with self._locked_state() as state:
+            state["blocked_until"] = max(state["blocked_until"], time.time() + retry_after)
+            state["requests"] = min(state["requests"], 0.0)
+
+    def stats(self) -> Dict[str, Any]:
+        state = {}
+        if self.enabled:
+            with self._locked_state() as current:
+                state = dict(current)
+        return {"waited_seconds": round(self.waited_seconds, 3), "rate_limited": self.rate_limited, "buckets": state}
+
+
+def _header_number(headers: Any, name: str) -> Optional[float]:
+    if headers is None:
+        return None
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _retry_after_seconds(headers: Any, default: float = 1.0) -> float:
+    milliseconds = _header_number(headers, "retry-after-ms")
+    if milliseconds is not None:
+        return milliseconds / 1000.0
+    seconds = _header_number(headers, "retry-after")
+    return seconds if seconds is not None else default
+
+
+def estimate_tokens(messages: List[Dict[str, Any]], max_tokens: Optional[int], n: int = 1) -> int:
+    """Rough token cost of a chat request: about 4 characters per prompt token plus the completion budget"""
+    prompt_chars = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        prompt_chars += len(str(content or "")) + 16     # role and message framing
+    completion_tokens = max_tokens if max_tokens is not None else DEFAULT_COMPLETION_TOKENS
+    return prompt_chars // 4 + completion_tokens * max(1, n)
+
+
+def chat_completion(model_client, limiter: Optional[TokenBucketLimiter] = None, max_attempts: int = 5, **kwargs):
+    """
+    chat.completions.create behind the shared rate limiter, retries 429 after the time Azure asks for.
+    The SDK's own retries are switched off so every 429 is seen by the limiter; connection errors, timeouts
+    and 5xx responses are retried here with the SDK's backoff, as often as the client would have retried them.
+    """
+    limiter = limiter or azure_openai_limiter
+    estimated = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens"), kwargs.get("n") or 1)
+    max_retries = getattr(model_client, "max_retries", openai.DEFAULT_MAX_RETRIES)
+    client = model_client.with_options(max_retries=0) if hasattr(model_client, "with_options") else model_client
+    attempt = retries = 0
+    while True:
+        limiter.acquire(estimated)
+        try:
+            raw_response = client.chat.completions.with_raw_response.create(**kwargs)
+        except openai.RateLimitError as e:
+            attempt += 1
+            retry_after = _retry_after_seconds(e.response.headers if e.response is not None else None)
+            logger.warning(f"Azure OpenAI rate limited, retry after {retry_after:.2f}s (attempt {attempt}/{max_attempts})")
+            limiter.block(retry_after)
+            if attempt == max_attempts:
+                raise
+            continue
+        except (openai.APIConnectionError, openai.InternalServerError) as e:     # APITimeoutError is an APIConnectionError
+            if retries == max_retries:
+                raise
+            retries += 1
+            delay = min(RETRY_INITIAL_SECONDS * 2 ** (retries - 1), RETRY_MAX_SECONDS) * (1 - 0.25 * random.random())
+            logger.warning(f"Azure OpenAI request failed: {e!r}, retry in {delay:.2f}s (retry {retries}/{max_retries})")
+            time.sleep(delay)
+            continue
+        response = raw_response.parse()
+        usage = getattr(response, "usage", None)
+        limiter.update(raw_response.headers, estimated, usage.total_tokens if usage is not None else None)
+        return response
+
+
+# Shared by every LLM caller of this host
+azure_openai_limiter = TokenBucketLimiter.from_settings()
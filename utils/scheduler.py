@@ -0,0 +1,239 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+from utils.logger import logger
+from utils.setting import settings
+from utils.metrics import LatencyHistogram
+
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)     # Served in this order
+
+RESOURCE_GPU = "gpu"    # A prompt queued or running on ComfyUI
+RESOURCE_LLM = "llm"    # An Azure OpenAI call in flight
+
+POLICY_FAIR = "fair"    # Weighted fair share between tenants, FIFO within a tenant
+POLICY_SJF = "sjf"      # Shortest expected job first, with aging
+POLICIES = (POLICY_FAIR, POLICY_SJF)
+
+
+class Ticket:
+    """A granted (or waiting) slot of one resource"""
+    def __init__(self, pool: "ResourcePool", tenant: str, priority: str, cost: float, expected_seconds: float = 0.0) -> None:
+        self.pool = pool
+        self.tenant = tenant
+        self.priority = priority
+        self.cost = cost
+        self.expected_seconds = expected_seconds    # Expected seconds of the job left, for the sjf policy
+        self.enqueued_at = time.perf_counter()
+        self.granted_at: Optional[float] = None
+        self.released = False
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    @property
+    def wait_seconds(self) -> Optional[float]:
+        return None if self.granted_at is None else self.granted_at - self.enqueued_at
+
+
+class TenantState:
+    def __init__(self, name: str, weight: float) -> None:
+        self.name = name
+        self.weight = weight
+        self.queues: Dict[str, List[Ticket]] = {priority: [] for priority in PRIORITIES}
+        self.running = 0
+        self.pass_value = 0.0   # Stride scheduling: the tenant with the smallest pass is served next
+        self.granted = 0
+        self.wait_histograms = {priority: LatencyHistogram() for priority in PRIORITIES}
+
+    def queued(self, priority: Optional[str] = None) -> int:
+        if priority is not None:
+            return len(self.queues[priority])
+        return sum(len(queue) for queue in self.queues.values())
+
+
+class ResourcePool:
+    """
+    Weighted fair sharing of `capacity` slots between tenants.
+
+    Interactive requests are always served before bulk requests, and bulk requests never take the last
+    `interactive_reserved` slots, so an interactive request only waits for other interactive requests.
+    Within a priority class the backlogged tenant with the smallest pass value is served next and its
+    pass grows by cost / weight (stride scheduling), so tenants share slots in proportion to their weight.
+
+    With the sjf policy the ticket whose job has the fewest expected seconds left is served next instead,
+    less sjf_aging seconds for every second it waited. The tenant limit still applies.
+    """
+    def __init__(self, name: str, capacity: int, tenant_limit: int, tenant_weights: Dict[str, float],
+                 interactive_reserved: int = 0, policy: str = POLICY_FAIR, sjf_aging: float = 1.0) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy}, expected one of {POLICIES}")
+        self.name = name
+        self.policy = policy
+        self.sjf_aging = sjf_aging
+        self.capacity = max(1, int(capacity))
+        self.tenant_limit = max(1, int(tenant_limit))
+        self.interactive_reserved = min(max(0, int(interactive_reserved)), self.capacity - 1)
+        self.tenant_weights = tenant_weights
+        self.tenants: Dict[str, TenantState] = {}
+        self.running = 0
+        self._lock = threading.Lock()
+
+    def _tenant(self, name: str) -> TenantState:
+        tenant = self.tenants.get(name)
+        if tenant is None:
+            tenant = TenantState(name, float(self.tenant_weights.get(name, 1.0)))
+            self.tenants[name] = tenant
+        return tenant
+
+    def _select(self, priority: str) -> Optional[Ticket]:
+        """Pick the next ticket of a priority class, must be called with self._lock held"""
+        candidates = [tenant for tenant in self.tenants.values()
+                      if tenant.queues[priority] and tenant.running < self.tenant_limit]
+        if not candidates:
+            return None
+        if self.policy == POLICY_SJF:
+            now = time.perf_counter()
+            return min((ticket for tenant in candidates for ticket in tenant.queues[priority]),
+                       key=lambda ticket: (ticket.expected_seconds - (now - ticket.enqueued_at) * self.sjf_aging, ticket.enqueued_at))
+        tenant = min(candidates, key=lambda tenant: tenant.pass_value)
+        return tenant.queues[priority][0]
+
+    def _dispatch(self) -> List[Ticket]:
+        """Grant as many waiting tickets as capacity allows, must be called with self._lock held"""
+        granted = []
+        while self.running < self.capacity:
+            ticket = self._select(PRIORITY_INTERACTIVE)
+            if ticket is None and self.running < self.capacity - self.interactive_reserved:
+                ticket = self._select(PRIORITY_BULK)
+            if ticket is None:
+                break
+            tenant = self.tenants[ticket.tenant]
+            tenant.queues[ticket.priority].remove(ticket)
+            tenant.running += 1
+            tenant.granted += 1
+            tenant.pass_value += ticket.cost / tenant.weight
+            self.running += 1
+            ticket.granted_at = time.perf_counter()
+            tenant.wait_histograms[ticket.priority].record(ticket.wait_seconds)
+            granted.append(ticket)
+        return granted
+
+    @staticmethod
+    def _wake(tickets: List[Ticket]) -> None:
+        for ticket in tickets:
+            ticket.loop.call_soon_threadsafe(lambda future=ticket.future: future.done() or future.set_result(True))
+
+    async def acquire(self, tenant: str, priority: str, cost: float = 1.0, expected_seconds: float = 0.0) -> Ticket:
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority class: {priority}, expected one of {PRIORITIES}")
+        ticket = Ticket(self, tenant, priority, cost, expected_seconds)
+        with self._lock:
+            state = self._tenant(tenant)
+            if state.queued() == 0 and state.running == 0:
+                # A tenant coming back from idle starts at the current pass, it gets no credit for the idle time
+                active = [other.pass_value for other in self.tenants.values() if other.queued() or other.running]
+                state.pass_value = max(state.pass_value, min(active, default=state.pass_value))
+            state.queues[priority].append(ticket)
+            granted = self._dispatch()
+        self._wake(granted)
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            with self._lock:
+                queue = self.tenants[tenant].queues[priority]
+                if ticket in queue:
+                    queue.remove(ticket)
+                    ticket.released = True
+            self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        """Give a slot back, calling it twice for the same ticket is harmless"""
+        with self._lock:
+            if ticket.released or ticket.granted_at is None:
+                return
+            ticket.released = True
+            self.tenants[ticket.tenant].running -= 1
+            self.running -= 1
+            granted = self._dispatch()
+        self._wake(granted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            tenants = {
+                name: {
+                    "weight": tenant.weight,
+                    "running": tenant.running,
+                    "queue_depth": {priority: tenant.queued(priority) for priority in PRIORITIES},
+                    "granted": tenant.granted,
+                    "wait_seconds": {priority: histogram.snapshot() for priority, histogram in tenant.wait_histograms.items()},
+                }
+                for name, tenant in self.tenants.items()
+            }
+        return {"capacity": self.capacity, "running": self.running, "policy": self.policy, "tenants": tenants}
+
+
+class FairShareScheduler:
+    """
+    Shared admission point for GPU jobs (ComfyUI prompts) and LLM calls of every tenant.
+
+        ticket = await scheduler.acquire("gpu", tenant, "bulk")
+        ...submit and wait for the images...
+        scheduler.release(ticket)
+
+        async with scheduler.slot("llm", tenant, "interactive"):
+            ...call the LLM...
+    """
+    def __init__(self, gpu_capacity: int, llm_capacity: int, tenant_gpu_limit: int, tenant_llm_limit: int,
+                 tenant_weights: Optional[Dict[str, float]] = None, gpu_interactive_reserved: int = 1,
+                 policy: str = POLICY_FAIR, sjf_aging: float = 1.0) -> None:
+        tenant_weights = tenant_weights or {}
+        self.pools = {
+            RESOURCE_GPU: ResourcePool(RESOURCE_GPU, gpu_capacity, tenant_gpu_limit, tenant_weights, gpu_interactive_reserved,
+                                       policy=policy, sjf_aging=sjf_aging),
+            RESOURCE_LLM: ResourcePool(RESOURCE_LLM, llm_capacity, tenant_llm_limit, tenant_weights),
+        }
+
+    @classmethod
+    def from_settings(cls) -> "FairShareScheduler":
+        return cls(gpu_capacity=settings.SCHEDULER_GPU_CONCURRENCY,
+                   llm_capacity=settings.SCHEDULER_LLM_CONCURRENCY,
+                   tenant_gpu_limit=settings.SCHEDULER_TENANT_GPU_LIMIT,
+                   tenant_llm_limit=settings.SCHEDULER_TENANT_LLM_LIMIT,
+                   tenant_weights=settings.SCHEDULER_TENANT_WEIGHTS,
+                   gpu_interactive_reserved=settings.SCHEDULER_GPU_INTERACTIVE_RESERVED,
+                   policy=settings.SCHEDULER_POLICY,
+                   sjf_aging=settings.SCHEDULER_SJF_AGING)
+
+    async def acquire(self, resource: str, tenant: str, priority: str, cost: float = 1.0, expected_seconds: float = 0.0) -> Ticket:
+        ticket = await self.pools[resource].acquire(tenant, priority, cost, expected_seconds)
+        if ticket.wait_seconds > 1:
+            logger.debug(f"scheduler {resource} tenant:{tenant} priority:{priority} waited {ticket.wait_seconds:.3f}s")
+        return ticket
+
+    @staticmethod
+    def release(ticket: Optional[Ticket]) -> None:
+        if ticket is not None:
+            ticket.pool.release(ticket)
+
+    @asynccontextmanager
+    async def slot(self, resource: str, tenant: str, priority: str, cost: float = 1.0):
+        ticket = await self.acquire(resource, tenant, priority, cost)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict[str, Any]:
+        """Per resource and tenant: running jobs, queue depth and wait time percentiles per priority class"""
+        return {resource: pool.stats() for resource, pool in self.pools.items()}
+
+
+# Shared by every processor of this process
+scheduler = FairShareScheduler.from_settings()
@@ -0,0 +1,144 @@
+import re
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.logger import logger
+from utils.setting import settings
+
+
+WORD = re.compile(r"\w+")
+CJK = re.compile(r"[぀-ヿ㐀-鿿가-힯]")
+STOPWORDS = frozenset("a an the of for with and in on at to by from this that is are be as it its into over under very".split())
+SUFFIXES = ("ing", "ed", "es", "s", "ly")
+SIMILARITY_BINS = 20    # Buckets of the best-match similarity histogram, 0.05 wide
+
+
+def _stem(word: str) -> str:
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+class HashedNgramVectorizer:
+    """
+    Embeds a text without a model or network call: stemmed words, word bigrams and character trigrams are
+    hashed (crc32, the same in every process) into a signed vector of `dim` floats with unit length.
+    CJK runs, which have no spaces, are split into character bigrams instead of words.
+    """
+    def __init__(self, dim: int = 2048, word_weight: float = 1.0, bigram_weight: float = 0.5, char_weight: float = 0.3) -> None:
+        self.dim = dim
+        self.word_weight = word_weight
+        self.bigram_weight = bigram_weight
+        self.char_weight = char_weight
+
+    def _features(self, text: str) -> List[Tuple[str, float]]:
+        words = []
+        for word in WORD.findall(text.lower()):
+            if CJK.search(word):
+                words.extend(word[i:i + 2] for i in range(max(len(word) - 1, 1)))
+            elif word not in STOPWORDS:
+                words.append(_stem(word))
+        features = []
+        for word in words:
+            features.append((f"w:{word}", self.word_weight))
+            padded = f" {word} "
+            features.extend((f"c:{padded[i:i + 3]}", self.char_weight) for i in range(len(padded) - 2))
+        features.extend((f"b:{first} {second}", self.bigram_weight) for first, second in zip(words, words[1:]))
+        return features
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, weight in self._features(text):
+            hashed = zlib.crc32(feature.encode('utf-8'))
+            vector[hashed % self.dim] += weight if hashed & 0x80000000 else -weight
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+class SemanticCache:
+    """
+    Values stored under texts, found again by a text close enough in meaning: cosine similarity of the
+    hashed n-gram vectors at least `threshold`. The vectors are rows of one NumPy matrix, a lookup is one
+    matrix-vector product. Holds up to `capacity` entries, the least recently used one is evicted, entries
+    older than ttl seconds are not returned.
+
+    The best similarity of every lookup is counted in a histogram, logged with the hit rate every
+    log_interval lookups, to tune the threshold.
+    """
+    def __init__(self, name: str, threshold: float = settings.SEMANTIC_CACHE_THRESHOLD, capacity: int = settings.SEMANTIC_CACHE_CAPACITY,
+                 ttl: float = settings.SEMANTIC_CACHE_TTL, vectorizer: Optional[HashedNgramVectorizer] = None, log_interval: int = 100) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.capacity = max(1, capacity)
+        self.ttl = ttl
+        self.vectorizer = vectorizer or HashedNgramVectorizer()
+        self.log_interval = log_interval
+        self._vectors = np.zeros((self.capacity, self.vectorizer.dim), dtype=np.float32)
+        self._texts: List[Optional[str]] = [None] * self.capacity
+        self._rows: Dict[str, int] = {}     # Text -> row
+        self._values: List[Any] = [None] * self.capacity
+        self._created = np.zeros(self.capacity)
+        self._used = np.full(self.capacity, -np.inf)    # Last use per row, -inf for free rows
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.similarity_counts = np.zeros(SIMILARITY_BINS, dtype=np.int64)
+
+    def get(self, text: str) -> Optional[Tuple[Any, float]]:
+        """
+        Returns:
+            tuple: (stored value, similarity) of the closest entry, None when no entry is close enough
+        """
+        vector = self.vectorizer.embed(text)
+        now = time.time()
+        with self._lock:
+            similarities = self._vectors @ vector
+            live = np.isfinite(self._used)
+            if self.ttl > 0:
+                live &= now - self._created <= self.ttl
+            similarities[~live] = -1.0
+            row = int(np.argmax(similarities))
+            similarity = float(similarities[row])
+            self.lookups += 1
+            if similarity >= 0:
+                self.similarity_counts[min(int(similarity * SIMILARITY_BINS), SIMILARITY_BINS - 1)] += 1
+            match = None
+            if similarity >= self.threshold:
+                self.hits += 1
+                self._used[row] = now
+                match = (self._values[row], similarity)
+            log = self.lookups % self.log_interval == 0
+        if log:
+            logger.info(f"semantic cache {self.name}: {self.stats()}")
+        return match
+
+    def put(self, text: str, value: Any) -> Any:
+        """Store a value under a text, replacing the entry of the same text. Returns the value"""
+        vector = self.vectorizer.embed(text)
+        now = time.time()
+        with self._lock:
+            row = self._rows.get(text)
+            if row is None:
+                used = self._used if self.ttl <= 0 else np.where(now - self._created > self.ttl, -np.inf, self._used)
+                row = int(np.argmin(used))     # A free or expired row, otherwise the least recently used entry
+                self._rows.pop(self._texts[row], None)
+                self._rows[text] = row
+            self._vectors[row] = vector
+            self._texts[row] = text
+            self._values[row] = value
+            self._created[row] = now
+            self._used[row] = now
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = self.similarity_counts.tolist()
+            return {"entries": int(np.isfinite(self._used).sum()), "lookups": self.lookups, "hits": self.hits,
+                    "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                    "threshold": self.threshold,
+                    "best_similarity": {f"{i / SIMILARITY_BINS:.2f}": count for i, count in enumerate(counts) if count}}
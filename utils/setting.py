@@ -1,5 +1,5 @@
 import os
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
 
@@ -18,13 +18,88 @@ class Settings(BaseSettings):
     # ComfyUI   
     COMFYUI_BASE_API_URL: str
     COMFYUI_WEBSOCKET_API_URL: str
+    COMFYUI_VALIDATE_WORKFLOW: bool = True     # check workflows against the node schemas of /object_info before queueing
+    COMFYUI_OBJECT_INFO_TTL: float = 600       # seconds a cached node schema is used
+    COMFYUI_OBJECT_INFO_RECHECK_SECONDS: float = 30    # a workflow rejected by an older schema is checked again with a fresh one
+    COMFYUI_PERSIST_OUTPUTS: bool = True       # keep a SaveImage node next to every websocket output, so images survive a dropped websocket
+    COMFYUI_RECONNECT_ATTEMPTS: int = 5        # attempts to reopen a dropped websocket with the same client_id
+    COMFYUI_RECONNECT_BACKOFF: float = 0.5     # seconds before the second attempt, doubled after every failed one
+    COMFYUI_RECOVERY_POLL_SECONDS: float = 1.0     # prompts that missed websocket messages are polled in /history this often
 
     # Azure OpenAI
     AZURE_OPENAI_MODEL: str
     AZURE_OPENAI_API_KEY: str
     AZURE_OPENAI_ENDPOINT: str
     AZURE_OPENAI_API_VERSION: str
+    AZURE_OPENAI_RPM_LIMIT: int = 0        # requests per minute of the deployment, shared by every worker of the host, 0 disables
+    AZURE_OPENAI_TPM_LIMIT: int = 0        # tokens per minute of the deployment, 0 disables
+    RATE_LIMIT_STATE_DIR: str = ""         # directory of the shared bucket state, default is the system temp directory
+
+    # prompt generation
+    PROMPT_CANDIDATES: int = 2     # candidates requested per prompt in one request, the first valid one is used
     
+    # scheduler, shared by every tenant in front of ComfyUI and Azure OpenAI
+    SCHEDULER_GPU_CONCURRENCY: int = 2         # prompts queued or running on ComfyUI at the same time
+    SCHEDULER_GPU_INTERACTIVE_RESERVED: int = 1    # GPU slots bulk jobs may never take
+    SCHEDULER_LLM_CONCURRENCY: int = 8         # LLM calls in flight at the same time
+    SCHEDULER_TENANT_GPU_LIMIT: int = 2        # GPU slots one tenant may hold
+    SCHEDULER_TENANT_LLM_LIMIT: int = 4        # LLM calls one tenant may have in flight
+    SCHEDULER_TENANT_WEIGHTS: Dict[str, float] = {}    # fair share weight per tenant, JSON, default weight is 1
+    SCHEDULER_POLICY: str = "fair"             # fair (weighted fair share) or sjf (shortest expected job first)
+    SCHEDULER_SJF_AGING: float = 1.0           # sjf: expected seconds a waiting job gains per second waited, so big jobs do not starve
+
+    # cost model trained on the node times ComfyUI reports, admission control against queue-time SLOs
+    COST_MODEL_PATH: str = "data/cost_model.json"
+    COST_MODEL_DEFAULT_IMAGE_SECONDS: float = 30.0     # GPU seconds of a 1 megapixel image before anything was measured
+    ADMISSION_GPU_WORKERS: int = 1             # prompts ComfyUI renders at the same time
+    ADMISSION_QUEUE_SLO_INTERACTIVE: float = 0     # longest expected GPU wait of an interactive request in seconds, 0 admits everything
+    ADMISSION_QUEUE_SLO_BULK: float = 0            # same for bulk requests
+    ADMISSION_DEFER_SECONDS: float = 0         # bulk requests over their SLO wait up to this long for the queue to drain before they are rejected
+
+    # input images given as bytes, file objects or HTTP(S) URLs, URL downloads stream straight into the ComfyUI upload
+    IMAGE_INPUT_MAX_BYTES: int = 30 * 1024 * 1024     # larger input images are refused
+    IMAGE_INPUT_TIMEOUT: float = 30.0      # seconds without progress before a URL download fails
+    IMAGE_INPUT_URL_HOSTS: List[str] = []          # hosts URL inputs are downloaded from, JSON, ".example.com" allows subdomains, empty allows every public host
+    IMAGE_INPUT_ALLOW_PRIVATE_URLS: bool = False   # download URL inputs from loopback, private and link-local addresses too
+
+    # workflow variants of the task registry: traffic split and per-variant statistics
+    VARIANT_WEIGHTS: Dict[str, Dict[str, float]] = {}     # task type -> variant ID -> weight, JSON, replaces the registry weights
+    VARIANT_STATS_DIR: str = "data/variant_stats"      # one statistics file per worker process, merged by python worker.py variants
+
+    # identical work in flight (process calls, LLM calls, uploads) shares one execution
+    SINGLEFLIGHT_ENABLED: bool = True
+
+    # input prompts close in meaning (hashed n-gram cosine similarity) reuse the flux prompts and placements of an earlier request
+    SEMANTIC_CACHE_ENABLED: bool = True
+    SEMANTIC_CACHE_THRESHOLD: float = 0.85
+    SEMANTIC_CACHE_CAPACITY: int = 4096     # entries per task type, the least recently used one is evicted
+    SEMANTIC_CACHE_TTL: float = 86400       # seconds an entry is reused, 0 for no limit
+
+    # content-addressed output store and derivatives
+    OUTPUT_STORE_ENABLED: bool = True
+    OUTPUT_STORE_ROOT: str = "images/store"
+    OUTPUT_STORE_RENDITIONS: str = "templates/output_renditions.yml"
+    OUTPUT_STORE_WORKERS: int = 2          # processes building thumbnails and lossy versions
+
+    # durable job store and workers
+    JOB_STORE_PATH: str = "data/jobs.sqlite3"
+    JOB_LEASE_SECONDS: float = 60          # a job is claimed again when its worker stops renewing the lease
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_POLL_SECONDS: float = 1.0          # idle workers look for new jobs this often
+    JOB_RECOVERY_POLL_SECONDS: float = 2.0     # re-attached prompts still running on ComfyUI are polled this often
+
+    # event loop lag monitor and sampling profiler
+    LOOP_LAG_MONITOR_ENABLED: bool = False
+    LOOP_LAG_INTERVAL: float = 0.05        # seconds between two loop lag measurements
+    LOOP_LAG_THRESHOLD: float = 0.2        # the loop thread stack is logged when a callback blocks longer
+    PROFILER_OUTPUT_DIR: str = "logs/profiles"     # folded stacks for flamegraph.pl or speedscope
+    PROFILER_INTERVAL: float = 0.005       # seconds between two stack samples
+    PROFILER_SAMPLE_RATE: float = 0.0      # fraction of process calls that are profiled
+    PROFILER_SIGNAL_SECONDS: float = 30    # worker.py profiles this long on SIGUSR2
+
+    # task types, their workflows, parameter bindings and output nodes
+    TASK_REGISTRY_PATH: str = "templates/task_registry.yml"
+
     # default batch task use one prompt
     DEFAULT_BATCHSIZE_USE_ONE_PROMPT: int
 
@@ -34,5 +109,16 @@ class Settings(BaseSettings):
     IMAGE2POSTER_OUTPUT_SIZE_HEIGHT: int
     IMAGE2POSTER_SCALE_MIN: float
     IMAGE2POSTER_SCALE_MAX: float
+    IMAGE2POSTER_PIPELINE_QUEUE_SIZE: int = 2      # items buffered between two pipeline stages
+    IMAGE2POSTER_PROMPT_BATCH_GROUPS: int = 10     # groups whose prompts are generated by one LLM request
+    IMAGE2POSTER_PLACEMENT_MODE: str = "llm_with_fallback"     # llm, local (no LLM call) or llm_with_fallback
+    IMAGE2POSTER_PLACEMENT_TIMEOUT: float = 5.0    # seconds llm_with_fallback waits for the LLM before placing locally
+    IMAGE2POSTER_PREPROCESS_CACHE: bool = True    # render the preprocess_node of a task type once per input image
+    IMAGE2POSTER_PREPROCESS_TTL: float = 600       # seconds a preprocessed image is trusted to be on ComfyUI before it is checked again
+    IMAGE2POSTER_DRAFT_SCALE: float = 0.5          # output size of draft images relative to the full size
+    IMAGE2POSTER_DRAFT_STEPS_RATIO: float = 0.4    # sampler steps of draft images relative to the workflow steps
+    IMAGE2POSTER_DRAFT_MIN_STEPS: int = 4
+    IMAGE2POSTER_DRAFT_DIR: str = "data/drafts"    # prompts, seeds and placements of drafts, read by finalize calls
+    IMAGE2POSTER_DRAFT_TTL: float = 86400          # seconds a draft can be finalized, 0 keeps drafts forever
 
 settings = Settings()
@@ -0,0 +1,78 @@
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+from typing import Any, Awaitable, Callable, Dict
+
+
+def make_key(*parts: Any) -> str:
+    """Stable key of JSON-like parts, dict order does not matter"""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesce identical work in flight: while a call for a key is running, further calls with the same key
+    wait for it instead of starting their own. Every caller gets its own deep copy of the result (or the
+    same exception). The shared call keeps running when one of its callers is cancelled.
+    """
+    def __init__(self, name: str, enabled: bool = True) -> None:
+        self.name = name
+        self.enabled = enabled
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.executions = 0
+
+    @property
+    def coalesced(self) -> int:
+        return self.calls - self.executions
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        if not self.enabled:
+            return await fn()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self.calls += 1
+            task = self._inflight.get(key)
+            if task is None or task.get_loop() is not loop:
+                self.executions += 1
+                task = loop.create_task(fn())
+                self._inflight[key] = task
+                task.add_done_callback(lambda done, key=key: self._forget(key, done))
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result)
+
+    def _forget(self, key: str, task: asyncio.Future) -> None:
+        with self._lock:
+            if self._inflight.get(key) is task:
+                del self._inflight[key]
+        if not task.cancelled():
+            task.exception()    # Mark the exception as retrieved even if every caller was cancelled
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "coalesce_rate": round(self.coalesced / self.calls, 4) if self.calls else 0.0,
+            "in_flight": len(self._inflight),
+        }
+
+
+_groups: Dict[str, SingleFlight] = {}
+
+
+def get_singleflight(name: str, enabled: bool = True) -> SingleFlight:
+    """Process-wide coalescing group, created on first use"""
+    group = _groups.get(name)
+    if group is None:
+        group = _groups.setdefault(name, SingleFlight(name, enabled))
+    return group
+
+
+def singleflight_stats() -> Dict[str, Dict[str, Any]]:
+    """Coalescing metrics of every group, e.g. {'process': {'calls': 10, 'coalesced': 3, ...}}"""
+    return {name: group.stats() for name, group in _groups.items()}
@@ -0,0 +1,59 @@
+import json
+from typing import Any, Dict
+
+import yaml
+
+from schemas.task_schema import TaskSpec, REQUIRED_BINDINGS
+from utils.workflow_split import ancestors, apply_overrides, bindings_in
+
+
+def _resolve(name: str, entries: Dict[str, Dict[str, Any]], resolving: tuple = ()) -> Dict[str, Any]:
+    """Entry with the keys of the task types it extends filled in"""
+    if name not in entries:
+        raise ValueError(f"Unknown task type {name}" + (f", extended by {resolving[-1]}" if resolving else ""))
+    if name in resolving:
+        raise ValueError(f"Task types extend each other: {' -> '.join(resolving + (name,))}")
+    entry = dict(entries[name] or {})
+    parent = entry.pop('extends', None)
+    if parent is None:
+        return entry
+    resolved = _resolve(parent, entries, resolving + (name,))
+    resolved.update(entry)
+    return resolved
+
+
+def load_task_registry(registry_path: str) -> Dict[str, TaskSpec]:
+    """
+    Load the task types of a registry file, e.g. templates/task_registry.yml
+    Raises:
+        ValueError: When an entry is incomplete or binds a node its workflow does not have
+    """
+    with open(registry_path, 'r', encoding='utf-8') as file:
+        entries = yaml.safe_load(file) or {}
+
+    registry = {}
+    workflows = {}
+    for task_type in entries:
+        spec = TaskSpec(task_type=task_type, **_resolve(task_type, entries))
+        if spec.workflow not in workflows:
+            with open(spec.workflow, 'r', encoding='utf-8') as file:
+                workflows[spec.workflow] = json.load(file)
+        workflow = workflows[spec.workflow]
+        bound_nodes = [binding.node for bindings in spec.bindings.values() for binding in bindings] + [binding.node for binding in spec.draft_steps] + ([spec.preprocess_node] if spec.preprocess_node else [])
+        unknown = sorted({node_id for node_id in bound_nodes + list(spec.outputs) + list(spec.middle_outputs) if node_id not in workflow})
+        if unknown:
+            raise ValueError(f"task {task_type}: nodes {unknown} are not in {spec.workflow}")
+        preprocessed = ancestors(workflow, spec.preprocess_node) if spec.preprocess_node else set()
+        for variant_id, variant in spec.variants.items():
+            try:
+                variant_workflow = apply_overrides(workflow, variant.overrides)
+            except ValueError as e:
+                raise ValueError(f"task {task_type} variant {variant_id}: {e}")
+            changed = sorted(preprocessed & set(variant.overrides))
+            if changed:
+                raise ValueError(f"task {task_type} variant {variant_id}: nodes {changed} are rendered once per image by the preprocess_node")
+            unbound = [name for name in REQUIRED_BINDINGS if name not in bindings_in(spec.bindings, variant_workflow)]
+            if unbound:
+                raise ValueError(f"task {task_type} variant {variant_id}: no node left for {unbound}")
+        registry[task_type] = spec
+    return registry
@@ -0,0 +1,165 @@
+import csv
+import io
+import json
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+from utils.logger import logger
+from utils.metrics import LatencyHistogram
+from utils.setting import settings
+
+
+# Columns of the CSV export, the JSON export has the GPU seconds of every node as well
+REPORT_COLUMNS = ("task_type", "variant", "calls", "failures", "failure_rate", "images", "latency_mean", "latency_p50",
+                  "latency_p95", "latency_p99", "prompts", "gpu_seconds_per_image")
+
+
+def _new_counters() -> Dict[str, Any]:
+    return {"calls": 0, "failures": 0, "images": 0, "latency": LatencyHistogram(), "prompts": 0, "node_seconds": {}}
+
+
+class VariantStats:
+    """
+    Statistics of the workflow variants of every task type: process calls, failures and end-to-end latency,
+    images, and the GPU execution time of every node ComfyUI reports for their prompts (observe_prompt).
+    Every process writes its own file to root, report() merges the files of all workers and hosts sharing it.
+    """
+    def __init__(self, root: str = settings.VARIANT_STATS_DIR, save_interval: float = 30.0) -> None:
+        self.root = root
+        self.save_interval = save_interval
+        self._variants: Dict[Tuple[str, str], Dict[str, Any]] = {}    # (task type, variant) -> counters
+        self._expected: Dict[str, Tuple[str, str]] = {}                # prompt_id -> (task type, variant)
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+        self._dirty = False
+
+    @property
+    def path(self) -> str:
+        """Statistics file of this process, named when it saves: worker processes forked after the import get their own"""
+        return os.path.join(self.root, f"{socket.gethostname()}-{os.getpid()}.json") if self.root else ""
+
+    def _counters(self, task_type: str, variant: str) -> Dict[str, Any]:
+        return self._variants.setdefault((task_type, variant), _new_counters())
+
+    def expect(self, prompt_id: str, task_type: str, variant: str) -> None:
+        """Remember the variant of a queued prompt, its node timings are counted for it"""
+        with self._lock:
+            self._expected[prompt_id] = (task_type, variant)
+
+    def forget(self, prompt_id: str) -> None:
+        with self._lock:
+            self._expected.pop(prompt_id, None)
+
+    def observe_prompt(self, prompt_id: str, node_times: Dict[str, float]) -> None:
+        """Node execution times of a finished prompt, none when its images came from /history"""
+        with self._lock:
+            expected = self._expected.pop(prompt_id, None)
+            if expected is None or not node_times:
+                return
+            counters = self._counters(*expected)
+            counters["prompts"] += 1
+            for node_id, seconds in node_times.items():
+                counters["node_seconds"][node_id] = counters["node_seconds"].get(node_id, 0.0) + seconds
+            self._dirty = True
+        self._maybe_save()
+
+    def record_call(self, task_type: str, variant: str, seconds: float, succeeded: bool, images: int) -> None:
+        """A finished process call: end-to-end seconds, whether it succeeded and the images it returned"""
+        with self._lock:
+            counters = self._counters(task_type, variant)
+            counters["calls"] += 1
+            counters["failures"] += 0 if succeeded else 1
+            counters["images"] += images
+            counters["latency"].record(seconds)
+            self._dirty = True
+        self._maybe_save()
+
+    def _maybe_save(self) -> None:
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            try:
+                self.save()
+            except OSError as e:
+                logger.warning(f"cannot save variant stats {self.path}: {e}")
+
+    def save(self) -> None:
+        path = self.path
+        if not path:
+            return
+        with self._lock:
+            self._saved_at = time.monotonic()
+            if not self._dirty:
+                return
+            state = {f"{task_type}/{variant}": dict(counters, latency=counters["latency"].to_dict(), node_seconds=dict(counters["node_seconds"]))
+                     for (task_type, variant), counters in self._variants.items()}
+            self._dirty = False
+        os.makedirs(self.root, exist_ok=True)
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+        os.replace(temporary, path)
+
+    def report(self) -> List[Dict[str, Any]]:
+        """Merged statistics of every file in root, including the unsaved counts of this process"""
+        self.save()
+        return load_report(self.root) if self.path else _rows(self._variants)
+
+
+def _rows(variants: Dict[Tuple[str, str], Dict[str, Any]]) -> List[Dict[str, Any]]:
+    rows = []
+    for (task_type, variant), counters in sorted(variants.items()):
+        latency = counters["latency"].snapshot()
+        prompts = counters["prompts"]
+        node_seconds = {node_id: round(seconds / prompts, 3) for node_id, seconds in
+                        sorted(counters["node_seconds"].items(), key=lambda entry: -entry[1])} if prompts else {}
+        rows.append({
+            "task_type": task_type,
+            "variant": variant,
+            "calls": counters["calls"],
+            "failures": counters["failures"],
+            "failure_rate": round(counters["failures"] / counters["calls"], 4) if counters["calls"] else None,
+            "images": counters["images"],
+            "latency_mean": latency["mean"],
+            "latency_p50": latency["p50"],
+            "latency_p95": latency["p95"],
+            "latency_p99": latency["p99"],
+            "prompts": prompts,
+            "gpu_seconds_per_image": round(sum(node_seconds.values()), 3) if prompts else None,
+            "node_seconds_per_image": node_seconds,     # Mean GPU seconds of every node, slowest first
+        })
+    return rows
+
+
+def load_report(root: str = settings.VARIANT_STATS_DIR) -> List[Dict[str, Any]]:
+    """Statistics of every variant, merged over the files of all worker processes in root"""
+    variants: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    names = sorted(name for name in os.listdir(root) if name.endswith(".json")) if os.path.isdir(root) else []
+    for name in names:
+        try:
+            with open(os.path.join(root, name), 'r', encoding='utf-8') as file:
+                state = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"cannot read variant stats {name}: {e}")
+            continue
+        for key, saved in state.items():
+            task_type, variant = key.split("/", 1)
+            counters = variants.setdefault((task_type, variant), _new_counters())
+            for field in ("calls", "failures", "images", "prompts"):
+                counters[field] += saved[field]
+            counters["latency"].merge(LatencyHistogram.from_dict(saved["latency"]))
+            for node_id, seconds in saved["node_seconds"].items():
+                counters["node_seconds"][node_id] = counters["node_seconds"].get(node_id, 0.0) + seconds
+    return _rows(variants)
+
+
+def report_csv(rows: Iterable[Dict[str, Any]]) -> str:
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=REPORT_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue()
+
+
+variant_stats = VariantStats()
@@ -6,6 +6,8 @@ import sys
 from pathlib import Path
 import json
 import uuid
+import threading
+import time
 import httpx
 import websocket
 
@@ -23,6 +25,10 @@ except ModuleNotFoundError as e:
     print("Please ensure this file is run from the project root directory")
     sys.exit(1)
 
+# Suffix of the SaveImage node kept next to every SaveImageWebsocket output, its images are in /history
+DISK_OUTPUT_SUFFIX = "_disk"
+
+
 class WebsocketAPI:
     def __init__(self, comfyui_base_url = settings.COMFYUI_BASE_API_URL):
 
@@ -42,6 +48,76 @@ class WebsocketAPI:
         self.ws = websocket.WebSocket()
         self.ws_url = f"{self.comfyui_websocket_api_url}?clientId={self.client_id}"
 
+        # One websocket connection is shared by every prompt of this client_id, the messages are
+        # dispatched to the waiting prompt by prompt_id. Only one thread reads at a time.
+        self._state_lock = threading.Condition()
+        self._reader_lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        self._executing_prompt_id = None
+        self._executing_node = None
+        self._pending_outputs = {}      # prompt_id -> {node_id: [image bytes]}
+        self._finished = {}             # prompt_id -> error message or None
+        self._open_prompts = set()      # prompt_ids queued by this client whose images were not returned yet
+        self._lost_prompts = set()      # open prompt_ids that missed messages while the websocket was down
+        self.reconnects = 0
+        self._node_clock = {}           # prompt_id -> (node_id executing, time it started)
+        self._node_times = {}           # prompt_id -> {node_id: seconds}, cached nodes with 0
+
+        # Called with the node_errors of a prompt ComfyUI rejected, e.g. to refresh cached node schemas
+        self.on_node_errors = None
+        # Called with the prompt_id and node execution times of every prompt that finished, e.g. to train a cost model.
+        # The times are empty for a prompt whose images came from /history, they were not measured
+        self.on_prompt_timings = None
+
+    @property
+    def open_prompts(self):
+        """prompt_ids queued by this client whose images were not returned yet"""
+        with self._state_lock:
+            return set(self._open_prompts)
+
+    def connect(self):
+        """Open the shared websocket connection if it is not open yet"""
+        with self._connect_lock:
+            if not self.ws.connected:
+                self.ws.connect(self.ws_url)
+
+    def _reconnect(self, error):
+        """
+        Open a new websocket with the same client_id after the connection dropped, ComfyUI then sends the
+        messages of our prompts to it again. Messages sent in between are lost, so every open prompt that
+        did not finish yet is marked to be collected through /history instead.
+        Raises:
+            Exception: The last connection error once COMFYUI_RECONNECT_ATTEMPTS attempts failed
+        """
+        with self._state_lock:
+            lost = self._open_prompts - set(self._finished)
+            self._lost_prompts |= lost
+            self._executing_prompt_id = None
+            self._executing_node = None
+            # Node times of prompts that missed messages are incomplete
+            self._node_clock.clear()
+            self._node_times.clear()
+        logger.warning(f"comfyui websocket dropped ({error!r}), reconnecting, {len(lost)} prompts in flight")
+        with self._connect_lock:
+            try:
+                self.ws.shutdown()
+            except Exception:
+                pass
+            self.ws = websocket.WebSocket()
+            delay = settings.COMFYUI_RECONNECT_BACKOFF
+            for attempt in range(1, settings.COMFYUI_RECONNECT_ATTEMPTS + 1):
+                try:
+                    self.ws.connect(self.ws_url)
+                    break
+                except Exception as e:
+                    if attempt == settings.COMFYUI_RECONNECT_ATTEMPTS:
+                        raise
+                    logger.warning(f"comfyui websocket reconnect attempt {attempt} failed: {e}")
+                    time.sleep(delay)
+                    delay *= 2
+        self.reconnects += 1
+        logger.info(f"comfyui websocket reconnected with client_id {self.client_id}")
+
     def queue_prompt(self, prompt):
         p = {"prompt": prompt, "client_id": self.client_id}
         data = json.dumps(p).encode('utf-8')
@@ -50,21 +126,116 @@ class WebsocketAPI:
         return response.json()
     
     def get_image(self, filename, subfolder, folder_type):
+        """Download an image ComfyUI wrote to disk, streamed in chunks instead of one buffered read"""
         data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen("{}/view?{}".format(self.comfyui_base_api_url, url_values)) as response:
-            return response.read()
+        image = bytearray()
+        with httpx.stream("GET", f"{self.comfyui_base_api_url}/view", params=data) as response:
+            response.raise_for_status()
+            for chunk in response.iter_bytes(chunk_size=1 << 16):
+                image += chunk
+        return bytes(image)
+
+    def input_exists(self, filename, subfolder=""):
+        """Whether the input folder of ComfyUI has the file, the body is not downloaded"""
+        data = {"filename": filename, "subfolder": subfolder, "type": "input"}
+        with httpx.stream("GET", f"{self.comfyui_base_api_url}/view", params=data) as response:
+            return response.status_code == 200
 
     # Get history
     def get_history(self, prompt_id):
         with urllib.request.urlopen("{}/history/{}".format(self.comfyui_base_api_url, prompt_id)) as response:
             return json.loads(response.read())
 
+    def get_object_info(self, class_type=None):
+        """
+        Node schemas, {class_type: {'input': {...}, 'output': [...], ...}}
+        Only the schema of class_type when it is given, {} when ComfyUI has no such class
+        """
+        url = f"{self.comfyui_base_api_url}/object_info"
+        if class_type is not None:
+            url += f"/{urllib.parse.quote(class_type, safe='')}"
+        response = httpx.get(url)
+        response.raise_for_status()
+        return response.json()
+
     def get_queue_status(self):
         """Get current queue status"""
         url = f"{self.comfyui_base_api_url}/queue"
         response = httpx.get(url)
         return response.json()
+
+    def get_prompt_queue_state(self, prompt_id):
+        """
+        Returns:
+            str: 'running', 'pending' or None when the prompt is not in the ComfyUI queue
+        """
+        queue = self.get_queue_status()
+        if any(entry[1] == prompt_id for entry in queue.get('queue_running', [])):
+            return 'running'
+        if any(entry[1] == prompt_id for entry in queue.get('queue_pending', [])):
+            return 'pending'
+        return None
+
+    def delete_queued_prompt(self, prompt_id):
+        """Remove a prompt that has not started yet from the ComfyUI queue"""
+        url = f"{self.comfyui_base_api_url}/queue"
+        httpx.post(url, json={"delete": [prompt_id]})
+
+    def get_history_outputs(self, prompt_id, output_node_name):
+        """
+        Get the images a finished prompt wrote to disk, through /history and /view
+
+        Parameters:
+            prompt_id: prompt_id returned by submit_task_to_comfyui
+            output_node_name: List of output node names
+        Returns:
+            output_images: Dictionary like get_images, None while the prompt is not in the history yet
+        Raises:
+            RuntimeError: When the prompt finished with an error
+        """
+        history = self.get_history(prompt_id)
+        if prompt_id not in history:
+            return None
+        entry = history[prompt_id]
+        if entry.get('status', {}).get('status_str') == 'error':
+            raise RuntimeError(f"prompt {prompt_id} finished with an error")
+        outputs = entry.get('outputs', {})
+        output_images = {}
+        for node_id in output_node_name:
+            # A SaveImageWebsocket output has its images in the history under its disk twin
+            node_output = outputs.get(node_id + DISK_OUTPUT_SUFFIX) or outputs.get(node_id, {})
+            for image in node_output.get('images', []):
+                images_output = output_images.setdefault(node_id, [])
+                images_output.append(self.get_image(image['filename'], image['subfolder'], image['type']))
+        return output_images
+
+    def _recover_outputs(self, prompt_id, output_node_name, wait=True):
+        """
+        Images of a prompt that missed websocket messages, from /history. Waits while the prompt is still
+        queued or running, nothing is rendered again.
+        Returns:
+            output_images: Dictionary like get_images, None when the prompt is not in the history and wait is False
+        Raises:
+            RuntimeError: When the prompt failed, or ComfyUI has neither the prompt nor its images
+        """
+        while True:
+            output_images = self.get_history_outputs(prompt_id, output_node_name)
+            if output_images is not None:
+                break
+            if not wait:
+                return None
+            if self.get_prompt_queue_state(prompt_id) is None:
+                output_images = self.get_history_outputs(prompt_id, output_node_name)
+                if output_images is None:
+                    raise RuntimeError(f"prompt {prompt_id} is neither queued nor in the history of ComfyUI")
+                break
+            time.sleep(settings.COMFYUI_RECOVERY_POLL_SECONDS)
+        missing = set(output_node_name) - set(output_images)
+        if missing:
+            raise RuntimeError(f"prompt {prompt_id} finished, but the history has no images of nodes {sorted(missing)}, "
+                               f"set COMFYUI_PERSIST_OUTPUTS to keep them")
+        logger.info(f"prompt {prompt_id} recovered through /history")
+        return output_images
     
     def submit_task_to_comfyui(self, prompt):
         """
@@ -106,7 +277,12 @@ class WebsocketAPI:
         
         """
 
+        # Connect before queueing, so no message of this prompt is sent before we listen
+        self.connect()
         ret = self.queue_prompt(prompt)
+        if 'prompt_id' in ret:
+            with self._state_lock:
+                self._open_prompts.add(ret['prompt_id'])
 
         status = True
         ret_message = "success"
@@ -119,6 +295,8 @@ class WebsocketAPI:
             if 'error' in ret:
                 status = False
                 ret_message = f"Error type: {ret['error']['type']}, Error message: {ret['error']['message']}"
+                if ret.get('node_errors') and self.on_node_errors is not None:
+                    self.on_node_errors(ret['node_errors'])
                 if 'node_errors' in ret:
                     for node_id, error in ret['node_errors'].items():
                         ret_message += f"\nNode {node_id} ({error['class_type']}) error: {error['errors'][0]['details']}"
@@ -129,6 +307,119 @@ class WebsocketAPI:
                 return status, ret_message, {}
         return status, ret_message, prompt_id
 
+    def _clock_node(self, prompt_id, node_id):
+        """Close the timing of the node prompt_id was executing and start node_id, None when the prompt is done"""
+        now = time.perf_counter()
+        previous = self._node_clock.pop(prompt_id, None)
+        if previous is not None:
+            node_times = self._node_times.setdefault(prompt_id, {})
+            node_times[previous[0]] = node_times.get(previous[0], 0.0) + now - previous[1]
+        if node_id is not None:
+            self._node_clock[prompt_id] = (node_id, now)
+
+    def _dispatch_message(self, out):
+        """
+        Record one websocket message, must be called with self._state_lock held
+        Returns:
+            tuple: (prompt_id, node execution times) when the message finished a prompt, otherwise None
+        """
+        if isinstance(out, str):
+            message = json.loads(out)
+            data = message.get('data', {})
+            prompt_id = data.get('prompt_id')
+            if message['type'] == 'executing':
+                logger.debug(f"get comfyui message: {message}")
+                if prompt_id is not None:
+                    self._clock_node(prompt_id, data.get('node'))
+                if data.get('node') is None:
+                    self._executing_prompt_id = None
+                    self._executing_node = None
+                    if prompt_id is not None:
+                        self._finished.setdefault(prompt_id, None)     # Execution is done
+                        node_times = self._node_times.pop(prompt_id, None)
+                        if node_times and self._finished[prompt_id] is None:
+                            return prompt_id, node_times
+                else:
+                    self._executing_prompt_id = prompt_id
+                    self._executing_node = data['node']
+            elif message['type'] == 'execution_cached':
+                if prompt_id is not None:
+                    node_times = self._node_times.setdefault(prompt_id, {})
+                    for node_id in data.get('nodes', []):
+                        node_times.setdefault(node_id, 0.0)
+            elif message['type'] in ('execution_error', 'execution_interrupted'):
+                logger.debug(f"get comfyui message: {message}")
+                if prompt_id is not None:
+                    error = data.get('exception_message', message['type'])
+                    self._finished[prompt_id] = f"Node {data.get('node_id')} ({data.get('node_type')}) error: {error}"
+                    self._node_clock.pop(prompt_id, None)
+                    self._node_times.pop(prompt_id, None)
+        elif self._executing_prompt_id is not None:
+            # Binary frames belong to the node currently executing, ComfyUI runs one prompt at a time
+            node_outputs = self._pending_outputs.setdefault(self._executing_prompt_id, {})
+            node_outputs.setdefault(self._executing_node, []).append(out[8:])
+
+    def wait_for_images(self, prompt_id, output_node_name):
+        """
+        Block until the prompt finished and return its images, safe to call from several threads at once
+
+        Parameters:
+            prompt_id: prompt_id returned by submit_task_to_comfyui
+            output_node_name: List of output node names
+        Returns:
+            output_images: Dictionary containing output image data, key is node name, value is list of image data
+        Raises:
+            RuntimeError: When ComfyUI reports an execution error for the prompt
+        """
+        output_node_name = set(output_node_name)
+        self.connect()
+        checked_reconnects = -1        # Reconnects after which the history was checked, a prompt may be lost before we wait
+        while True:
+            recover = check_history = False
+            with self._state_lock:
+                if prompt_id in self._finished:
+                    error = self._finished.pop(prompt_id)
+                    node_outputs = self._pending_outputs.pop(prompt_id, {})
+                    recover = prompt_id in self._lost_prompts
+                    self._open_prompts.discard(prompt_id)
+                    self._lost_prompts.discard(prompt_id)
+                    if error:
+                        raise RuntimeError(error)
+                    if not recover:
+                        return {node: images for node, images in node_outputs.items() if node in output_node_name}
+                elif prompt_id in self._lost_prompts and checked_reconnects != self.reconnects:
+                    # A prompt that finished while the websocket was down gets no more messages
+                    checked_reconnects = self.reconnects
+                    check_history = True
+                elif not self._reader_lock.acquire(blocking=False):
+                    # Another thread is reading, it wakes us up after every message
+                    self._state_lock.wait()
+                    continue
+            if recover:
+                # Some images of this prompt were sent while the websocket was down
+                output_images = self._recover_outputs(prompt_id, output_node_name)
+                self._report_timings(prompt_id, {})
+                return output_images
+            if check_history:
+                output_images = self._recover_outputs(prompt_id, output_node_name, wait=False)
+                if output_images is not None:
+                    self.discard(prompt_id)
+                    self._report_timings(prompt_id, {})
+                    return output_images
+                continue
+            try:
+                out = self.ws.recv()
+                with self._state_lock:
+                    timings = self._dispatch_message(out)
+                if timings is not None:
+                    self._report_timings(*timings)
+            except (websocket.WebSocketException, OSError) as e:
+                self._reconnect(e)
+            finally:
+                with self._state_lock:
+                    self._reader_lock.release()
+                    self._state_lock.notify_all()
+
     def get_images(self, prompt_id, output_node_name):
         """
         Get image output
@@ -139,28 +430,29 @@ class WebsocketAPI:
         Returns:
             output_images: Dictionary containing output image data, key is node name, value is list of image data
         """
-        self.ws.connect(self.ws_url)
-        output_images = {}
-        current_node = ""
-        while True:
-            out = self.ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message['type'] == 'executing':
-                    data = message['data']
-                    if data.get('prompt_id') == prompt_id:
-                        logger.debug(f"get comfyui message: {message}")
-                        if data['node'] is None:
-                            break #Execution is done
-                        else:
-                            current_node = data['node']
-            else:
-                if current_node in output_node_name:
-                    images_output = output_images.get(current_node, [])
-                    images_output.append(out[8:])
-                    output_images[current_node] = images_output
-        self.ws.close()
-        return output_images
+        return self.wait_for_images(prompt_id, output_node_name)
+
+    def _report_timings(self, prompt_id, node_times):
+        if self.on_prompt_timings is not None:
+            try:
+                self.on_prompt_timings(prompt_id, node_times)
+            except Exception as e:
+                logger.warning(f"prompt timings hook failed: {e}")
+
+    def discard(self, prompt_id):
+        """Forget buffered messages of a prompt nobody waits for anymore"""
+        with self._state_lock:
+            self._finished.pop(prompt_id, None)
+            self._pending_outputs.pop(prompt_id, None)
+            self._open_prompts.discard(prompt_id)
+            self._lost_prompts.discard(prompt_id)
+            self._node_clock.pop(prompt_id, None)
+            self._node_times.pop(prompt_id, None)
+
+    def close(self):
+        with self._connect_lock:
+            if self.ws.connected:
+                self.ws.close()
 
 
 if __name__ == "__main__":
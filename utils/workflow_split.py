@@ -0,0 +1,108 @@
+import copy
+from typing import Any, Dict, Set, Tuple
+
+
+# Node classes whose images leave the workflow, the roots of the nodes ComfyUI executes
+OUTPUT_CLASSES = ("SaveImage", "PreviewImage", "SaveImageWebsocket")
+
+# Suffixes of the node IDs added by split_workflow
+PREPROCESS_OUTPUT_SUFFIX = "_preprocessed"
+CACHED_INPUT_SUFFIX = "_cached"
+
+
+def _links(node: dict) -> list:
+    return [value[0] for value in node['inputs'].values() if isinstance(value, list) and len(value) == 2]
+
+
+def ancestors(workflow: dict, node_id: str) -> Set[str]:
+    """The node and every node its inputs are computed from"""
+    found = set()
+    pending = [node_id]
+    while pending:
+        current = str(pending.pop())
+        if current in found:
+            continue
+        found.add(current)
+        pending.extend(_links(workflow[current]))
+    return found
+
+
+def preprocess_output_id(node_id: str) -> str:
+    """Output node of the preprocess workflow split off at node_id"""
+    return node_id + PREPROCESS_OUTPUT_SUFFIX
+
+
+def split_workflow(workflow: dict, node_id: str) -> Tuple[dict, dict, str]:
+    """
+    Split a workflow at a node whose output only depends on the input image (e.g. background removal of
+    the product image), so it can be rendered once per image and reused by every variant.
+
+    The preprocess workflow is the node, its inputs and a SaveImage node on its image. In the generation
+    workflow the node is replaced by a LoadImage of the saved image and JoinImageWithAlpha, which puts the
+    alpha channel LoadImage splits off (as an inverted mask) back on the image, and the nodes only the
+    preprocessing needed are removed.
+    Returns:
+        tuple: (preprocess workflow, generation workflow, ID of the LoadImage node of the generation workflow)
+    """
+    needed = ancestors(workflow, node_id)
+    output_id = preprocess_output_id(node_id)
+    preprocess = {current: copy.deepcopy(workflow[current]) for current in needed}
+    preprocess[output_id] = {
+        'class_type': 'SaveImage',
+        'inputs': {'images': [node_id, 0], 'filename_prefix': f"preprocess/{node_id}"},
+        '_meta': {'title': f"Preprocessed {node_id}"},
+    }
+
+    load_id = node_id + CACHED_INPUT_SUFFIX
+    generation = copy.deepcopy(workflow)
+    generation[load_id] = {
+        'class_type': 'LoadImage',
+        'inputs': {'image': "", 'upload': "image"},
+        '_meta': {'title': f"Cached output of {node_id}"},
+    }
+    generation[node_id] = {
+        'class_type': 'JoinImageWithAlpha',
+        'inputs': {'image': [load_id, 0], 'alpha': [load_id, 1]},
+        '_meta': {'title': workflow[node_id].get('_meta', {}).get('title', node_id)},
+    }
+    # Drop the inputs of the replaced node that nothing else consumes any more
+    removable = needed - {node_id}
+    while True:
+        consumed = {str(source) for node in generation.values() for source in _links(node)}
+        unused = [current for current in removable if current in generation and current not in consumed
+                  and generation[current].get('class_type') not in OUTPUT_CLASSES]
+        if not unused:
+            break
+        for current in unused:
+            del generation[current]
+    return preprocess, generation, load_id
+
+
+def apply_overrides(workflow: dict, overrides: Dict[str, Dict[str, Any]]) -> dict:
+    """
+    Copy of a workflow with some node inputs changed, e.g. fewer sampler steps. A [node ID, output] value
+    rewires the input to another node; nodes no output depends on any more (e.g. a relighting chain that was
+    bypassed) are dropped, so ComfyUI does not run them.
+    Raises:
+        ValueError: When an override names a node the workflow does not have
+    """
+    unknown = sorted({str(node_id) for node_id, inputs in overrides.items() if str(node_id) not in workflow}
+                     | {str(value[0]) for inputs in overrides.values() for value in inputs.values()
+                        if isinstance(value, list) and len(value) == 2 and str(value[0]) not in workflow})
+    if unknown:
+        raise ValueError(f"overrides refer to nodes {unknown} the workflow does not have")
+    changed = copy.deepcopy(workflow)
+    for node_id, inputs in overrides.items():
+        for name, value in inputs.items():
+            changed[str(node_id)]['inputs'][name] = [str(value[0]), value[1]] if isinstance(value, list) and len(value) == 2 else value
+    needed = set()
+    for node_id, node in changed.items():
+        if node.get('class_type') in OUTPUT_CLASSES:
+            needed |= ancestors(changed, node_id)
+    return {node_id: node for node_id, node in changed.items() if node_id in needed}
+
+
+def bindings_in(bindings: Dict[str, list], workflow: dict) -> Dict[str, list]:
+    """The bindings whose node is in the workflow, parameters without any are left out"""
+    kept = {name: [binding for binding in node_bindings if binding.node in workflow] for name, node_bindings in bindings.items()}
+    return {name: node_bindings for name, node_bindings in kept.items() if node_bindings}
@@ -0,0 +1,217 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from utils.logger import logger
+
+
+# Widget types ComfyUI converts a literal value to, anything else has to come from a link
+WIDGET_TYPES = {"INT": int, "FLOAT": float, "STRING": str, "BOOLEAN": bool}
+
+
+class WorkflowValidationError(ValueError):
+    """
+    The compiled workflow would be rejected by ComfyUI.
+    errors: [{'node_id', 'class_type', 'input_name', 'type', 'details'}], the types follow ComfyUI's node_errors
+    """
+    def __init__(self, errors: List[Dict[str, Any]]) -> None:
+        self.errors = errors
+        message = "Prompt outputs failed validation"
+        for error in errors:
+            message += f"\nNode {error['node_id']} ({error['class_type']}) error: {error['details']}"
+        super().__init__(message)
+
+
+def _types_match(received_type: str, input_type: str) -> bool:
+    """Same rule as ComfyUI: '*' matches anything, 'A,B' matches either type"""
+    if received_type == "*" or input_type == "*":
+        return True
+    return bool(set(received_type.split(",")) & set(input_type.split(",")))
+
+
+class WorkflowValidator:
+    """
+    Checks an API-format workflow against the node schemas of /object_info before it is queued:
+    node classes, required inputs, links and their types, enum members and numeric ranges.
+
+    Schemas are fetched on first use, all of them with one /object_info request, and cached for ttl
+    seconds. A request rejected by a schema older than recheck_seconds is checked again with fresh
+    schemas, so models added on the server are picked up, and the classes named in node_errors of a
+    prompt ComfyUI rejected are dropped from the cache.
+    """
+    def __init__(self, fetch_object_info: Callable[[Optional[str]], Dict[str, Any]], ttl: float = 600.0, recheck_seconds: float = 30.0) -> None:
+        self.fetch_object_info = fetch_object_info
+        self.ttl = ttl
+        self.recheck_seconds = recheck_seconds
+        self._schemas: Dict[str, tuple] = {}     # class_type -> (schema or None when unknown, fetched_at)
+        self._lock = threading.Lock()
+        self.validated = 0
+        self.rejected = 0
+        self.fetches = 0
+
+    def _schema(self, class_type: str, refresh: bool = False) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cached = self._schemas.get(class_type)
+        if cached is not None and not refresh and time.time() - cached[1] < self.ttl:
+            return cached[0]
+        info = self.fetch_object_info(class_type)
+        self.fetches += 1
+        schema = info.get(class_type)
+        with self._lock:
+            self._schemas[class_type] = (schema, time.time())
+        return schema
+
+    def _load(self, class_types: Iterable[str]) -> None:
+        """Fetch every schema at once when several are missing or expired, one request instead of one per class"""
+        now = time.time()
+        with self._lock:
+            missing = {class_type for class_type in class_types
+                       if class_type not in self._schemas or now - self._schemas[class_type][1] >= self.ttl}
+        if len(missing) < 2:
+            return
+        info = self.fetch_object_info(None)
+        self.fetches += 1
+        now = time.time()
+        with self._lock:
+            for class_type, schema in info.items():
+                self._schemas[class_type] = (schema, now)
+            for class_type in missing - set(info):
+                self._schemas[class_type] = (None, now)
+
+    def invalidate(self, class_types: Optional[Iterable[str]] = None) -> None:
+        """Forget the cached schemas of class_types, all of them when None"""
+        with self._lock:
+            if class_types is None:
+                self._schemas.clear()
+            else:
+                for class_type in class_types:
+                    self._schemas.pop(class_type, None)
+
+    def invalidate_node_errors(self, node_errors: Dict[str, Any]) -> None:
+        """ComfyUI rejected a prompt, the schemas of the failing classes may be out of date"""
+        class_types = {error.get('class_type') for error in node_errors.values() if error.get('class_type')}
+        if class_types:
+            logger.info(f"object_info cache: ComfyUI rejected {sorted(class_types)}, schemas are fetched again")
+            self.invalidate(class_types)
+
+    def validate(self, workflow: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Raises:
+            WorkflowValidationError: With every problem found
+        """
+        errors = self._validate(workflow)
+        if errors:
+            # Re-check with fresh schemas when the rejecting ones may be stale
+            now = time.time()
+            with self._lock:
+                stale = {error['class_type'] for error in errors
+                         if error['class_type'] in self._schemas and now - self._schemas[error['class_type']][1] > self.recheck_seconds}
+            if stale:
+                for class_type in stale:
+                    self._schema(class_type, refresh=True)
+                errors = self._validate(workflow)
+        self.validated += 1
+        if errors:
+            self.rejected += 1
+            raise WorkflowValidationError(errors)
+
+    def _validate(self, workflow: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        errors = []
+        schemas = {}
+        self._load({node['class_type'] for node in workflow.values() if node.get('class_type')})
+        for node_id, node in workflow.items():
+            class_type = node.get('class_type')
+            schema = self._schema(class_type) if class_type else None
+            if schema is None:
+                errors.append(self._error(node_id, class_type, None, "missing_node_type", f"Node class {class_type} does not exist"))
+            schemas[node_id] = schema
+
+        # Like ComfyUI, only nodes an output node depends on are executed and checked
+        for node_id in self._reachable(workflow, schemas):
+            schema = schemas[node_id]
+            if schema is None:
+                continue
+            class_type = workflow[node_id]['class_type']
+            inputs = workflow[node_id].get('inputs', {})
+            spec = schema.get('input', {})
+            for section in ('required', 'optional'):
+                for input_name, input_config in (spec.get(section) or {}).items():
+                    if input_name not in inputs:
+                        if section == 'required':
+                            errors.append(self._error(node_id, class_type, input_name, "required_input_missing",
+                                                      f"Required input is missing: {input_name}"))
+                        continue
+                    error = self._check_input(workflow, schemas, inputs[input_name], input_config)
+                    if error:
+                        errors.append(self._error(node_id, class_type, input_name, error[0], f"{input_name}: {error[1]}"))
+        return errors
+
+    @staticmethod
+    def _reachable(workflow: Dict[str, Dict[str, Any]], schemas: Dict[str, Optional[Dict[str, Any]]]) -> List[str]:
+        outputs = [node_id for node_id, schema in schemas.items() if schema and schema.get('output_node')]
+        if not outputs:
+            return list(workflow)
+        seen = set()
+        stack = list(outputs)
+        while stack:
+            node_id = stack.pop()
+            if node_id in seen or node_id not in workflow:
+                continue
+            seen.add(node_id)
+            for value in workflow[node_id].get('inputs', {}).values():
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                    stack.append(str(value[0]))
+        return [node_id for node_id in workflow if node_id in seen]
+
+    @staticmethod
+    def _check_input(workflow, schemas, value, input_config) -> Optional[tuple]:
+        """(error type, details) of one input value, None when it is valid"""
+        input_type = input_config[0]
+        options = input_config[1] if len(input_config) > 1 and isinstance(input_config[1], dict) else {}
+
+        # Link to the output of another node
+        if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+            source_id, slot = str(value[0]), value[1]
+            if source_id not in workflow:
+                return "bad_linked_input", f"linked node {source_id} does not exist"
+            source_schema = schemas.get(source_id)
+            if source_schema is None:
+                return None     # Reported on the source node
+            outputs = source_schema.get('output', [])
+            if slot >= len(outputs):
+                return "bad_linked_input", f"node {source_id} has no output {slot}"
+            received_type = outputs[slot]
+            if isinstance(input_type, str) and isinstance(received_type, str) and not _types_match(received_type, input_type):
+                return "return_type_mismatch", f"{received_type} output of node {source_id} linked to a {input_type} input"
+            return None
+
+        # Enum, either a list of members or the COMBO type with its options
+        members = input_type if isinstance(input_type, list) else (options.get('options') if input_type == "COMBO" else None)
+        if members is not None:
+            if options.get('image_upload'):
+                return None     # The list is the input folder when the schema was fetched, uploads are newer
+            if value not in members:
+                preview = members if len(members) <= 10 else members[:10] + ["..."]
+                return "value_not_in_list", f"'{value}' not in {preview}"
+            return None
+
+        converter = WIDGET_TYPES.get(input_type)
+        if converter is None:
+            return "invalid_input_type", f"{input_type} input needs a link, got {value!r}"
+        try:
+            value = converter(value)
+        except (TypeError, ValueError):
+            return "invalid_input_type", f"{value!r} is not a valid {input_type}"
+        if input_type in ("INT", "FLOAT"):
+            if options.get('min') is not None and value < options['min']:
+                return "value_smaller_than_min", f"{value} is smaller than min {options['min']}"
+            if options.get('max') is not None and value > options['max']:
+                return "value_bigger_than_max", f"{value} is bigger than max {options['max']}"
+        return None
+
+    @staticmethod
+    def _error(node_id, class_type, input_name, error_type, details) -> Dict[str, Any]:
+        return {"node_id": node_id, "class_type": class_type, "input_name": input_name, "type": error_type, "details": details}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"validated": self.validated, "rejected": self.rejected, "schema_fetches": self.fetches, "cached_classes": len(self._schemas)}
@@ -0,0 +1,171 @@
+"""
+Durable job workers backed by the SQLite job store.
+
+    python worker.py run --processes 4                   # N worker processes claiming jobs with leases
+    python worker.py enqueue --data request.json         # add a job, prints its job_id and the expected completion time
+    python worker.py status <job_id>                     # job status, items and result
+    python worker.py variants --format csv               # latency, GPU time per node and failure rate of every workflow variant
+
+kill -USR2 <worker pid> writes a profile of that worker to PROFILER_OUTPUT_DIR.
+
+A job that was running when its worker died is claimed again once its lease expires. Items already
+queued on ComfyUI are re-attached through /history instead of being rendered again.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from utils.job_store import JobStore
+from utils.logger import logger
+from utils.profiling import ensure_loop_lag_monitor, profile_for
+from utils.setting import settings
+
+
+def build_processors(job_store):
+    """One processor per task type of the registry, all of them share the connections of one engine"""
+    from models.azure_openai import azure_openai, azure_model
+    from services.task_engine import TaskEngine
+    engine = TaskEngine(model_client=azure_openai, model_name=azure_model, job_store=job_store)
+    return {task_type: engine.processor(task_type) for task_type in engine.task_types}
+
+
+async def handle_job(job_store, processors, worker_id, job):
+    job_id = job["job_id"]
+    processor = processors.get(job["task_type"])
+    if processor is None:
+        job_store.fail(job_id, worker_id, f"Unknown task type: {job['task_type']}")
+        return
+
+    async def keep_lease():
+        while True:
+            await asyncio.sleep(job_store.lease_seconds / 3)
+            if not await asyncio.to_thread(job_store.heartbeat, job_id, worker_id):
+                logger.error(f"worker {worker_id} lost the lease of job {job_id}")
+                return
+
+    logger.info(f"worker {worker_id} claimed job {job_id} (attempt {job['attempts']})")
+    heartbeat = asyncio.ensure_future(keep_lease())
+    try:
+        result = await processor.process(task_id=job_id, data=job["data"])
+    except Exception as e:
+        logger.error(f"worker {worker_id} job {job_id} raised: {e}")
+        await asyncio.to_thread(job_store.fail, job_id, worker_id, str(e), True)
+        return
+    finally:
+        heartbeat.cancel()
+    if result["status"]:
+        await asyncio.to_thread(job_store.complete, job_id, worker_id, result)
+    else:
+        await asyncio.to_thread(job_store.fail, job_id, worker_id, result["message"])
+    logger.info(f"worker {worker_id} finished job {job_id}, status: {result['status']}")
+
+
+async def worker_loop(db_path, concurrency):
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    job_store = JobStore(db_path)
+    processors = build_processors(job_store)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    # kill -USR2 <pid> profiles this worker for PROFILER_SIGNAL_SECONDS
+    loop.add_signal_handler(signal.SIGUSR2, profile_for, settings.PROFILER_SIGNAL_SECONDS, "worker")
+    monitor = ensure_loop_lag_monitor()
+
+    slots = asyncio.Semaphore(concurrency)
+    running = set()
+    logger.info(f"worker {worker_id} started, concurrency {concurrency}")
+    while not stopping.is_set():
+        await slots.acquire()
+        job = await asyncio.to_thread(job_store.claim, worker_id)
+        if job is None:
+            slots.release()
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=settings.JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        task = asyncio.ensure_future(handle_job(job_store, processors, worker_id, job))
+        running.add(task)
+        task.add_done_callback(running.discard)
+        task.add_done_callback(lambda _: slots.release())
+    # Finish the jobs in flight, unfinished ones are picked up again after their lease expires
+    if running:
+        await asyncio.gather(*running, return_exceptions=True)
+    if monitor is not None:
+        logger.info(f"worker {worker_id} loop lag: {monitor.stats()}")
+    logger.info(f"worker {worker_id} stopped")
+
+
+def run_worker(db_path, concurrency):
+    asyncio.run(worker_loop(db_path, concurrency))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Durable job workers")
+    parser.add_argument("--db", default=settings.JOB_STORE_PATH, help="SQLite job store path")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Start worker processes")
+    run.add_argument("--processes", type=int, default=1)
+    run.add_argument("--concurrency", type=int, default=1, help="Jobs one worker process runs at the same time")
+
+    enqueue = commands.add_parser("enqueue", help="Add a job")
+    enqueue.add_argument("--task-type", default="image2poster")
+    enqueue.add_argument("--data", required=True, help="JSON file with the process data, - for stdin")
+    enqueue.add_argument("--priority", type=int, default=0, help="Lower values are claimed first")
+
+    status = commands.add_parser("status", help="Show a job")
+    status.add_argument("job_id")
+
+    variants = commands.add_parser("variants", help="Export the statistics of the workflow variants")
+    variants.add_argument("--format", choices=("json", "csv"), default="json", help="csv leaves out the GPU seconds per node")
+    variants.add_argument("--output", help="File to write, stdout by default")
+    variants.add_argument("--stats-dir", default=settings.VARIANT_STATS_DIR, help="Directory of the statistics files of the workers")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        processes = [multiprocessing.Process(target=run_worker, args=(args.db, args.concurrency)) for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
+    elif args.command == "enqueue":
+        with (sys.stdin if args.data == "-" else open(args.data, "r", encoding="utf-8")) as file:
+            data = json.load(file)
+        job_store = JobStore(args.db)
+        job_id = job_store.enqueue(args.task_type, data, priority=args.priority)
+        print(job_id)
+        # Expected GPU seconds of the jobs claimed before this one and of the job itself, from the measured node times
+        from utils.cost_model import cost_model, estimate_backlog_seconds
+        job = {"task_type": args.task_type, "data": data}
+        eta_seconds = (estimate_backlog_seconds(job_store.jobs_ahead(job_id), cost_model)
+                       + estimate_backlog_seconds([job], cost_model)) / max(1, settings.ADMISSION_GPU_WORKERS)
+        print(f"expected completion in {eta_seconds:.0f}s, at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() + eta_seconds))}",
+              file=sys.stderr)
+    elif args.command == "status":
+        job = JobStore(args.db).get_job(args.job_id)
+        print(json.dumps(job, indent=2, ensure_ascii=False) if job else f"job {args.job_id} not found")
+    elif args.command == "variants":
+        from utils.variant_stats import load_report, report_csv
+        rows = load_report(args.stats_dir)
+        text = report_csv(rows) if args.format == "csv" else json.dumps(rows, indent=2, ensure_ascii=False) + "\n"
+        if args.output:
+            with open(args.output, "w", encoding="utf-8", newline="") as file:
+                file.write(text)
+        else:
+            sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    main()